@@ -16,11 +16,22 @@ from time import time
 from collections import *
 import traceback
 import datetime
+import math
+import json
+import threading
+import pickle
+import queue
 
 # Third party imports
 import numpy as np
 from tqdm import tqdm
 
+# Optional shared memory support (python >= 3.8)
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
 # Local imports
 from NanopolishComp.common import *
 from NanopolishComp import __version__ as package_version
@@ -34,34 +45,150 @@ logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 class Eventalign_collapse ():
 
+    # Fixed dtypes of the kmer fields in npy output format
+    NPY_DTYPE = OrderedDict ([
+        ("ref_pos", np.int32),
+        ("ref_kmer", np.uint16),
+        ("num_events", np.uint32),
+        ("dwell_time", np.float32),
+        ("NNNNN_dwell_time", np.float32),
+        ("mismatch_dwell_time", np.float32),
+        ("start_idx", np.uint32),
+        ("end_idx", np.uint32),
+        ("mean", np.float32),
+        ("std", np.float32),
+        ("median", np.float32),
+        ("mad", np.float32),
+        ("num_signals", np.uint32),
+        ("samples_offset", np.uint32),
+        ("samples_count", np.uint32)])
+
+    # Read summary fields of the index file, followed by the data offset fields
+    IDX_HEADER = "ref_id\tref_start\tref_end\tread_id\tkmers\tdwell_time\tNNNNN_kmers\tmismatch_kmers\tmissing_kmers\t"
+
     def __init__ (self,
-        input_fn:"str",
+        input_fn:"str or list of str",
         outdir:"str"="./",
         outprefix:"str"="out",
         max_reads:"int"=None,
         write_samples:"bool"=False,
+        samples_format:"str"="text",
         stat_fields:"list of str"=["mean", "median", "num_signals"],
         threads:"int"=4,
+        vectorized_parser:"bool"=False,
+        shard_input:"bool"=False,
+        batch_reads:"int"=1,
+        batch_bytes:"int"=0,
+        max_memory:"int or str"=0,
+        ordered:"bool"=False,
+        reorder_buffer:"int"=1000,
+        output_format:"str"="tsv",
+        max_chunk_events:"int"=0,
+        event_stats:"bool"=False,
+        decompress_threads:"int"=4,
+        compress_output:"bool"=False,
+        compress_threads:"int"=4,
+        resume:"bool"=False,
+        shm_buffer:"int or str"=0,
+        writers:"int"=1,
+        metrics_interval:"float"=0,
+        auto:"bool"=False,
+        auto_reads:"int"=200,
         verbose:"bool"=False,
         quiet:"bool"=False):
         """
         Collapse the nanopolish eventalign output by kmers rather that by events.
         kmer level statistics (mean, median, std, mad) are only computed if nanopolish is run with --samples option
         * input_fn
-            Path to a nanopolish eventalign tsv output file.
+            Path to a nanopolish eventalign tsv output file or named pipe, or list of paths. Multiple inputs are read concurrently
+            by one reader each and written to a single data file and index. The number of reads parsed from each input is
+            reported in the log file. Cannot be used with shard_input, ordered or max_chunk_events
         * outdir
             Path to the output folder (will be created if it does exist yet)
         * outprefix
             text outprefix for all the files generated
         * max_reads
-            Maximum number of read to parse. 0 to deactivate (default = 0)
+            Maximum number of read to parse, per input. 0 to deactivate (default = 0)
         * write_samples
             If given, will write the raw sample if nanopolish eventalign was ran with --samples option
+        * samples_format
+            Format of the samples written with write_samples. "text" = comma separated values in the samples column of the data file.
+            "float32" or "int16" = binary samples file (*_eventalign_collapse.samples.npy) which can be memory mapped. int16 values are
+            scaled by common.SAMPLES_INT16_SCALE. The kmer rows then contain samples_offset and samples_count relative to the first
+            sample of the read, and the index contains samples_offset and samples_len of the read in the samples file (default = text)
         * stat_fields
             List of statistical fields to compute if nanopolish eventalign was ran with --samples option.
             Valid values = "mean", "std", "median", "mad", "num_signals"
         * threads
-            Total number of threads. 1 thread is used for the reader and 1 for the writer (default = 4)
+            Total number of threads. 1 thread is used for the reader of each input and 1 for each writer. With auto, maximum total
+            number of threads, or 0 to use all the CPUs available (default = 4)
+        * vectorized_parser
+            Parse the input by large byte blocks with numpy instead of line by line. Much faster reader for large files
+        * shard_input
+            Split the input file in byte ranges starting at read boundaries, which are directly parsed and collapsed by the workers.
+            Removes the reader process. Requires an input file (not stdin) and cannot be used with max_reads
+        * batch_reads
+            Number of reads grouped in a single message between the reader, the workers and the writer (default = 1)
+        * batch_bytes
+            Send a batch as soon as its estimated size reaches this number of bytes, even if batch_reads is not reached.
+            Accepts sizes with unit suffix such as 500K or 2M. 0 to deactivate (default = 0)
+        * max_memory
+            Maximum estimated size of the reads in flight in the queues between the reader, the workers and the writer.
+            The reader waits when the limit is reached. Accepts sizes with unit suffix such as 500M or 8G. With shm_buffer, the shared memory
+            buffer is allocated in addition and only the reads larger than a slot, sent through the queue, are counted. 0 to deactivate (default = 0)
+        * ordered
+            Write reads in the same order as in the input file. Cannot be used with shard_input
+        * reorder_buffer
+            Maximum number of reads held by the writer to restore the input order with ordered. The reader waits when the limit is reached (default = 1000)
+        * output_format
+            Format of the collapsed data file. "tsv" = text file, "npy" = numpy structured array file with fixed dtype columns which can be
+            memory mapped with np.load(fn, mmap_mode="r"). In npy format, ref_kmer is encoded as uint16 (see common.kmer_to_code) and the
+            index contains row_offset and row_len instead of byte_offset and byte_len (default = tsv)
+        * max_chunk_events
+            Split reads with more events than this value in chunks which are collapsed and written separately, so that memory usage does
+            not depend on read length. Chunks are cut between kmers and the read index line is written after the last chunk. Implies
+            ordered. Cannot be used with vectorized_parser or shard_input. 0 to deactivate (default = 0)
+        * event_stats
+            Compute the kmer mean and std from the event_level_mean, event_stdv and event_length fields instead of the samples, so that
+            nanopolish eventalign does not need to be run with --samples. Values are pooled over the events of each kmer, weighted by
+            event length. Only the mean and std stat_fields can be computed this way
+        * decompress_threads
+            Number of threads used by the reader to decompress BGZF compressed input in parallel. gzip and zstd compressed input
+            are also detected but decompressed by a single thread. In addition to threads (default = 4)
+        * compress_output
+            Write the tsv data file compressed in BGZF format (*_eventalign_collapse.tsv.gz). The index contains BGZF virtual offsets
+            (compressed block offset << 16 | offset in the uncompressed block) instead of byte offsets. Not available with npy output
+        * compress_threads
+            Number of threads used by the writer to compress BGZF blocks in parallel with compress_output. In addition to threads (default = 4)
+        * resume
+            Resume an interrupted run with the same outdir and outprefix. Reads found in the existing index are skipped, partial records at
+            the end of the data and index files are truncated and new reads are appended. The input file or stream has to be supplied again
+            and is read from the beginning, but only the read_id and ref_id fields of the lines of skipped reads are parsed.
+            Only available for uncompressed tsv output without binary samples file and cannot be used with max_reads
+        * shm_buffer
+            Size of a shared memory buffer used to pass the input from the readers to the workers, for instance when reading from stdin.
+            The buffer is divided in slots in which the readers directly read blocks of complete reads. Only the slot numbers are sent
+            through the queue and the workers parse the blocks in place with the vectorized parser. Reads larger than a slot are sent
+            through the queue. Accepts sizes with unit suffix such as 256M. Requires python >= 3.8. Cannot be used with shard_input,
+            ordered, max_chunk_events or max_reads. 0 to deactivate (default = 0)
+        * writers
+            Number of writer processes. With more than 1 writer, each writer writes its own numbered data file (shard) and index. A unified
+            index with the shard number of each read (*_eventalign_collapse.tsv.idx) and a manifest listing the shard files
+            (*_eventalign_collapse.tsv.manifest) are written at the end. The manifest can be opened with Eventalign_collapse_reader as a
+            single dataset. Cannot be used with ordered, max_chunk_events or resume (default = 1)
+        * metrics_interval
+            Interval in seconds between samples of the pipeline metrics (reads and events per second of each stage, time blocked on the
+            queues, queue depths, worker busy fraction and writer bytes per second) written to *_eventalign_collapse.metrics.jsonl,
+            one JSON object per line. A summary of the whole run is added to the log file. With shm_buffer, the reads of the readers
+            are counted when the workers parse the blocks. Writer bytes are the bytes written to the data, samples and index files,
+            before compression with compress_output. 0 to deactivate (default = 0)
+        * auto
+            Measure the reading, queue transfer, collapsing and writing costs per read on the first auto_reads reads of the first input
+            and choose the number of workers needed to keep up with the readers and writers (within threads), the number of reads per
+            batch and the queue sizes fitting in max_memory or in a quarter of the available memory. The chosen configuration is
+            reported in the log file. Requires a regular input file (not stdin or a named pipe)
+        * auto_reads
+            Number of reads sampled at the beginning of the first input by auto (default = 200)
         * verbose
             Increase verbosity
         * quiet
@@ -93,76 +220,237 @@ class Eventalign_collapse ():
 
         # Verify parameters validity
         self.log.info ("Checking arguments")
-        # Try to read input file if not a stream
-        self.log.debug("\tTesting input file readability")
-        if input_fn != 0 and not file_readable (input_fn):
-            raise IOError ("Cannot read input file")
+        # Try to read input files if not a stream
+        self.log.debug("\tTesting input files readability")
+        input_fn_list = list (input_fn) if isinstance (input_fn, (list, tuple)) else [input_fn]
+        for fn in input_fn_list:
+            if fn != 0 and not file_readable (fn) and not fifo_readable (fn):
+                raise IOError ("Cannot read input file {}".format(fn))
         # Try to create output folder
         self.log.debug("\tCreating output folder")
         mkdir(outdir, exist_ok=True)
         # Check other args
+        if auto:
+            self.log.debug("\tChecking automatic tuning options")
+            if input_fn_list[0] == 0 or not file_readable (input_fn_list[0]):
+                raise ValueError ("auto requires a regular input file and cannot read from stdin or a named pipe")
+            if auto_reads < 1:
+                raise ValueError ("auto_reads should be at least 1")
+            if not threads:
+                threads = max (available_cpus (), len(input_fn_list)+writers+1)
         self.log.debug("\tChecking number of threads")
-        if threads < 3:
-            raise ValueError ("At least 3 threads required")
+        if threads < len(input_fn_list)+writers+1:
+            raise ValueError ("At least {} threads required".format(len(input_fn_list)+writers+1))
         self.log.debug("\tChecking if stat_fields names are valid")
         for field in stat_fields:
             if not field in ["mean", "std", "median", "mad", "num_signals"]:
                 raise ValueError ("Invalid value in stat_field {}. Valid entries = mean, std, median, mad, num_signals".format(field))
+        if len(input_fn_list) > 1:
+            self.log.debug("\tChecking multiple inputs options")
+            if shard_input or ordered or max_chunk_events:
+                raise ValueError ("shard_input, ordered and max_chunk_events cannot be used with multiple inputs")
+        if shard_input:
+            self.log.debug("\tChecking sharded input options")
+            input_fn = input_fn_list[0]
+            if input_fn == 0 or not file_readable (input_fn):
+                raise ValueError ("Sharded input requires a regular input file and cannot read from stdin or a named pipe")
+            if max_reads:
+                raise ValueError ("max_reads cannot be used with sharded input")
+            if input_compression (input_fn):
+                raise ValueError ("Sharded input requires an uncompressed input file")
+        self.log.debug("\tChecking batch and memory options")
+        if batch_reads < 1:
+            raise ValueError ("batch_reads should be at least 1")
+        batch_bytes = parse_size (batch_bytes)
+        max_memory = parse_size (max_memory)
+        self.log.debug("\tChecking output format")
+        if not output_format in ["tsv", "npy"]:
+            raise ValueError ("Invalid output_format {}. Valid entries = tsv, npy".format(output_format))
+        self.log.debug("\tChecking samples format")
+        if not samples_format in ["text", "float32", "int16"]:
+            raise ValueError ("Invalid samples_format {}. Valid entries = text, float32, int16".format(samples_format))
+        if output_format == "npy" and write_samples and samples_format == "text":
+            raise ValueError ("write_samples cannot be used with npy output format and text samples_format")
+        if output_format == "npy" and compress_output:
+            raise ValueError ("compress_output cannot be used with npy output format")
+        if event_stats:
+            self.log.debug("\tChecking event level stat options")
+            skipped_fields = [field for field in stat_fields if not field in ["mean", "std"]]
+            if skipped_fields:
+                self.log.info ("\tstat_fields {} cannot be computed from event level fields and are skipped".format(", ".join(skipped_fields)))
+            stat_fields = [field for field in stat_fields if field in ["mean", "std"]]
+        if max_chunk_events:
+            self.log.debug("\tChecking read chunking options")
+            if max_chunk_events < 0:
+                raise ValueError ("max_chunk_events should be positive")
+            if vectorized_parser or shard_input:
+                raise ValueError ("max_chunk_events cannot be used with vectorized_parser or shard_input")
+            # Chunks of a read have to be written contiguously
+            ordered = True
+        if resume:
+            self.log.debug("\tChecking resume options")
+            if output_format != "tsv" or compress_output or (write_samples and samples_format != "text"):
+                raise ValueError ("resume is only available for uncompressed tsv output without binary samples file")
+            if max_reads:
+                raise ValueError ("max_reads cannot be used with resume")
+        shm_buffer = parse_size (shm_buffer)
+        if shm_buffer:
+            self.log.debug("\tChecking shared memory options")
+            if not shared_memory:
+                raise ValueError ("shm_buffer requires python >= 3.8")
+            if shard_input or ordered or max_chunk_events or max_reads:
+                raise ValueError ("shm_buffer cannot be used with shard_input, ordered, max_chunk_events or max_reads")
+        if writers > 1:
+            self.log.debug("\tChecking multiple writers options")
+            if ordered or max_chunk_events or resume:
+                raise ValueError ("ordered, max_chunk_events and resume cannot be used with multiple writers")
+        elif writers < 1:
+            raise ValueError ("writers should be at least 1")
+        if metrics_interval < 0:
+            raise ValueError ("metrics_interval should be positive")
+        if ordered:
+            self.log.debug("\tChecking ordered output options")
+            if shard_input:
+                raise ValueError ("ordered cannot be used with sharded input")
+            if reorder_buffer < 1:
+                raise ValueError ("reorder_buffer should be at least 1")
 
         # Save args to self values
-        self.outdir = outdir
-        self.outprefix = outprefix
-        self.input_fn = input_fn
-        self.threads = threads-2 # Remove 2 threads for read and write
+        self._init_writer (outdir, outprefix, output_format, compress_output, compress_threads, write_samples and samples_format != "text",
+            samples_format, ordered, writers, 0 if shard_input else len(input_fn_list))
+        self.input_fn_list = input_fn_list
+        self.shard_input = shard_input
+        self.threads = threads-writers if shard_input else threads-len(input_fn_list)-writers # Remove 1 thread per reader and per writer or per writer only if sharded
         self.max_reads = max_reads
         self.write_samples = write_samples
         self.stat_fields = stat_fields
+        self.batch_reads = batch_reads
+        self.batch_bytes = batch_bytes
+        self.max_chunk_events = max_chunk_events
+        self.event_stats = event_stats
+        self.decompress_threads = decompress_threads
+        if resume:
+            self.log.info ("Reading index of previous run")
+            self.done_reads, self.resume_offset = self._init_resume ()
+            self.log.info ("\tFound {:,} reads already written".format(len(self.done_reads)))
+        self.queue_size = 1000
+        if auto:
+            self.log.info ("Measuring processing costs on the first {:,} reads".format(auto_reads))
+            self.auto_d = self._auto_tune (auto_reads, threads, max_memory, vectorized_parser, shm_buffer)
+            self.log.info ("\tChosen configuration: {} workers, {} reads per batch, queue size {}".format(
+                self.threads, self.batch_reads, self.queue_size))
 
         # Init Multiprocessing variables
-        in_q = mp.Queue (maxsize = 1000)
-        out_q = mp.Queue (maxsize = 1000)
+        in_q = mp.Queue (maxsize = self.queue_size)
+        out_q = mp.Queue (maxsize = self.queue_size)
         error_q = mp.Queue ()
+        self.memory_budget = MemoryBudget (max_memory) if max_memory else None
+        self.metrics = PipelineMetrics () if metrics_interval else None
+        if ordered:
+            self.reorder_slots = mp.Semaphore (reorder_buffer)
+            self.reorder_wait = mp.Value ("d", 0.0)
+        # Shared memory buffer divided in slots and queue of free slots
+        self.shm = None
+        if shm_buffer:
+            n_slots = 2*self.threads+len(input_fn_list)
+            self.shm_slot_size = shm_buffer//n_slots
+            self.shm = shared_memory.SharedMemory (create=True, size=n_slots*self.shm_slot_size)
+            self.shm_slots = mp.Queue ()
+            for slot in range (n_slots):
+                self.shm_slots.put (slot)
+            self.log.debug ("\tShared memory buffer: {} slots of {:,} bytes".format(n_slots, self.shm_slot_size))
 
         # Define processes
-        ps_list = []
-        ps_list.append (mp.Process (target=self._split_reads, args=(in_q, error_q)))
-        for i in range (self.threads):
-            ps_list.append (mp.Process (target=self._process_read, args=(in_q, out_q, error_q, i+1)))
-        ps_list.append (mp.Process (target=self._write_output, args=(out_q, error_q)))
+        reader_ps_list = []
+        worker_ps_list = []
+        writer_ps_list = []
+        if shard_input:
+            self.log.info ("Splitting input file in shards")
+            for i, (shard_start, shard_end) in enumerate (self._get_shard_list()):
+                worker_ps_list.append (mp.Process (target=self._process_shard, args=(shard_start, shard_end, out_q, error_q, i+1)))
+        else:
+            for input_id, fn in enumerate (input_fn_list):
+                if shm_buffer:
+                    reader_ps_list.append (mp.Process (target=self._split_blocks_shm, args=(fn, input_id, in_q, error_q)))
+                elif vectorized_parser:
+                    reader_ps_list.append (mp.Process (target=self._split_reads_vectorized, args=(fn, input_id, in_q, error_q)))
+                else:
+                    reader_ps_list.append (mp.Process (target=self._split_reads, args=(fn, input_id, in_q, error_q)))
+            for i in range (self.threads):
+                if shm_buffer:
+                    worker_ps_list.append (mp.Process (target=self._process_block_shm, args=(in_q, out_q, error_q, i+1)))
+                else:
+                    worker_ps_list.append (mp.Process (target=self._process_read, args=(in_q, out_q, error_q, i+1)))
+        if writers == 1:
+            writer_ps_list.append (mp.Process (target=self._write_output, args=(out_q, error_q)))
+        else:
+            for writer_id in range (writers):
+                writer_ps_list.append (mp.Process (target=self._write_output, args=(out_q, error_q, writer_id)))
+        ps_list = reader_ps_list+worker_ps_list+writer_ps_list
 
         self.log.info ("Starting to process files")
+        t = time()
+        metrics_stop = threading.Event ()
+        metrics_thread = None
         try:
             # Start all processes
             for ps in ps_list:
                 ps.start ()
-            # Monitor error queue
-            for E in iter (error_q.get, None):
-                raise E
+            # Poison pills are sent once all the readers, then all the workers, have exited
+            if reader_ps_list:
+                threading.Thread (target=self._send_poison_pills, args=(reader_ps_list, in_q, self.threads), daemon=True).start ()
+            threading.Thread (target=self._send_poison_pills, args=(worker_ps_list, out_q, writers), daemon=True).start ()
+            # Sample the pipeline metrics from the main process
+            if self.metrics:
+                metrics_thread = threading.Thread (target=self._sample_metrics, args=(in_q, out_q, metrics_interval, metrics_stop, t), daemon=True)
+                metrics_thread.start ()
+            # Monitor error queue until all writers are done
+            for _ in range (writers):
+                for E in iter (error_q.get, None):
+                    raise E
             # Join processes
             for ps in ps_list:
                 ps.join ()
+            # Merge the indexes of the writers
+            if writers > 1:
+                self._merge_writers (t)
 
         # Kill processes if any error
         except (BrokenPipeError, KeyboardInterrupt, NanopolishCompError) as E:
             for ps in ps_list:
                 ps.terminate ()
+            # Items left in the queues are never consumed, do not wait for them to be flushed at exit
+            in_q.cancel_join_thread ()
+            out_q.cancel_join_thread ()
             self.log.warning ("\nAn error occured. All processes were killed\n")
             raise E
 
+        # Stop metrics sampling and release shared memory buffer
+        finally:
+            if metrics_thread:
+                metrics_stop.set ()
+                metrics_thread.join ()
+            if self.shm:
+                self.shm.close ()
+                self.shm.unlink ()
+
     def __repr__ (self):
         m = "General options:\n"
         m+=dict_to_str(self.option_d)
         return m
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
-    def _split_reads (self, in_q, error_q):
+    def _split_reads (self, input_fn, input_id, in_q, error_q):
         """
         Mono-threaded reader
         """
-        self.log.debug("\t[split_reads] Start reading input file/stream")
+        self.log.debug("\t[split_reads {}] Start reading input file/stream".format(input_id))
+        in_batch = QueueBatcher (q=in_q, max_items=self.batch_reads, max_bytes=self.batch_bytes, size_fun=self._item_size, budget=self.memory_budget,
+            metrics=self.metrics, stage="reader")
+        n_reads = 0
         try:
-            # Open input file or stdin if 0
-            with open (self.input_fn) as fp:
+            # Open input file or stdin if 0. Compressed input is decompressed on the fly
+            with open_input (input_fn, threads=self.decompress_threads) as fp:
 
                 # Get header line and extract corresponding index
                 input_header = fp.readline().rstrip().split("\t")
@@ -170,11 +458,22 @@ class Eventalign_collapse ():
                     raise NanopolishCompError ("Input file/stream is empty")
 
                 idx = self._get_field_idx (input_header)
-                n_reads = 0
+                seq = 0
+                # Chunk number, last position and number of samples of the previous chunks for reads split in chunks
+                chunk_idx = 0
+                prev_pos = None
+                prev_samples = 0
 
-                # First data line exception
+                # First data line exception. Lines of reads written by a previous run are skipped after splitting only the id fields
+                id_fields = max (idx["read_id"], idx["ref_id"])+1
                 read_l = []
-                event_l = fp.readline().rstrip().split("\t")
+                for line in fp:
+                    field_l = line.split ("\t", id_fields)
+                    if not (field_l[idx["read_id"]], field_l[idx["ref_id"]]) in self.done_reads:
+                        break
+                else:
+                    return
+                event_l = line.rstrip().split("\t")
                 cur_read_id = event_l[idx["read_id"]]
                 cur_ref_id = event_l[idx["ref_id"]]
                 event_d = self._event_list_to_dict (event_l, idx)
@@ -185,6 +484,10 @@ class Eventalign_collapse ():
                     if self.max_reads and n_reads == self.max_reads:
                         break
                     # Get event line
+                    if self.done_reads:
+                        field_l = line.split ("\t", id_fields)
+                        if (field_l[idx["read_id"]], field_l[idx["ref_id"]]) in self.done_reads:
+                            continue
                     event_l = line.rstrip().split("\t")
                     read_id = event_l[idx["read_id"]]
                     ref_id = event_l[idx["ref_id"]]
@@ -192,162 +495,1246 @@ class Eventalign_collapse ():
 
                     # Line correspond to the same ids
                     if read_id != cur_read_id or ref_id != cur_ref_id:
-                        in_q.put ((cur_read_id, cur_ref_id, read_l))
+                        if self.ordered:
+                            self._acquire_reorder_slot (in_batch)
+                        in_batch.put ((seq, cur_read_id, cur_ref_id, read_l, (chunk_idx, True, prev_pos, prev_samples) if chunk_idx else None), events=len(read_l))
                         n_reads+=1
+                        seq+=1
                         read_l = []
                         cur_read_id = read_id
                         cur_ref_id = ref_id
+                        chunk_idx = 0
+                        prev_pos = None
+                        prev_samples = 0
+
+                    # Send the current part of a long read when a new kmer starts
+                    elif self.max_chunk_events and len(read_l) >= self.max_chunk_events and event_d["ref_pos"] != read_l[-1]["ref_pos"]:
+                        self._acquire_reorder_slot (in_batch)
+                        in_batch.put ((seq, cur_read_id, cur_ref_id, read_l, (chunk_idx, False, prev_pos, prev_samples)), reads=0, events=len(read_l))
+                        seq+=1
+                        prev_pos = read_l[-1]["ref_pos"]
+                        prev_samples += sum (len(event_d.get("sample_list", ())) for event_d in read_l)
+                        chunk_idx += 1
+                        read_l = []
 
                     # In any case extend list corresponding to current read_id/ref_id
                     read_l.append(event_d)
 
                 # Last data line exception
-                in_q.put ((cur_read_id, cur_ref_id, read_l))
+                if self.ordered:
+                    self._acquire_reorder_slot (in_batch)
+                in_batch.put ((seq, cur_read_id, cur_ref_id, read_l, (chunk_idx, True, prev_pos, prev_samples) if chunk_idx else None), events=len(read_l))
                 n_reads+=1
 
         # Manage exceptions and deal poison pills
         except Exception:
             error_q.put (NanopolishCompError(traceback.format_exc()))
         finally:
-            for i in range (self.threads):
-                in_q.put(None)
-            self.log.debug("\t[split_reads] Done")
+            self._reader_done (input_id, n_reads, in_batch)
+            self.log.debug("\t[split_reads {}] Done".format(input_id))
+
+    def _split_reads_vectorized (self, input_fn, input_id, in_q, error_q):
+        """
+        Mono-threaded reader parsing the input by large byte blocks with numpy
+        """
+        self.log.debug("\t[split_reads {}] Start reading input file/stream by blocks".format(input_id))
+        in_batch = QueueBatcher (q=in_q, max_items=self.batch_reads, max_bytes=self.batch_bytes, size_fun=self._item_size, budget=self.memory_budget,
+            metrics=self.metrics, stage="reader")
+        n_reads = 0
+        try:
+            # Open input file or stdin if 0 in binary mode. Compressed input is decompressed on the fly
+            with open_input (input_fn, "rb", threads=self.decompress_threads) as fp:
+
+                # Get header line and extract corresponding index
+                input_header = fp.readline().decode().rstrip().split("\t")
+                if input_header == [""]:
+                    raise NanopolishCompError ("Input file/stream is empty")
+
+                idx = self._get_field_idx (input_header)
+                block_parser = BlockParser (idx=idx, n_fields=len(input_header))
+
+                for read_id, ref_id, read_a in block_parser (fp, skip_reads=self.done_reads):
+                    # Early ending if required
+                    if self.max_reads and n_reads == self.max_reads:
+                        break
+                    if self.ordered:
+                        self._acquire_reorder_slot (in_batch)
+                    in_batch.put ((n_reads, read_id, ref_id, read_a, None), events=len(read_a["events"]))
+                    n_reads+=1
+
+        # Manage exceptions and deal poison pills
+        except Exception:
+            error_q.put (NanopolishCompError(traceback.format_exc()))
+        finally:
+            self._reader_done (input_id, n_reads, in_batch)
+            self.log.debug("\t[split_reads {}] Done".format(input_id))
+
+    def _split_blocks_shm (self, input_fn, input_id, in_q, error_q):
+        """
+        Mono-threaded reader filling the slots of the shared memory buffer with blocks of complete reads read from the input.
+        Only the slot descriptors are sent to the workers. Reads are only delimited and counted by the workers
+        """
+        self.log.debug("\t[split_blocks_shm {}] Start reading input file/stream in shared memory".format(input_id))
+        in_batch = QueueBatcher (q=in_q, max_items=self.batch_reads, size_fun=self._shm_item_size, budget=self.memory_budget,
+            metrics=self.metrics, stage="reader")
+        slot_size = self.shm_slot_size
+        try:
+            # Open input file or stdin if 0 in binary mode. Compressed input is decompressed on the fly
+            with open_input (input_fn, "rb", threads=self.decompress_threads) as fp:
+
+                # Get header line and extract corresponding index
+                input_header = fp.readline().decode().rstrip().split("\t")
+                if input_header == [""]:
+                    raise NanopolishCompError ("Input file/stream is empty")
+                block_parser = BlockParser (idx=self._get_field_idx (input_header), n_fields=len(input_header))
+
+                # The last read of a block might continue after it and is carried over to the next block
+                carry = b""
+                eof = False
+                while not eof:
+                    if len(carry) < slot_size:
+                        slot = self._get_shm_slot (in_batch)
+                        view = self.shm.buf[slot*slot_size:(slot+1)*slot_size]
+                        view[:len(carry)] = carry
+                        n = len(carry)+self._readinto (fp, view[len(carry):])
+                        eof = n < slot_size
+                        buf = np.frombuffer (view, dtype=np.uint8, count=n)
+                        tail = n if eof else self._last_read_start (buf, block_parser)
+                        if eof or tail:
+                            carry = buf[tail:].tobytes()
+                            n_events = int (np.count_nonzero (buf[:tail] == 10)) if self.metrics else 0
+                            del buf, view
+                            if tail:
+                                in_batch.put ((input_id, block_parser, slot, tail, None), reads=0, events=n_events)
+                            else:
+                                self.shm_slots.put (slot)
+                            continue
+                        # A single read fills the slot
+                        carry = buf.tobytes()
+                        del buf, view
+                        self.shm_slots.put (slot)
+
+                    # Read larger than a slot sent through the queue
+                    data = bytearray (carry)
+                    while True:
+                        block = fp.read (slot_size)
+                        eof = not block
+                        data += block
+                        tail = len(data) if eof else self._last_read_start (np.frombuffer (data, dtype=np.uint8), block_parser)
+                        if eof or tail:
+                            break
+                    if tail:
+                        in_batch.put ((input_id, block_parser, None, tail, bytes(data[:tail])), reads=0, events=data.count (b"\n", 0, tail))
+                    carry = bytes (data[tail:])
+
+        # Manage exceptions and deal poison pills
+        except Exception:
+            error_q.put (NanopolishCompError(traceback.format_exc()))
+        finally:
+            self._reader_done (input_id, None, in_batch)
+            self.log.debug("\t[split_blocks_shm {}] Done".format(input_id))
+
+    def _get_shm_slot (self, in_batch):
+        """Get a free slot of the shared memory buffer. The pending batch is sent first if none is free, since it might hold all the slots"""
+        try:
+            return self.shm_slots.get (block=False)
+        except queue.Empty:
+            in_batch.flush ()
+            return self.shm_slots.get ()
+
+    def _reader_done (self, input_id, n_reads, in_batch):
+        """Send the last batch of a reader and record its counters"""
+        in_batch.flush ()
+        if n_reads is not None:
+            self.input_reads[input_id] = n_reads
+        with self.in_q_batches.get_lock ():
+            self.in_q_batches.value += in_batch.n_batches
+
+    def _send_poison_pills (self, ps_list, q, n_pills):
+        """
+        Wait for all the processes of ps_list to exit, then put n_pills poison pills in q. Items of a multiprocessing queue are only
+        ordered per process and a process only exits once its items are flushed, so the pills cannot overtake the items of another process
+        """
+        for ps in ps_list:
+            ps.join ()
+        # No consumer is left after a failure and the pills would block in the full queue
+        if any (ps.exitcode != 0 for ps in ps_list):
+            return
+        for i in range (n_pills):
+            q.put (None)
 
     def _process_read (self, in_q, out_q, error_q, pid):
         """
         Multi-threaded workers
         """
         self.log.debug("\t[process_read {}] Starting processing reads".format(pid))
+        # Do not wait for memory here since the reads from in_q are released before, otherwise it could deadlock
+        out_batch = QueueBatcher (q=out_q, max_items=self.batch_reads, max_bytes=self.batch_bytes, size_fun=self._item_size, budget=self.memory_budget, wait_budget=False,
+            metrics=self.metrics, stage="worker")
         try:
             # Collapse event at kmer level
-            for read_id, ref_id, read_l in iter(in_q.get, None):
-
-                # Write read header to str
-                read_str = "#{}\t{}\n".format(read_id, ref_id)
-                read_str+= "{}\n".format (self._make_ouput_header(event_d=read_l[0]))
-
-                # Init values for first kmer
-                kmer_d = self._init_kmer_dict(event_d=read_l[0])
-
-                # Init read dictionary
-                read_d = OrderedDict ()
-                read_d["read_id"] = read_id
-                read_d["ref_id"] = ref_id
-                read_d["dwell_time"] = 0.0
-                read_d["kmers"] = 0
-                read_d["NNNNN_kmers"] = 0
-                read_d["mismatch_kmers"] = 0
-                read_d["missing_kmers"] = 0
-                read_d["ref_start"] = kmer_d["ref_pos"]
-
-                # Iterate over the rest of the lines
-                for event_d in read_l [1:]:
-                    pos_offset = event_d["ref_pos"]-kmer_d["ref_pos"]
-
-                    # Same position = update current kmer
-                    if pos_offset == 0:
-                        kmer_d = self._update_kmer_dict(kmer_d=kmer_d, event_d=event_d)
-
-                    # New position = write previous kmer and start new one
-                    else:
-                        # Update read counter
-                        read_d["dwell_time"] += kmer_d["dwell_time"]
-                        if kmer_d["NNNNN_dwell_time"]:
-                            read_d["NNNNN_kmers"] += 1
-                        if kmer_d ["mismatch_dwell_time"]:
-                            read_d["mismatch_kmers"] += 1
-                        if pos_offset >=2:
-                            read_d["missing_kmers"] += (pos_offset-1)
-                        read_d["kmers"] += 1
-                        # Converts previous kmer to str and init new kmer
-                        read_str += "{}\n".format(self._kmer_dict_to_str(kmer_d=kmer_d))
-                        kmer_d = self._init_kmer_dict(event_d=event_d)
-
-                # Last read_d update
-                read_d["dwell_time"] += kmer_d["dwell_time"]
-                if kmer_d ["NNNNN_dwell_time"]:
-                    read_d["NNNNN_kmers"] += 1
-                if kmer_d ["mismatch_dwell_time"]:
-                    read_d["mismatch_kmers"] += 1
-                if pos_offset >=2:
-                    read_d["missing_kmers"] += (pos_offset-1)
-                read_d["ref_end"] = kmer_d["ref_pos"]+1
-                read_d["kmers"] += 1
+            t_get = time()
+            for batch in iter(in_q.get, None):
+                t_start = time()
+                put_wait = out_batch.put_wait
+                if self.memory_budget:
+                    batch_bytes = sum (self._item_size(item) for item in batch)
+                for seq, read_id, ref_id, read_l, chunk in batch:
+                    read_d, read_data = self._collapse_read (read_id=read_id, ref_id=ref_id, read_l=read_l, chunk=chunk)
 
-                # Last kmer
-                read_str += "{}\n".format(self._kmer_dict_to_str(kmer_d=kmer_d))
+                    # Add the current read details to queue. Partial read chunks are counted with the last one
+                    out_batch.put((seq, read_d, read_data), reads=int (read_d.get ("last_chunk", True)))
 
-                # Add the current read details to queue
-                out_q.put((read_d, read_str))
+                if self.memory_budget:
+                    self.memory_budget.release (batch_bytes)
+                # The writer might be waiting for these reads to release reorder slots
+                if self.ordered:
+                    out_batch.flush()
+                if self.metrics:
+                    t_get = self._worker_metrics (batch, t_get, t_start, out_batch.put_wait-put_wait)
 
         # Manage exceptions and deal poison pills
         except Exception:
             error_q.put (NanopolishCompError(traceback.format_exc()))
         finally:
             self.log.debug("\t[process_read {}] Done".format(pid))
-            out_q.put(None)
+            self._worker_done (out_batch)
 
-    def _write_output (self, out_q, error_q):
+    def _process_block_shm (self, in_q, out_q, error_q, pid):
         """
-        Mono-threaded Writer
+        Multi-threaded workers parsing blocks of reads in place in the shared memory buffer. The slot is released as soon as the block is parsed
+        """
+        self.log.debug("\t[process_block_shm {}] Starting processing blocks".format(pid))
+        out_batch = QueueBatcher (q=out_q, max_items=self.batch_reads, max_bytes=self.batch_bytes, size_fun=self._item_size, budget=self.memory_budget, wait_budget=False,
+            metrics=self.metrics, stage="worker")
+        try:
+            t_get = time()
+            for batch in iter(in_q.get, None):
+                t_start = time()
+                put_wait = out_batch.put_wait
+                n_events = batch_reads = 0
+                if self.memory_budget:
+                    batch_bytes = sum (self._shm_item_size(item) for item in batch)
+                for input_id, block_parser, slot, length, data in batch:
+                    if slot is not None:
+                        data = self.shm.buf[slot*self.shm_slot_size:slot*self.shm_slot_size+length]
+                    # The last line of the input might not end with a newline
+                    if data[-1] != 10:
+                        data = bytes(data)+b"\n"
+                    read_list = block_parser._parse_block (data, last_block=True, skip_reads=self.done_reads)[0]
+                    del data
+                    if slot is not None:
+                        self.shm_slots.put (slot)
+
+                    # Collapse event at kmer level
+                    n_reads = 0
+                    for read_id, ref_id, read_a in read_list:
+                        read_d, read_data = self._collapse_read (read_id=read_id, ref_id=ref_id, read_l=read_a)
+                        out_batch.put((0, read_d, read_data))
+                        n_reads += 1
+                        n_events += len(read_a["events"])
+                    with self.input_reads.get_lock ():
+                        self.input_reads[input_id] += n_reads
+                    batch_reads += n_reads
+                if self.memory_budget:
+                    self.memory_budget.release (batch_bytes)
+                if self.metrics:
+                    # Reads of the blocks are only delimited here and counted for the reader
+                    self.metrics.add (reader_reads=batch_reads)
+                    t_get = self._worker_metrics (n_events, t_get, t_start, out_batch.put_wait-put_wait)
+
+        # Manage exceptions and deal poison pills
+        except Exception:
+            error_q.put (NanopolishCompError(traceback.format_exc()))
+        finally:
+            self.log.debug("\t[process_block_shm {}] Done".format(pid))
+            self._worker_done (out_batch)
+
+    def _worker_metrics (self, batch, t_get, t_start, put_wait):
+        """
+        Record the counters of a worker for a batch received at t_start after waiting since t_get. batch is the list of in_q
+        items or directly the number of events. Time blocked on out_q is not counted as busy. Return the time of the next get
+        """
+        t_end = time()
+        n_events = batch if isinstance (batch, int) else sum (self._item_events (item[3]) for item in batch)
+        self.metrics.add (worker_events=n_events, worker_get_wait=t_start-t_get, worker_busy=t_end-t_start-put_wait)
+        return t_end
+
+    def _worker_done (self, out_batch):
+        """Send the last batch of a worker"""
+        out_batch.flush ()
+
+    def _process_shard (self, shard_start, shard_end, out_q, error_q, pid):
+        """
+        Multi-threaded workers reading and collapsing a byte range of the input file
+        """
+        self.log.debug("\t[process_shard {}] Starting processing bytes {} to {}".format(pid, shard_start, shard_end))
+        out_batch = QueueBatcher (q=out_q, max_items=self.batch_reads, max_bytes=self.batch_bytes, size_fun=self._item_size, budget=self.memory_budget,
+            metrics=self.metrics, stage="worker")
+        try:
+            with open (self.input_fn_list[0], "rb") as fp:
+
+                # Get header line and extract corresponding index
+                input_header = fp.readline().decode().rstrip().split("\t")
+                idx = self._get_field_idx (input_header)
+                block_parser = BlockParser (idx=idx, n_fields=len(input_header))
+
+                # Collapse event at kmer level
+                fp.seek (shard_start)
+                t_start = time()
+                for read_id, ref_id, read_a in block_parser (fp, max_bytes=shard_end-shard_start, skip_reads=self.done_reads):
+                    put_wait = out_batch.put_wait
+                    read_d, read_data = self._collapse_read (read_id=read_id, ref_id=ref_id, read_l=read_a)
+                    out_batch.put((0, read_d, read_data))
+                    # Parsing the shard is part of the work of the worker
+                    if self.metrics:
+                        t_start = self._worker_metrics (len(read_a["events"]), t_start, t_start, out_batch.put_wait-put_wait)
+
+        # Manage exceptions and deal poison pills
+        except Exception:
+            error_q.put (NanopolishCompError(traceback.format_exc()))
+        finally:
+            self.log.debug("\t[process_shard {}] Done".format(pid))
+            self._worker_done (out_batch)
+
+    def _init_writer (self, outdir, outprefix, output_format="tsv", compress_output=False, compress_threads=4, samples_file=False,
+        samples_format="float32", ordered=False, writers=1, n_inputs=0):
+        """
+        Set the options and the shared counters used by the writers and the log file. Resume, memory budget, metrics and auto tuning
+        are deactivated and can be set afterwards. The reads parsed from each of the n_inputs inputs are reported in the log file
+        """
+        self.outdir = outdir
+        self.outprefix = outprefix
+        self.output_format = output_format
+        self.compress_output = compress_output
+        self.compress_threads = compress_threads
+        self.samples_file = samples_file
+        self.samples_format = samples_format
+        self.ordered = ordered
+        self.n_writers = writers
+        self.done_reads = set ()
+        self.resume_offset = None
+        self.memory_budget = None
+        self.metrics = None
+        self.auto_d = None
+        self.in_q_batches = mp.Value ("L", 0)
+        self.input_reads = mp.Array ("L", n_inputs)
+        self.writer_reads = mp.Array ("L", writers)
+        self.writer_batches = mp.Array ("L", writers)
+
+    def _write_output (self, out_q, error_q, writer_id=None):
+        """
+        Mono-threaded Writer. With multiple writers, writer_id is the number of the shard written
         """
         self.log.debug("\t[write_output] Start rwriting output")
 
-        byte_offset = n_reads = 0
+        data_offset = n_reads = out_q_batches = 0
+        chunk_d = None
+        reorder_d = OrderedDict ()
+        next_seq = reorder_peak = 0
         t = time()
 
         try:
             # Open output files
-            data_fn = os.path.join(self.outdir, self.outprefix+"_eventalign_collapse.tsv")
-            idx_fn = os.path.join(self.outdir, self.outprefix+"_eventalign_collapse.tsv.idx")
-            with open (data_fn, "w") as data_fp,\
-                 open (idx_fn, "w") as idx_fp,\
+            data_fn = self._output_fn (self._data_ext(), writer_id)
+            idx_fn = data_fn+".idx"
+            if self.output_format == "npy":
+                data_fp = NpyWriter (data_fn, default_dtype=[(field, dtype) for field, dtype in list(self.NPY_DTYPE.items())[:6]])
+                offset_fields = "row_offset\trow_len"
+            elif self.compress_output:
+                data_fp = BGZFWriter (data_fn, threads=self.compress_threads)
+                offset_fields = "virtual_offset\tbyte_len"
+                self.idx_pending = deque ()
+            elif self.resume_offset is not None:
+                data_fp = open (data_fn, "a")
+                data_offset = self.resume_offset
+                offset_fields = "byte_offset\tbyte_len"
+            else:
+                data_fp = open (data_fn, "w")
+                offset_fields = "byte_offset\tbyte_len"
+            # Binary samples file
+            self.samples_fp = None
+            self.samples_offset = 0
+            # Bytes written to the data, samples and index files, before compression
+            self.written_bytes = 0
+            if self.samples_file:
+                samples_fn = self._output_fn ("samples.npy", writer_id)
+                self.samples_fp = NpyWriter (samples_fn, default_dtype=np.float32 if self.samples_format == "float32" else np.int16)
+                offset_fields = "samples_offset\tsamples_len\t"+offset_fields
+            with data_fp,\
+                 open (idx_fn, "a" if self.resume_offset is not None else "w") as idx_fp,\
                  tqdm (unit=" reads", mininterval=0.1, smoothing=0.1, disable=self.log.level>=30) as pbar:
 
-                idx_fp.write ("ref_id\tref_start\tref_end\tread_id\tkmers\tdwell_time\tNNNNN_kmers\tmismatch_kmers\tmissing_kmers\tbyte_offset\tbyte_len\n")
+                if self.resume_offset is None:
+                    idx_fp.write (self.IDX_HEADER+"{}\n".format(offset_fields))
 
                 n_reads = 0
-                for _ in range (self.threads):
-                    for (read_d, read_str) in iter (out_q.get, None):
-                        byte_len = len(read_str)
-
-                        data_fp.write (read_str)
-                        idx_fp.write ("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format (
-                            read_d["ref_id"],
-                            read_d["ref_start"],
-                            read_d["ref_end"],
-                            read_d["read_id"],
-                            read_d["kmers"],
-                            read_d["dwell_time"],
-                            read_d["NNNNN_kmers"],
-                            read_d["mismatch_kmers"],
-                            read_d["missing_kmers"],
-                            byte_offset,
-                            byte_len-1))
-
-                        byte_offset += byte_len
-                        n_reads += 1
-                        if self.log.level<30:
-                            pbar.update(1)
+                t_get = time()
+                for batch in iter (out_q.get, None):
+                    t_start = time()
+                    out_q_batches += 1
+                    if self.memory_budget:
+                        batch_bytes = sum (self._item_size(item) for item in batch)
+                    written_bytes = self.written_bytes
+                    batch_reads = 0
+                    for (seq, read_d, read_data) in batch:
+                        # Partial read chunks are counted with the last one
+                        if read_d.get ("last_chunk", True):
+                            batch_reads += 1
+                        # Hold reads until all the previous ones are written
+                        if self.ordered:
+                            reorder_d[seq] = (read_d, read_data)
+                            reorder_peak = max (reorder_peak, len(reorder_d))
+                            while next_seq in reorder_d:
+                                read_d, read_data = reorder_d.pop (next_seq)
+                                if "chunk_idx" in read_d:
+                                    data_offset, chunk_d = self._write_chunk (data_fp, idx_fp, read_d, read_data, data_offset, chunk_d)
+                                else:
+                                    data_offset = self._write_read (data_fp, idx_fp, read_d, read_data, data_offset)
+                                self.reorder_slots.release ()
+                                next_seq += 1
+                        else:
+                            data_offset = self._write_read (data_fp, idx_fp, read_d, read_data, data_offset)
+                    n_reads += batch_reads
+                    if self.memory_budget:
+                        self.memory_budget.release (batch_bytes)
+                    if self.metrics:
+                        self.metrics.add (writer_reads=batch_reads, writer_bytes=self.written_bytes-written_bytes, writer_get_wait=t_start-t_get)
+                        t_get = time()
+                    if self.log.level<30:
+                        pbar.update(batch_reads)
+
+                if reorder_d or chunk_d:
+                    raise NanopolishCompError ("{} reads could not be written in input order".format(len(reorder_d)+bool(chunk_d)))
 
                 # Flag last line
-                data_fp.write ("#\n")
+                if self.output_format == "tsv":
+                    data_fp.write ("#\n")
 
-            # Open log file
-            log_fn = os.path.join(self.outdir, self.outprefix+"_eventalign_collapse.log")
-            with open (log_fn, "w") as log_fp:
-                log_fp.write (str(self))
+                # Write the last index lines once all compressed blocks are written
+                if self.compress_output:
+                    data_fp.close ()
+                    self._flush_idx (idx_fp, data_fp)
+                if self.samples_fp:
+                    self.samples_fp.close ()
+
+            # The log file of multiple writers is written after merging their counters
+            if writer_id is None:
+                self._write_log (n_reads, out_q_batches, reorder_peak, t)
+            else:
+                self.writer_reads[writer_id] = n_reads
+                self.writer_batches[writer_id] = out_q_batches
 
         # Manage exceptions and deal poison pills
         except Exception:
             error_q.put (NanopolishCompError(traceback.format_exc()))
         finally:
             self.log.debug("\t[write_output] Done")
-            self.log.warning ("[Eventalign_collapse] total reads: {} [{} reads/s]\n".format(n_reads, round (n_reads/(time()-t), 2)))
+            if writer_id is None:
+                self.log.warning ("[Eventalign_collapse] total reads: {} [{} reads/s]\n".format(n_reads, round (n_reads/(time()-t), 2)))
             error_q.put(None)
 
+    def _write_log (self, n_reads, out_q_batches, reorder_peak, t):
+        """Write the options and the run counters to the log file"""
+        log_fn = self._output_fn ("log")
+        with open (log_fn, "w") as log_fp:
+            log_fp.write (str(self))
+
+            # Report observed batch sizes
+            batch_d = OrderedDict ()
+            if self.in_q_batches.value:
+                batch_d["in_q_batches"] = self.in_q_batches.value
+                batch_d["in_q_mean_batch_reads"] = round (n_reads/self.in_q_batches.value, 2)
+            batch_d["out_q_batches"] = out_q_batches
+            batch_d["out_q_mean_batch_reads"] = round (n_reads/out_q_batches, 2) if out_q_batches else 0
+            log_fp.write ("\n\nQueue batches:\n")
+            log_fp.write (dict_to_str(batch_d))
+
+            # Report the reads parsed from each input
+            if len (self.input_reads):
+                input_d = OrderedDict ()
+                for fn, input_reads in zip (self.input_fn_list, self.input_reads):
+                    input_d["stdin" if fn == 0 else fn] = "{} reads".format(input_reads)
+                log_fp.write ("\n\nInputs:\n")
+                log_fp.write (dict_to_str(input_d))
+
+            # Report the reads written by each writer
+            if self.n_writers > 1:
+                writer_d = OrderedDict ()
+                for writer_id, writer_reads in enumerate (self.writer_reads):
+                    writer_d[os.path.basename(self._output_fn (self._data_ext(), writer_id))] = "{} reads".format(writer_reads)
+                log_fp.write ("\n\nWriters:\n")
+                log_fp.write (dict_to_str(writer_d))
+
+            # Report the pipeline metrics of the whole run
+            if self.metrics:
+                metrics_d = self.metrics.summary (elapsed=time()-t)
+                self.log.info ("Pipeline metrics: worker busy {:.2%}, workers waiting for input {:.2%}, workers blocked on output {:.2%}".format(
+                    metrics_d["worker_busy_fraction"], metrics_d["worker_get_wait_fraction"], metrics_d["worker_put_wait_fraction"]))
+                log_fp.write ("\n\nPipeline metrics:\n")
+                log_fp.write (dict_to_str(metrics_d))
+
+            # Report the measured costs and the configuration chosen by auto
+            if self.auto_d:
+                log_fp.write ("\n\nAuto tuning:\n")
+                log_fp.write (dict_to_str(self.auto_d))
+
+            # Report reads written by the previous run
+            if self.resume_offset is not None:
+                log_fp.write ("\n\nResume:\n")
+                log_fp.write ("skipped_reads: {}\n".format(len(self.done_reads)))
+                log_fp.write ("resume_byte_offset: {}".format(self.resume_offset))
+
+            # Report memory usage
+            if self.memory_budget:
+                self.log.info ("Peak estimated memory in flight: {:,} bytes".format(self.memory_budget.peak.value))
+                log_fp.write ("\n\nMemory in flight:\n")
+                log_fp.write ("max_memory_bytes: {}\n".format(self.memory_budget.max_bytes))
+                log_fp.write ("peak_memory_bytes: {}".format(self.memory_budget.peak.value))
+
+            # Report cost of ordered output = time during which the reader was blocked by the reorder buffer
+            if self.ordered:
+                order_d = OrderedDict ()
+                order_d["reorder_buffer_peak_reads"] = reorder_peak
+                order_d["reader_wait_seconds"] = round (self.reorder_wait.value, 2)
+                order_d["reader_wait_fraction"] = round (self.reorder_wait.value/(time()-t), 4)
+                self.log.info ("Ordered output: reader waited {} s for the reorder buffer ({:.2%} of run time), peak buffer {} reads".format(
+                    order_d["reader_wait_seconds"], order_d["reader_wait_fraction"], reorder_peak))
+                log_fp.write ("\n\nOrdered output:\n")
+                log_fp.write (dict_to_str(order_d))
+
+    def _merge_writers (self, t):
+        """
+        Write the unified index of the shards written by multiple writers, with the shard number of each read, and the manifest
+        listing the shard files. Then write the log file with the counters of all writers
+        """
+        data_ext = self._data_ext ()
+        with open (self._output_fn (data_ext+".idx"), "w") as idx_fp, open (self._output_fn (data_ext+".manifest"), "w") as manifest_fp:
+            manifest_fp.write ("shard\tdata_fn\tsamples_fn\n")
+            for writer_id in range (self.n_writers):
+                data_fn = self._output_fn (data_ext, writer_id)
+                samples_fn = os.path.basename (self._output_fn ("samples.npy", writer_id)) if self.samples_file else ""
+                manifest_fp.write ("{}\t{}\t{}\n".format(writer_id, os.path.basename(data_fn), samples_fn))
+                with open (data_fn+".idx") as shard_idx_fp:
+                    header = shard_idx_fp.readline()
+                    if writer_id == 0:
+                        idx_fp.write (header.rstrip("\n")+"\tshard\n")
+                    for line in shard_idx_fp:
+                        idx_fp.write ("{}\t{}\n".format(line.rstrip("\n"), writer_id))
+
+        n_reads = sum (self.writer_reads)
+        self._write_log (n_reads, sum (self.writer_batches), 0, t)
+        self.log.warning ("[Eventalign_collapse] total reads: {} [{} reads/s]\n".format(n_reads, round (n_reads/(time()-t), 2)))
+
+    def _sample_metrics (self, in_q, out_q, interval, stop, t):
+        """
+        Thread of the main process sampling the pipeline counters and queue depths every interval seconds until stop is set.
+        Each sample is written as a JSON line with the rates over the last interval
+        """
+        metrics_fn = self._output_fn ("metrics.jsonl")
+        with open (metrics_fn, "w") as metrics_fp:
+            prev_d = self.metrics.snapshot ()
+            prev_t = t
+            while True:
+                done = stop.wait (interval)
+                cur_t = time()
+                in_q_depth, out_q_depth = self.metrics.sample_queues (in_q, out_q)
+                cur_d = self.metrics.snapshot ()
+                dt = max (cur_t-prev_t, 1e-9)
+                sample_d = OrderedDict ()
+                sample_d["elapsed_s"] = round (cur_t-t, 3)
+                sample_d["reader_reads"] = int(cur_d["reader_reads"])
+                sample_d["reader_reads_per_s"] = round ((cur_d["reader_reads"]-prev_d["reader_reads"])/dt, 2)
+                sample_d["reader_events"] = int(cur_d["reader_events"])
+                sample_d["reader_events_per_s"] = round ((cur_d["reader_events"]-prev_d["reader_events"])/dt, 2)
+                sample_d["reader_put_wait_s"] = round (cur_d["reader_put_wait"], 3)
+                sample_d["in_q_depth"] = in_q_depth
+                sample_d["worker_reads"] = int(cur_d["worker_reads"])
+                sample_d["worker_reads_per_s"] = round ((cur_d["worker_reads"]-prev_d["worker_reads"])/dt, 2)
+                sample_d["worker_events_per_s"] = round ((cur_d["worker_events"]-prev_d["worker_events"])/dt, 2)
+                sample_d["worker_busy_fraction"] = round ((cur_d["worker_busy"]-prev_d["worker_busy"])/(dt*self.threads), 4)
+                sample_d["worker_get_wait_s"] = round (cur_d["worker_get_wait"], 3)
+                sample_d["worker_put_wait_s"] = round (cur_d["worker_put_wait"], 3)
+                sample_d["out_q_depth"] = out_q_depth
+                sample_d["writer_reads"] = int(cur_d["writer_reads"])
+                sample_d["writer_reads_per_s"] = round ((cur_d["writer_reads"]-prev_d["writer_reads"])/dt, 2)
+                sample_d["writer_bytes"] = int(cur_d["writer_bytes"])
+                sample_d["writer_bytes_per_s"] = round ((cur_d["writer_bytes"]-prev_d["writer_bytes"])/dt, 2)
+                sample_d["writer_get_wait_s"] = round (cur_d["writer_get_wait"], 3)
+                metrics_fp.write (json.dumps (sample_d)+"\n")
+                metrics_fp.flush ()
+                prev_d, prev_t = cur_d, cur_t
+                if done:
+                    break
+
     #~~~~~~~~~~~~~~~~~~~~~~~~~~HELPER PRIVATE METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~#
 
+    def _data_ext (self):
+        """Extension of the data file for the selected output format"""
+        return self.output_format+".gz" if self.compress_output else self.output_format
+
+    def _output_fn (self, ext, writer_id=None):
+        """Path of an output file. Files written by each of multiple writers are numbered"""
+        shard = "" if writer_id is None else "{}.".format(writer_id)
+        return os.path.join (self.outdir, "{}_eventalign_collapse.{}{}".format(self.outprefix, shard, ext))
+
+    def _auto_tune (self, n_reads, max_threads, max_memory, vectorized_parser, shm_buffer):
+        """
+        Measure the costs per read of each stage on the first n_reads reads of the first input and set the number of workers,
+        the number of reads per batch and the queue size. Return an OrderedDict of the measured costs and chosen values
+        """
+        # Parse the sample with the parser used by the readers
+        read_list, parse_t = self._sample_reads (n_reads, vectorized_parser or shm_buffer)
+        if not read_list:
+            raise NanopolishCompError ("No reads found in input file {}".format(self.input_fn_list[0]))
+
+        # Transfer costs = pickling by the sending process and unpickling by the receiving one. Write cost = data and samples
+        in_dumps_t = in_loads_t = out_dumps_t = out_loads_t = collapse_t = write_t = 0
+        in_bytes = out_bytes = 0
+        with open (os.devnull, "w") as null_fp, open (os.devnull, "wb") as null_bfp:
+            for read_id, ref_id, read_l in read_list:
+                t = time()
+                pkl = pickle.dumps ((0, read_id, ref_id, read_l, None), protocol=pickle.HIGHEST_PROTOCOL)
+                in_dumps_t += time()-t
+                in_bytes += len(pkl)
+                t = time()
+                pickle.loads (pkl)
+                in_loads_t += time()-t
+
+                t = time()
+                read_d, read_data = self._collapse_read (read_id=read_id, ref_id=ref_id, read_l=read_l)
+                collapse_t += time()-t
+
+                t = time()
+                pkl = pickle.dumps ((0, read_d, read_data), protocol=pickle.HIGHEST_PROTOCOL)
+                out_dumps_t += time()-t
+                out_bytes += len(pkl)
+                t = time()
+                pickle.loads (pkl)
+                out_loads_t += time()-t
+
+                t = time()
+                if isinstance (read_data, str):
+                    null_fp.write (read_data)
+                else:
+                    null_bfp.write (read_data.tobytes())
+                if "samples" in read_d:
+                    null_bfp.write (read_d["samples"].tobytes())
+                write_t += time()-t
+
+        # Per read cost of each stage. Sharded input and shared memory blocks are parsed by the workers
+        n = len(read_list)
+        n_readers = 0 if self.shard_input else len(self.input_fn_list)
+        if self.shard_input or shm_buffer:
+            reader_cost = 0
+            worker_cost = (parse_t+collapse_t+out_dumps_t)/n
+        else:
+            reader_cost = (parse_t+in_dumps_t)/n
+            worker_cost = (in_loads_t+collapse_t+out_dumps_t)/n
+        writer_cost = (write_t+out_loads_t)/n
+
+        # Enough workers to keep up with the slowest of the readers and the writers, within the available threads
+        max_workers = max (max_threads-n_readers-self.n_writers, 1)
+        bound_rates = [n_stage/cost for n_stage, cost in ((n_readers, reader_cost), (self.n_writers, writer_cost)) if n_stage and cost]
+        if bound_rates:
+            workers = min (max (math.ceil (worker_cost*min (bound_rates)), 1), max_workers)
+        else:
+            workers = max_workers
+        self.threads = workers
+
+        # Batches carrying a few milliseconds of work, so that queue operations are amortized
+        self.batch_reads = min (max (math.ceil (0.005/max (worker_cost, 1e-9)), 1), 100)
+
+        # Queue sizes limited by the memory budget shared by in_q and out_q
+        memory = max_memory or available_memory ()
+        if memory and not max_memory:
+            memory //= 4
+        batch_size = self.batch_reads*max (in_bytes, out_bytes)/n
+        if memory:
+            self.queue_size = int (min (max (memory/(2*batch_size), 2*workers), 1000))
+
+        auto_d = OrderedDict ()
+        auto_d["sampled_reads"] = n
+        auto_d["parse_ms_per_read"] = round (1000*parse_t/n, 4)
+        auto_d["in_q_transfer_ms_per_read"] = round (1000*(in_dumps_t+in_loads_t)/n, 4)
+        auto_d["collapse_ms_per_read"] = round (1000*collapse_t/n, 4)
+        auto_d["out_q_transfer_ms_per_read"] = round (1000*(out_dumps_t+out_loads_t)/n, 4)
+        auto_d["write_ms_per_read"] = round (1000*write_t/n, 4)
+        auto_d["reader_ms_per_read"] = round (1000*reader_cost, 4)
+        auto_d["worker_ms_per_read"] = round (1000*worker_cost, 4)
+        auto_d["writer_ms_per_read"] = round (1000*writer_cost, 4)
+        auto_d["mean_read_bytes"] = int (max (in_bytes, out_bytes)/n)
+        auto_d["memory_budget_bytes"] = memory
+        auto_d["max_workers"] = max_workers
+        auto_d["workers"] = self.threads
+        auto_d["batch_reads"] = self.batch_reads
+        auto_d["queue_size"] = self.queue_size
+        for field, val in auto_d.items():
+            self.log.debug ("\t{}: {}".format(field, val))
+        return auto_d
+
+    def _sample_reads (self, n_reads, vectorized_parser):
+        """Parse the first n_reads reads of the first input. Return the list of (read_id, ref_id, read_l) and the parsing time"""
+        read_list = []
+        if vectorized_parser:
+            with open_input (self.input_fn_list[0], "rb", threads=self.decompress_threads) as fp:
+                input_header = fp.readline().decode().rstrip().split("\t")
+                block_parser = BlockParser (idx=self._get_field_idx (input_header), n_fields=len(input_header))
+                # Grow the sampled block until it contains enough complete reads, and only time the last parsing
+                data = b""
+                while True:
+                    block = fp.read (max (len(data), 1024*1024))
+                    data += block
+                    last_nl = data.rfind (b"\n")
+                    if last_nl == -1:
+                        if not block:
+                            break
+                        continue
+                    t = time()
+                    read_list, _ = block_parser._parse_block (data[:last_nl+1], last_block=not block)
+                    parse_t = time()-t
+                    if len(read_list) >= n_reads or not block:
+                        break
+            if not read_list:
+                return [], 0
+            # Parsing cost of the whole block is shared by all the reads it contains
+            parse_t = parse_t*min (n_reads, len(read_list))/len(read_list)
+            return read_list[:n_reads], parse_t
+
+        with open_input (self.input_fn_list[0], threads=self.decompress_threads) as fp:
+            idx = self._get_field_idx (fp.readline().rstrip().split("\t"))
+            t = time()
+            read_l = []
+            cur_ids = None
+            for line in fp:
+                event_l = line.rstrip().split("\t")
+                ids = (event_l[idx["read_id"]], event_l[idx["ref_id"]])
+                if ids != cur_ids and read_l:
+                    read_list.append (cur_ids+(read_l,))
+                    read_l = []
+                    if len(read_list) == n_reads:
+                        break
+                cur_ids = ids
+                read_l.append (self._event_list_to_dict (event_l, idx))
+            else:
+                if read_l:
+                    read_list.append (cur_ids+(read_l,))
+            return read_list, time()-t
+
+    def _init_resume (self):
+        """
+        Read the index of a previous run and truncate the partial records at the end of the index and data files.
+        Return the set of (read_id, ref_id) already written and the data offset to append new reads
+        """
+        data_fn = os.path.join(self.outdir, self.outprefix+"_eventalign_collapse.tsv")
+        idx_fn = data_fn+".idx"
+        done_reads = set ()
+        if not os.path.isfile (data_fn) or not os.path.isfile (idx_fn):
+            self.log.info ("\tNo previous output found. Starting from the beginning")
+            return done_reads, None
+
+        # Only index lines with a final newline and with a record fully written in the data file are kept, since the
+        # index and data files are not flushed together. Records are in the same order in both files
+        data_size = os.path.getsize (data_fn)
+        with open (idx_fn, "rb+") as fp:
+            header = fp.readline().decode()
+            if not header.startswith (self.IDX_HEADER) or not header.endswith ("byte_offset\tbyte_len\n"):
+                raise NanopolishCompError ("Cannot resume from index file {} with a different format".format(idx_fn))
+            idx_end = fp.tell()
+            data_offset = 0
+            for line in fp:
+                if not line.endswith (b"\n"):
+                    break
+                field_l = line.decode().split("\t")
+                read_end = int(field_l[-2])+int(field_l[-1])+1
+                if read_end > data_size:
+                    break
+                idx_end += len(line)
+                done_reads.add ((field_l[3], field_l[0]))
+                data_offset = max (data_offset, read_end)
+            fp.truncate (idx_end)
+
+        with open (data_fn, "rb+") as fp:
+            fp.truncate (data_offset)
+        return done_reads, data_offset
+
+    def _readinto (self, fp, view):
+        """Fill a memoryview from a binary file object. Return the number of bytes read, lower than the view size only at the end of the input"""
+        n = 0
+        while n < len(view):
+            n_bytes = fp.readinto (view[n:])
+            if not n_bytes:
+                break
+            n += n_bytes
+        return n
+
+    def _last_read_start (self, buf, block_parser):
+        """
+        Return the byte offset of the first line of the last read in a buffer of lines, which might continue after the buffer.
+        The line is found by binary search on the line ids. 0 if the buffer contains a single read
+        """
+        line_end = np.flatnonzero (buf == 10)
+        if len(line_end) < 2:
+            return 0
+        line_start = np.concatenate (([0], line_end[:-1]+1))
+        line_ids = lambda i: block_parser._line_ids (buf[line_start[i]:line_end[i]].tobytes())
+        last_ids = line_ids (len(line_end)-1)
+        lo, hi = 0, len(line_end)-1
+        while lo < hi:
+            mid = (lo+hi)//2
+            if line_ids (mid) == last_ids:
+                hi = mid
+            else:
+                lo = mid+1
+        return int(line_start[lo])
+
+    def _write_read (self, data_fp, idx_fp, read_d, read_data, data_offset):
+        """Write a read to the data file and the corresponding index line. Return the offset of the next read.
+        Offsets are in bytes for tsv output (excluding the last newline for the length) or in rows for npy output"""
+        data_len = len(read_data)
+        idx_len = data_len-1 if self.output_format == "tsv" else data_len
+
+        data_fp.write (read_data)
+        self.written_bytes += read_data.nbytes if self.output_format == "npy" else len(read_data)
+        if self.samples_fp:
+            self._write_samples (read_d)
+        self._write_idx (idx_fp, data_fp, read_d, data_offset, idx_len)
+        return data_offset+data_len
+
+    def _write_chunk (self, data_fp, idx_fp, read_d, read_data, data_offset, chunk_d):
+        """
+        Write a chunk of a read split by the reader and merge its counters with the previous chunks in chunk_d.
+        The index line is written with the read totals after the last chunk. Return the offset of the next chunk and chunk_d
+        """
+        data_fp.write (read_data)
+        self.written_bytes += read_data.nbytes if self.output_format == "npy" else len(read_data)
+        if self.samples_fp:
+            self._write_samples (read_d)
+        kmer_dwell_time = read_d.pop ("kmer_dwell_time")
+
+        # Read dwell time is accumulated kmer by kmer over all chunks to get the same value as for an unsplit read
+        if read_d["chunk_idx"] == 0:
+            chunk_d = read_d
+            chunk_d["data_offset"] = data_offset
+            chunk_d["data_len"] = 0
+            chunk_d["dwell_time"] = float (np.cumsum (kmer_dwell_time)[-1])
+        else:
+            for field in ["kmers", "NNNNN_kmers", "mismatch_kmers", "missing_kmers", "samples_len"]:
+                if field in chunk_d:
+                    chunk_d[field] += read_d[field]
+            chunk_d["ref_end"] = read_d["ref_end"]
+            chunk_d["dwell_time"] = float (np.cumsum (np.concatenate (([chunk_d["dwell_time"]], kmer_dwell_time)))[-1])
+        chunk_d["data_len"] += len(read_data)
+
+        if not read_d["last_chunk"]:
+            return data_offset+len(read_data), chunk_d
+
+        idx_len = chunk_d["data_len"]-1 if self.output_format == "tsv" else chunk_d["data_len"]
+        self._write_idx (idx_fp, data_fp, chunk_d, chunk_d["data_offset"], idx_len)
+        return data_offset+len(read_data), None
+
+    def _write_samples (self, read_d):
+        """Append the encoded samples of a read to the binary samples file and replace them by their offset and length in read_d"""
+        samples = read_d.pop ("samples", None)
+        read_d["samples_offset"] = self.samples_offset
+        read_d["samples_len"] = 0
+        if samples is not None:
+            self.samples_fp.write (samples)
+            self.written_bytes += samples.nbytes
+            read_d["samples_len"] = len(samples)
+            self.samples_offset += len(samples)
+
+    def _write_idx (self, idx_fp, data_fp, read_d, data_offset, data_len):
+        """
+        Write the index line of a read. With compressed output, lines are held until the BGZF block where the read starts
+        is written, to replace the uncompressed offset by a virtual offset
+        """
+        idx_line = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t".format (
+            read_d["ref_id"],
+            read_d["ref_start"],
+            read_d["ref_end"],
+            read_d["read_id"],
+            read_d["kmers"],
+            read_d["dwell_time"],
+            read_d["NNNNN_kmers"],
+            read_d["mismatch_kmers"],
+            read_d["missing_kmers"])
+        if self.samples_fp:
+            idx_line += "{}\t{}\t".format(read_d["samples_offset"], read_d["samples_len"])
+        if not self.compress_output:
+            idx_line = "{}{}\t{}\n".format(idx_line, data_offset, data_len)
+            idx_fp.write (idx_line)
+            self.written_bytes += len(idx_line)
+        else:
+            self.idx_pending.append ((idx_line, data_offset, data_len))
+            self._flush_idx (idx_fp, data_fp)
+
+    def _flush_idx (self, idx_fp, data_fp):
+        """Write the pending index lines of compressed output for which the virtual offset is known"""
+        while self.idx_pending:
+            idx_line, data_offset, data_len = self.idx_pending[0]
+            virtual_offset = data_fp.virtual_offset (data_offset)
+            if virtual_offset is None:
+                break
+            idx_line = "{}{}\t{}\n".format(idx_line, virtual_offset, data_len)
+            idx_fp.write (idx_line)
+            self.written_bytes += len(idx_line)
+            self.idx_pending.popleft ()
+
+    def _acquire_reorder_slot (self, in_batch):
+        """Wait for the writer to release a slot of the reorder buffer. The pending batch is sent first to avoid deadlocks"""
+        if not self.reorder_slots.acquire (block=False):
+            in_batch.flush ()
+            t = time()
+            self.reorder_slots.acquire ()
+            self.reorder_wait.value += time()-t
+
+    def _collapse_read_list (self, read_id, ref_id, read_l):
+        """Collapse a list of event dict at kmer level and return the read summary dict and the read str"""
+        # Write read header to str
+        read_str = "#{}\t{}\n".format(read_id, ref_id)
+        read_str+= "{}\n".format (self._make_ouput_header(event_d=read_l[0]))
+
+        # Init values for first kmer
+        pos_offset = 0
+        kmer_d = self._init_kmer_dict(event_d=read_l[0])
+
+        # Init read dictionary
+        read_d = OrderedDict ()
+        read_d["read_id"] = read_id
+        read_d["ref_id"] = ref_id
+        read_d["dwell_time"] = 0.0
+        read_d["kmers"] = 0
+        read_d["NNNNN_kmers"] = 0
+        read_d["mismatch_kmers"] = 0
+        read_d["missing_kmers"] = 0
+        read_d["ref_start"] = kmer_d["ref_pos"]
+
+        # Iterate over the rest of the lines
+        for event_d in read_l [1:]:
+            pos_offset = event_d["ref_pos"]-kmer_d["ref_pos"]
+
+            # Same position = update current kmer
+            if pos_offset == 0:
+                kmer_d = self._update_kmer_dict(kmer_d=kmer_d, event_d=event_d)
+
+            # New position = write previous kmer and start new one
+            else:
+                # Update read counter
+                read_d["dwell_time"] += kmer_d["dwell_time"]
+                if kmer_d["NNNNN_dwell_time"]:
+                    read_d["NNNNN_kmers"] += 1
+                if kmer_d ["mismatch_dwell_time"]:
+                    read_d["mismatch_kmers"] += 1
+                if pos_offset >=2:
+                    read_d["missing_kmers"] += (pos_offset-1)
+                read_d["kmers"] += 1
+                # Converts previous kmer to str and init new kmer
+                read_str += "{}\n".format(self._kmer_dict_to_str(kmer_d=kmer_d))
+                kmer_d = self._init_kmer_dict(event_d=event_d)
+
+        # Last read_d update
+        read_d["dwell_time"] += kmer_d["dwell_time"]
+        if kmer_d ["NNNNN_dwell_time"]:
+            read_d["NNNNN_kmers"] += 1
+        if kmer_d ["mismatch_dwell_time"]:
+            read_d["mismatch_kmers"] += 1
+        if pos_offset >=2:
+            read_d["missing_kmers"] += (pos_offset-1)
+        read_d["ref_end"] = kmer_d["ref_pos"]+1
+        read_d["kmers"] += 1
+
+        # Last kmer
+        read_str += "{}\n".format(self._kmer_dict_to_str(kmer_d=kmer_d))
+
+        return read_d, read_str
+
+    def _collapse_read (self, read_id, ref_id, read_l, chunk=None):
+        """
+        Collapse a read from any parser and format it for the selected output format.
+        chunk = (chunk index, last chunk, last position of the previous chunk, number of samples in the previous chunks) for reads split
+        in chunks by the reader, else None
+        """
+        # Fast path for the line parser with text output. Reads with samples use the array stat engine
+        if self.output_format == "tsv" and not isinstance (read_l, dict) and not "sample_list" in read_l[0] and not chunk:
+            return self._collapse_read_list (read_id=read_id, ref_id=ref_id, read_l=read_l)
+
+        chunk_idx, last_chunk, prev_pos, prev_samples = chunk if chunk else (0, True, None, 0)
+        if not isinstance (read_l, dict):
+            read_l = self._event_list_to_array (read_l)
+        read_d, kmer_a = self._collapse_read_array (read_id=read_id, ref_id=ref_id, read_a=read_l, prev_pos=prev_pos, last_chunk=last_chunk, prev_samples=prev_samples)
+        if self.output_format == "tsv":
+            read_data = self._kmer_array_to_str (read_id=read_id, ref_id=ref_id, kmer_a=kmer_a, header=chunk_idx==0)
+        else:
+            read_data = self._kmer_array_to_records (kmer_a=kmer_a)
+
+        # Extra fields needed by the writer to merge chunks
+        if chunk:
+            read_d["chunk_idx"] = chunk_idx
+            read_d["last_chunk"] = last_chunk
+            read_d["kmer_dwell_time"] = kmer_a["dwell_time"]
+        return read_d, read_data
+
+    def _collapse_read_array (self, read_id, ref_id, read_a, prev_pos=None, last_chunk=True, prev_samples=0):
+        """
+        Collapse a structured array of events generated by BlockParser at kmer level and return the read summary dict and a dict of kmer arrays.
+        For chunks of a read, prev_pos is the position of the last event of the previous chunk, used to count missing kmers between chunks,
+        and prev_samples the number of samples of the previous chunks, used to offset the kmer samples in the binary samples file
+        """
+        # Unpack structured array fields
+        events = read_a["events"]
+        sample_text = read_a.get("sample_text")
+        read_a = OrderedDict ((field, events[field]) for field in events.dtype.names)
+
+        # Find kmer boundaries = position changes between consecutive events
+        ref_pos = read_a["ref_pos"]
+        n_events = len(ref_pos)
+        pos_offset = np.diff(ref_pos)
+        kmer_start = np.concatenate (([0], np.flatnonzero(pos_offset)+1))
+        kmer_end = np.append (kmer_start[1:], n_events)
+
+        # Sum event lengths per kmer
+        event_len = read_a["event_len"]
+        NNNNN_event = read_a["mod_kmer"] == b"NNNNN"
+        mismatch_event = ~NNNNN_event & (read_a["mod_kmer"] != read_a["ref_kmer"])
+        kmer_a = OrderedDict ()
+        kmer_a["ref_pos"] = ref_pos[kmer_start]
+        kmer_a["ref_kmer"] = read_a["ref_kmer"][kmer_start]
+        kmer_a["num_events"] = kmer_end-kmer_start
+        kmer_a["dwell_time"] = self._segment_sum (event_len, kmer_start, kmer_end)
+        kmer_a["NNNNN_dwell_time"] = self._segment_sum (np.where(NNNNN_event, event_len, 0.0), kmer_start, kmer_end)
+        kmer_a["mismatch_dwell_time"] = self._segment_sum (np.where(mismatch_event, event_len, 0.0), kmer_start, kmer_end)
+
+        # Facultative index fields
+        if "start_idx" in read_a:
+            kmer_a["start_idx"] = read_a["start_idx"][kmer_end-1]
+            kmer_a["end_idx"] = read_a["end_idx"][kmer_start]
+
+        # Facultative event level stat fields
+        if "event_mean" in read_a:
+            kmer_a.update (self._event_stats (read_a["event_len"], read_a["event_mean"], read_a["event_std"], kmer_start, kmer_end))
+
+        # Facultative samples fields. Parse samples text and count samples per event from commas
+        samples = None
+        if sample_text is not None:
+            to = np.concatenate (([0], np.cumsum(read_a["sample_text_len"])))
+            if not self.event_stats or self.samples_file:
+                samples = np.fromstring (sample_text[:-1], sep=",", dtype=np.float64).astype(np.float32)
+                so = np.searchsorted (np.flatnonzero(np.frombuffer(sample_text, dtype=np.uint8) == 44), to)
+                if len(samples) != so[-1]:
+                    raise NanopolishCompError ("Invalid samples field for read {}".format(read_id))
+            if not self.event_stats:
+                kmer_a.update (self._sample_stats (samples, so[kmer_start], so[kmer_end]))
+            if self.samples_file:
+                kmer_a["samples_offset"] = so[kmer_start]+prev_samples
+                kmer_a["samples_count"] = so[kmer_end]-so[kmer_start]
+            elif self.write_samples:
+                kmer_a["samples"] = [sample_text[to[ks]:to[ke]-1].decode() for ks, ke in zip (kmer_start, kmer_end)]
+
+        # Missing kmers are counted the same way as in _collapse_read_list, including the last event offset of the read
+        if prev_pos is not None:
+            pos_offset = np.diff (np.concatenate (([prev_pos], ref_pos)))
+        missing_kmers = int(np.sum(pos_offset[pos_offset>=2]-1))
+        if last_chunk and len(pos_offset) and pos_offset[-1] >= 2:
+            missing_kmers += int(pos_offset[-1]-1)
+
+        # Init read dictionary
+        read_d = OrderedDict ()
+        read_d["read_id"] = read_id
+        read_d["ref_id"] = ref_id
+        read_d["dwell_time"] = float(np.cumsum(kmer_a["dwell_time"])[-1])
+        read_d["kmers"] = len(kmer_start)
+        read_d["NNNNN_kmers"] = int(np.count_nonzero(kmer_a["NNNNN_dwell_time"]))
+        read_d["mismatch_kmers"] = int(np.count_nonzero(kmer_a["mismatch_dwell_time"]))
+        read_d["missing_kmers"] = missing_kmers
+        read_d["ref_start"] = int(ref_pos[0])
+        read_d["ref_end"] = int(ref_pos[-1])+1
+        if self.samples_file and samples is not None:
+            read_d["samples"] = encode_samples (samples, self.samples_format)
+
+        return read_d, kmer_a
+
+    def _sample_stats (self, samples, start, end):
+        """
+        Compute the statistical fields of all kmers of a read from the float32 samples buffer and the kmer boundaries.
+        Kmers with the same number of samples are gathered in a matrix and reduced together (row sums and partitions),
+        which gives the same values as np.mean, np.std and np.median called for each kmer
+        """
+        num_signals = end-start
+        stat_d = OrderedDict ()
+        for field in ["mean", "std", "median", "mad"]:
+            if field in self.stat_fields:
+                stat_d[field] = np.full (len(start), np.nan, dtype=np.float32)
+
+        for n in np.unique (num_signals) if stat_d else []:
+            if n == 0:
+                continue
+            kmers = np.flatnonzero (num_signals == n)
+            mat = samples[start[kmers,None]+np.arange(n)]
+
+            # Like np.mean and np.std, float32 sums are divided in float64 and cast back to float32
+            if "mean" in stat_d or "std" in stat_d:
+                mean = (mat.sum(axis=1)/n).astype(np.float32)
+                if "mean" in stat_d:
+                    stat_d["mean"][kmers] = mean
+                if "std" in stat_d:
+                    dev = mat-mean[:,None]
+                    stat_d["std"][kmers] = np.sqrt (((dev*dev).sum(axis=1)/n).astype(np.float32))
+
+            if "median" in stat_d or "mad" in stat_d:
+                median = self._row_median (mat)
+                if "median" in stat_d:
+                    stat_d["median"][kmers] = median
+                if "mad" in stat_d:
+                    stat_d["mad"][kmers] = self._row_median (np.abs(mat-median[:,None]))
+
+        if "num_signals" in self.stat_fields:
+            stat_d["num_signals"] = num_signals.astype(np.uint32)
+        return stat_d
+
+    def _event_stats (self, event_len, event_mean, event_std, start, end):
+        """
+        Pool the event level means and standard deviations of all kmers of a read, weighting events by length.
+        Events are added one at a time with the weighted incremental update of _update_kmer_dict, vectorized over kmers
+        """
+        sum_w = event_len[start].copy()
+        mean = event_mean[start].copy()
+        m2 = sum_w*event_std[start]*event_std[start]
+        seg_len = end-start
+        for i in range (1, seg_len.max()):
+            m = seg_len > i
+            w = event_len[start[m]+i]
+            s = event_std[start[m]+i]
+            new_sum_w = sum_w[m]+w
+            ratio = np.divide (w, new_sum_w, out=np.zeros(len(w)), where=new_sum_w!=0)
+            delta = event_mean[start[m]+i]-mean[m]
+            mean[m] += delta*ratio
+            m2[m] += w*s*s+delta*delta*sum_w[m]*ratio
+            sum_w[m] = new_sum_w
+
+        stat_d = OrderedDict ()
+        if "mean" in self.stat_fields:
+            stat_d["mean"] = mean
+        if "std" in self.stat_fields:
+            stat_d["std"] = np.sqrt (np.divide (m2, sum_w, out=np.full(len(m2), np.nan), where=sum_w!=0))
+        return stat_d
+
+    def _row_median (self, mat):
+        """Median of each row of a matrix using a partition around the middle columns"""
+        half = mat.shape[1]//2
+        if mat.shape[1]%2:
+            return np.partition (mat, half, axis=1)[:,half]
+        mat = np.partition (mat, [half-1, half], axis=1)
+        return (mat[:,half-1]+mat[:,half])/mat.dtype.type(2)
+
+    def _kmer_array_to_str (self, read_id, ref_id, kmer_a, header=True):
+        """Format a dict of kmer arrays as a text read block. Columns are converted to str in bulk and joined row wise"""
+        read_str = ""
+        if header:
+            read_str+= "#{}\t{}\n".format(read_id, ref_id)
+            read_str+= "{}\n".format ("\t".join(kmer_a.keys()))
+        col_list = []
+        for a in kmer_a.values():
+            if isinstance (a, np.ndarray):
+                # float32 values are written with the float64 repr like str.format does
+                if a.dtype == np.float32:
+                    a = a.astype(np.float64)
+                a = a.astype(str).tolist()
+            col_list.append (a)
+        read_str+= "\n".join (map ("\t".join, zip (*col_list)))+"\n"
+        return read_str
+
+    def _kmer_array_to_records (self, kmer_a):
+        """Convert a dict of kmer arrays to a structured array with the fixed dtype of the npy output format"""
+        dtype = [(field, self.NPY_DTYPE[field]) for field in kmer_a.keys()]
+        rec = np.empty (len(kmer_a["ref_pos"]), dtype=dtype)
+        for field, a in kmer_a.items():
+            rec[field] = kmer_to_code(a) if field == "ref_kmer" else a
+        return rec
+
+    def _event_list_to_array (self, read_l):
+        """Convert a list of event dict from the line parser to the read format generated by BlockParser"""
+        col_d = OrderedDict ()
+        col_d["ref_pos"] = np.array ([event_d["ref_pos"] for event_d in read_l], dtype=np.int64)
+        col_d["ref_kmer"] = np.array ([event_d["ref_kmer"].encode() for event_d in read_l])
+        col_d["mod_kmer"] = np.array ([event_d["mod_kmer"].encode() for event_d in read_l])
+        col_d["event_len"] = np.array ([event_d["event_len"] for event_d in read_l], dtype=np.float64)
+        if "event_mean" in read_l[0]:
+            col_d["event_mean"] = np.array ([event_d["event_mean"] for event_d in read_l], dtype=np.float64)
+            col_d["event_std"] = np.array ([event_d["event_std"] for event_d in read_l], dtype=np.float64)
+        if "start_idx" in read_l[0]:
+            col_d["start_idx"] = np.array ([event_d["start_idx"] for event_d in read_l], dtype=np.int64)
+            col_d["end_idx"] = np.array ([event_d["end_idx"] for event_d in read_l], dtype=np.int64)
+        read_a = OrderedDict ()
+        if "sample_list" in read_l[0]:
+            sample_text_list = [",".join(event_d["sample_list"])+"," for event_d in read_l]
+            col_d["sample_text_len"] = np.array ([len(i) for i in sample_text_list], dtype=np.int64)
+            read_a["sample_text"] = "".join(sample_text_list).encode()
+        events = np.empty (len(read_l), dtype=[(field, a.dtype) for field, a in col_d.items()])
+        for field, a in col_d.items():
+            events[field] = a
+        read_a["events"] = events
+        return read_a
+
+    def _segment_sum (self, a, start, end):
+        """Sum contiguous segments of an array in sequential order, to get the same values as python float accumulation"""
+        seg_sum = a[start].copy()
+        seg_len = end-start
+        for i in range (1, seg_len.max()):
+            m = seg_len > i
+            seg_sum[m] += a[start[m]+i]
+        return seg_sum
+
+    def _item_size (self, item):
+        """Estimate the memory size in bytes of a read item passed through in_q or out_q"""
+        # out_q item = (seq, read_d, read_str or read records)
+        if len(item) == 3:
+            samples_bytes = item[1]["samples"].nbytes if "samples" in item[1] else 0
+            return samples_bytes+(len(item[2]) if isinstance (item[2], str) else item[2].nbytes)
+        # in_q item from BlockParser = (seq, read_id, ref_id, dict of arrays, chunk)
+        read_l = item[3]
+        if isinstance (read_l, dict):
+            return read_l["events"].nbytes+len(read_l.get("sample_text", b""))
+        # in_q item from line parser = (seq, read_id, ref_id, list of event dict, chunk). Rough python object overhead
+        return sum (500+60*len(event_d.get("sample_list", ())) for event_d in read_l)
+
+    def _shm_item_size (self, item):
+        """Size in bytes of a block passed through in_q with shm_buffer. Blocks in the shared memory buffer are not counted as it is allocated beforehand"""
+        return 0 if item[4] is None else len(item[4])
+
+    def _item_events (self, read_l):
+        """Number of events of a read passed through in_q, from the block parser or from the line parser"""
+        return len(read_l["events"]) if isinstance (read_l, dict) else len(read_l)
+
+    def _get_shard_list (self):
+        """Split the input file in one byte range per worker. Split points are moved forward to the next read boundary"""
+        file_size = os.path.getsize (self.input_fn_list[0])
+        with open (self.input_fn_list[0], "rb") as fp:
+            input_header = fp.readline().decode().rstrip().split("\t")
+            block_parser = BlockParser (idx=self._get_field_idx (input_header), n_fields=len(input_header))
+            data_start = fp.tell()
+
+            shard_bounds = [data_start]
+            for i in range (1, self.threads):
+                # Move to the start of the next line
+                fp.seek (max (data_start+(file_size-data_start)*i//self.threads, shard_bounds[-1])-1)
+                fp.readline()
+                # Move to the first line of the next read
+                bound = fp.tell()
+                line = fp.readline()
+                if line:
+                    ids = block_parser._line_ids (line.rstrip(b"\n"))
+                    while line:
+                        bound = fp.tell()
+                        line = fp.readline()
+                        if not line or block_parser._line_ids (line.rstrip(b"\n")) != ids:
+                            break
+                shard_bounds.append (bound)
+            shard_bounds.append (file_size)
+
+        self.log.debug ("\tShards bounds: {}".format(shard_bounds))
+        return list (zip (shard_bounds[:-1], shard_bounds[1:]))
+
     def _get_field_idx (self, input_header):
         """"""
         # Get index of fields to fetch
@@ -365,8 +1752,14 @@ class Eventalign_collapse ():
         if "start_idx" in input_header and "end_idx" in input_header:
             idx["start_idx"] = input_header.index ("start_idx")
             idx["end_idx"] = input_header.index ("end_idx")
-        # Facultative field samples
-        if "samples" in input_header:
+        # Facultative event level stat fields
+        if self.event_stats:
+            if not "event_level_mean" in input_header or not "event_stdv" in input_header:
+                raise NanopolishCompError ("event_level_mean and event_stdv fields are required to compute event level stats")
+            idx["event_mean"] = input_header.index ("event_level_mean")
+            idx["event_std"] = input_header.index ("event_stdv")
+        # Facultative field samples. Only needed to write samples if stats are computed from events
+        if "samples" in input_header and (self.write_samples or not self.event_stats):
             idx["samples"] = input_header.index ("samples")
         return idx
 
@@ -377,6 +1770,9 @@ class Eventalign_collapse ():
         event_d["ref_kmer"] = event_l[idx["ref_kmer"]]
         event_d["mod_kmer"] = event_l[idx["mod_kmer"]]
         event_d["event_len"] = float(event_l[idx["event_len"]])
+        if "event_mean" in idx:
+            event_d["event_mean"] = float(event_l[idx["event_mean"]])
+            event_d["event_std"] = float(event_l[idx["event_std"]])
         if "start_idx" in idx:
             event_d["start_idx"] = int(event_l[idx["start_idx"]])
             event_d["end_idx"] = int(event_l[idx["end_idx"]])
@@ -400,8 +1796,10 @@ class Eventalign_collapse ():
         if "start_idx" in event_d:
             kmer_d["start_idx"] = event_d["start_idx"]
             kmer_d["end_idx"] = event_d["end_idx"]
-        if "sample_list" in event_d:
-            kmer_d["sample_list"] = event_d["sample_list"]
+        if "event_mean" in event_d:
+            kmer_d["sum_w"] = event_d["event_len"]
+            kmer_d["event_mean"] = event_d["event_mean"]
+            kmer_d["event_m2"] = event_d["event_len"]*event_d["event_std"]*event_d["event_std"]
         return kmer_d
 
     def _update_kmer_dict (self, kmer_d, event_d):
@@ -414,8 +1812,16 @@ class Eventalign_collapse ():
             kmer_d["mismatch_dwell_time"] += event_d["event_len"]
         if "start_idx" in event_d:
             kmer_d["start_idx"] = event_d["start_idx"]
-        if "sample_list" in event_d:
-            kmer_d["sample_list"].extend(event_d["sample_list"])
+        if "event_mean" in event_d:
+            # Weighted incremental update of the pooled mean and sum of squared deviations
+            w = event_d["event_len"]
+            s = event_d["event_std"]
+            new_sum_w = kmer_d["sum_w"]+w
+            ratio = w/new_sum_w if new_sum_w else 0.0
+            delta = event_d["event_mean"]-kmer_d["event_mean"]
+            kmer_d["event_mean"] += delta*ratio
+            kmer_d["event_m2"] += w*s*s+delta*delta*kmer_d["sum_w"]*ratio
+            kmer_d["sum_w"] = new_sum_w
         return kmer_d
 
     def _kmer_dict_to_str (self, kmer_d):
@@ -433,21 +1839,12 @@ class Eventalign_collapse ():
             s += "\t{}\t{}".format(
                 kmer_d["start_idx"],
                 kmer_d["end_idx"])
-        # Facultative samples fields
-        if "sample_list" in kmer_d:
-            sample_array = np.array (kmer_d["sample_list"], dtype=np.float32)
+        # Facultative event level stat fields
+        if "sum_w" in kmer_d:
             if "mean" in self.stat_fields:
-                s += "\t{}".format(np.mean (sample_array))
+                s += "\t{}".format(kmer_d["event_mean"])
             if "std" in self.stat_fields:
-                s += "\t{}".format(np.std (sample_array))
-            if "median" in self.stat_fields:
-                s += "\t{}".format(np.median (sample_array))
-            if "mad" in self.stat_fields:
-                s += "\t{}".format(np.median(np.abs(sample_array-np.median(sample_array))))
-            if "num_signals" in self.stat_fields:
-                s += "\t{}".format(len(sample_array))
-            if self.write_samples:
-                s += "\t{}".format(",".join(kmer_d["sample_list"]))
+                s += "\t{}".format(math.sqrt(kmer_d["event_m2"]/kmer_d["sum_w"]) if kmer_d["sum_w"] else float("nan"))
         return s
 
     def _make_ouput_header (self, event_d):
@@ -457,17 +1854,322 @@ class Eventalign_collapse ():
         # Write extra fields
         if "start_idx" in event_d:
             s += "\tstart_idx\tend_idx"
-        if "sample_list" in event_d:
-            if "mean" in self.stat_fields:
-                s += "\tmean"
-            if "std" in self.stat_fields:
-                s += "\tstd"
-            if "median" in self.stat_fields:
-                s += "\tmedian"
-            if "mad" in self.stat_fields:
-                s += "\tmad"
-            if "num_signals" in self.stat_fields:
-                s += "\tnum_signals"
-            if self.write_samples:
-                s += "\tsamples"
+        if "event_mean" in event_d:
+            for field in ["mean", "std"]:
+                if field in self.stat_fields:
+                    s += "\t"+field
         return s
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+class BlockParser ():
+    """Parse an eventalign file by large byte blocks and yield reads as dicts of numpy arrays.
+    Only the fields listed in idx are decoded and read boundaries are found with array comparisons"""
+
+    def __init__ (self, idx, n_fields, block_size=16*1024*1024):
+        """"""
+        self.idx = idx
+        self.n_fields = n_fields
+        self.block_size = block_size
+
+    def __repr__ (self):
+        return "BlockParser / fields:{} / block size:{}".format(list(self.idx.keys()), self.block_size)
+
+    def __call__ (self, fp, max_bytes=None, skip_reads=None):
+        """Iterate over a binary file object starting after the header line. Stop after max_bytes if given.
+        Reads whose (read_id, ref_id) are in skip_reads are dropped before their fields are decoded"""
+        carry = b""
+        while True:
+            if max_bytes is None:
+                block = fp.read (self.block_size)
+            else:
+                block = fp.read (min (self.block_size, max_bytes))
+                max_bytes -= len(block)
+
+            # End of file = all remaining lines belong to complete reads
+            if not block:
+                data = carry.rstrip(b"\n")
+                if data:
+                    for read in self._parse_block (data+b"\n", last_block=True, skip_reads=skip_reads)[0]:
+                        yield read
+                return
+
+            # Only parse complete lines and keep the last partial line for next block
+            data = carry+block
+            last_nl = data.rfind (b"\n")
+            if last_nl == -1:
+                carry = data
+                continue
+
+            # Skip parsing if the first and last lines belong to the same read (very long reads)
+            first_line = data[:data.find(b"\n")]
+            last_line = data[data.rfind(b"\n", 0, last_nl)+1:last_nl]
+            if self._line_ids (first_line) == self._line_ids (last_line):
+                carry = data
+                continue
+
+            # Parse block and carry over the last read which might continue in the next block
+            read_list, tail_offset = self._parse_block (data[:last_nl+1], last_block=False, skip_reads=skip_reads)
+            for read in read_list:
+                yield read
+            carry = data[tail_offset:]
+
+    #~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~#
+
+    def _line_ids (self, line):
+        """Get ref_id and read_id of a single line"""
+        line = line.split(b"\t")
+        return (line[self.idx["ref_id"]], line[self.idx["read_id"]])
+
+    def _parse_block (self, data, last_block=False, skip_reads=None):
+        """Parse a block of complete lines and return the list of reads found and the byte offset of the last read.
+        Reads whose (read_id, ref_id) are in skip_reads are not returned"""
+        buf = np.frombuffer (data, dtype=np.uint8)
+
+        # Find line and field boundaries
+        line_end = np.flatnonzero (buf == 10)
+        line_start = np.concatenate (([0], line_end[:-1]+1))
+        n_lines = len(line_end)
+        tabs = np.flatnonzero (buf == 9)
+        if len(tabs) != n_lines*(self.n_fields-1):
+            raise NanopolishCompError ("Inconsistent number of fields in input block")
+        tabs = tabs.reshape (n_lines, self.n_fields-1)
+        if np.any(tabs[:,0] < line_start) or np.any(tabs[:,-1] > line_end):
+            raise NanopolishCompError ("Inconsistent number of fields in input block")
+
+        def field_bounds (field):
+            col = self.idx[field]
+            start = line_start if col == 0 else tabs[:,col-1]+1
+            end = line_end if col == self.n_fields-1 else tabs[:,col]
+            return start, end
+
+        # Find read boundaries
+        ref_id = self._gather (buf, *field_bounds("ref_id"))
+        read_id = self._gather (buf, *field_bounds("read_id"))
+        read_change = np.flatnonzero ((ref_id[1:] != ref_id[:-1]) | (read_id[1:] != read_id[:-1]))+1
+        read_start = np.concatenate (([0], read_change))
+        read_end = np.append (read_change, n_lines)
+        # Keep the last read for the next block as it might continue there
+        tail_offset = 0
+        if not last_block:
+            tail_offset = int(line_start[read_start[-1]])
+            read_start, read_end = read_start[:-1], read_end[:-1]
+
+        # Drop the lines of the reads to skip, and of the last read, before decoding the other fields
+        if skip_reads:
+            keep = np.array ([not (read_id[rs].decode(), ref_id[rs].decode()) in skip_reads for rs in read_start], dtype=bool)
+            if not keep.any():
+                return [], tail_offset
+            read_len = (read_end-read_start)[keep]
+            line_keep = np.zeros (n_lines, dtype=bool)
+            line_keep[:read_end[-1]] = np.repeat (keep, read_end-read_start)
+            line_start, line_end, tabs = line_start[line_keep], line_end[line_keep], tabs[line_keep]
+            ref_id, read_id = ref_id[line_keep], read_id[line_keep]
+            read_end = np.cumsum (read_len)
+            read_start = read_end-read_len
+            n_lines = len(line_start)
+
+        # Decode other fields in a single structured array
+        col_d = OrderedDict ()
+        col_d["ref_pos"] = self._gather (buf, *field_bounds("ref_pos")).astype(np.int64)
+        col_d["ref_kmer"] = self._gather (buf, *field_bounds("ref_kmer"))
+        col_d["mod_kmer"] = self._gather (buf, *field_bounds("mod_kmer"))
+        col_d["event_len"] = self._gather (buf, *field_bounds("event_len")).astype(np.float64)
+        if "event_mean" in self.idx:
+            col_d["event_mean"] = self._gather (buf, *field_bounds("event_mean")).astype(np.float64)
+            col_d["event_std"] = self._gather (buf, *field_bounds("event_std")).astype(np.float64)
+        if "start_idx" in self.idx:
+            col_d["start_idx"] = self._gather (buf, *field_bounds("start_idx")).astype(np.int64)
+            col_d["end_idx"] = self._gather (buf, *field_bounds("end_idx")).astype(np.int64)
+        if "samples" in self.idx:
+            sample_text, col_d["sample_text_len"] = self._parse_samples (buf, *field_bounds("samples"))
+            sample_text_offsets = np.concatenate (([0], np.cumsum(col_d["sample_text_len"])))
+        events = np.empty (n_lines, dtype=[(field, a.dtype) for field, a in col_d.items()])
+        for field, a in col_d.items():
+            events[field] = a
+
+        # Slice arrays per read. Slices are only copied when pickled
+        read_list = []
+        for rs, re in zip (read_start, read_end):
+            read_a = {"events":events[rs:re]}
+            if "samples" in self.idx:
+                read_a["sample_text"] = sample_text[sample_text_offsets[rs]:sample_text_offsets[re]].tobytes()
+            read_list.append ((read_id[rs].decode(), ref_id[rs].decode(), read_a))
+
+        return read_list, tail_offset
+
+    def _gather (self, buf, start, end):
+        """Collect a field of variable length from all lines in a numpy bytes array"""
+        field_len = end-start
+        width = max (int(field_len.max()), 1)
+        mat = buf.take (start[:,None]+np.arange(width), mode="clip")
+        # Pad shorter fields with null bytes
+        if field_len.min() < width:
+            mat[np.arange(width) >= field_len[:,None]] = 0
+        return mat.view ("S{}".format(width)).ravel()
+
+    def _parse_samples (self, buf, start, end):
+        """Extract the comma separated samples fields of all lines in a single text buffer.
+        Values are only parsed later by the workers"""
+        # Select samples fields bytes including the following field separator
+        d = np.zeros (len(buf)+1, dtype=np.int8)
+        d[start] += 1
+        d[end+1] -= 1
+        sample_text = buf[np.cumsum(d[:-1], dtype=np.int8).view(bool)]
+        sample_text[(sample_text == 9) | (sample_text == 10)] = 44
+        return sample_text, end-start+1
+
+class QueueBatcher ():
+    """Group items put in a multiprocessing queue into lists, sent when either max_items is reached or when
+    the total size of the items estimated with size_fun reaches max_bytes.
+    If a MemoryBudget is given, the size of each batch is reserved before sending it.
+    The time blocked on the queue and on the budget is accumulated in put_wait and reported to PipelineMetrics if given"""
+
+    def __init__ (self, q, max_items=1, max_bytes=0, size_fun=None, budget=None, wait_budget=True, metrics=None, stage=None):
+        """"""
+        self.q = q
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.size_fun = size_fun
+        self.budget = budget
+        self.wait_budget = wait_budget
+        self.batch = []
+        self.batch_bytes = 0
+        self.batch_reads = 0
+        self.batch_events = 0
+        self.n_batches = 0
+        self.put_wait = 0.0
+        self.metrics = metrics
+        self.stage = stage
+
+    def __repr__ (self):
+        return "QueueBatcher / max items:{} / max bytes:{} / batches sent:{}".format(self.max_items, self.max_bytes, self.n_batches)
+
+    def put (self, item, reads=1, events=0):
+        """Add an item to the current batch and send it if full. reads and events are the counts of the item reported to PipelineMetrics"""
+        self.batch.append (item)
+        self.batch_reads += reads
+        self.batch_events += events
+        if self.max_bytes or self.budget:
+            self.batch_bytes += self.size_fun (item)
+        if len(self.batch) >= self.max_items or (self.max_bytes and self.batch_bytes >= self.max_bytes):
+            self.flush ()
+
+    def flush (self):
+        """Send the current batch if not empty"""
+        if self.batch:
+            t = time()
+            if self.budget and self.batch_bytes:
+                self.budget.acquire (self.batch_bytes, wait=self.wait_budget)
+            self.q.put (self.batch)
+            put_wait = time()-t
+            self.put_wait += put_wait
+            if self.metrics:
+                self.metrics.add (**{self.stage+"_reads":self.batch_reads, self.stage+"_events":self.batch_events, self.stage+"_put_wait":put_wait})
+            self.n_batches += 1
+            self.batch = []
+            self.batch_bytes = 0
+            self.batch_reads = 0
+            self.batch_events = 0
+
+class MemoryBudget ():
+    """Estimated number of bytes in flight shared between processes. acquire blocks until enough bytes are released,
+    except if nothing else is in flight, so that a single item larger than the budget can still go through"""
+
+    def __init__ (self, max_bytes):
+        """"""
+        self.max_bytes = max_bytes
+        self.cond = mp.Condition ()
+        self.used = mp.Value ("q", 0, lock=False)
+        self.peak = mp.Value ("q", 0, lock=False)
+
+    def __repr__ (self):
+        return "MemoryBudget / max bytes:{} / used bytes:{} / peak bytes:{}".format(self.max_bytes, self.used.value, self.peak.value)
+
+    def acquire (self, n_bytes, wait=True):
+        """Reserve n_bytes, waiting for other processes to release memory if wait"""
+        with self.cond:
+            if wait:
+                while self.used.value and self.used.value+n_bytes > self.max_bytes:
+                    self.cond.wait ()
+            self.used.value += n_bytes
+            if self.used.value > self.peak.value:
+                self.peak.value = self.used.value
+
+    def release (self, n_bytes):
+        """Release n_bytes and wake up waiting processes"""
+        with self.cond:
+            self.used.value -= n_bytes
+            self.cond.notify_all ()
+
+class PipelineMetrics ():
+    """Counters of the pipeline stages shared between processes. Each process adds its own counters by batch and the main
+    process samples them with the depths of the queues. Times are in seconds"""
+
+    FIELDS = [
+        "reader_reads", "reader_events", "reader_put_wait",
+        "worker_reads", "worker_events", "worker_busy", "worker_get_wait", "worker_put_wait",
+        "writer_reads", "writer_bytes", "writer_get_wait",
+        "queue_samples", "in_q_depth_sum", "in_q_depth_max", "out_q_depth_sum", "out_q_depth_max"]
+
+    def __init__ (self):
+        """"""
+        self.counters = mp.Array ("d", len(self.FIELDS))
+        self.field_idx = {field:i for i, field in enumerate (self.FIELDS)}
+
+    def __repr__ (self):
+        return "PipelineMetrics / {}".format(" / ".join ("{}:{}".format(field, val) for field, val in self.snapshot().items()))
+
+    def add (self, **kwargs):
+        """Add values to the counters given as keyword arguments"""
+        with self.counters.get_lock ():
+            for field, val in kwargs.items():
+                self.counters[self.field_idx[field]] += val
+
+    def snapshot (self):
+        """Return an OrderedDict copy of all counters"""
+        with self.counters.get_lock ():
+            return OrderedDict (zip (self.FIELDS, self.counters[:]))
+
+    def sample_queues (self, in_q, out_q):
+        """Record the number of batches waiting in in_q and out_q. Return the depths, or None if not supported by the platform"""
+        depth_l = []
+        for q in (in_q, out_q):
+            try:
+                depth_l.append (q.qsize())
+            except NotImplementedError:
+                depth_l.append (None)
+        if not None in depth_l:
+            with self.counters.get_lock ():
+                self.counters[self.field_idx["queue_samples"]] += 1
+                for field, depth in zip (("in_q_depth", "out_q_depth"), depth_l):
+                    self.counters[self.field_idx[field+"_sum"]] += depth
+                    self.counters[self.field_idx[field+"_max"]] = max (self.counters[self.field_idx[field+"_max"]], depth)
+        return depth_l
+
+    def summary (self, elapsed):
+        """Return an OrderedDict of rates and fractions over a run of elapsed seconds"""
+        d = self.snapshot ()
+        elapsed = max (elapsed, 1e-9)
+        worker_time = max (d["worker_busy"]+d["worker_get_wait"]+d["worker_put_wait"], 1e-9)
+        n_samples = max (d["queue_samples"], 1)
+        summary_d = OrderedDict ()
+        summary_d["run_seconds"] = round (elapsed, 2)
+        summary_d["reader_reads_per_s"] = round (d["reader_reads"]/elapsed, 2)
+        summary_d["reader_events_per_s"] = round (d["reader_events"]/elapsed, 2)
+        summary_d["reader_put_wait_seconds"] = round (d["reader_put_wait"], 2)
+        summary_d["worker_reads_per_s"] = round (d["worker_reads"]/elapsed, 2)
+        summary_d["worker_events_per_s"] = round (d["worker_events"]/elapsed, 2)
+        summary_d["worker_busy_fraction"] = round (d["worker_busy"]/worker_time, 4)
+        summary_d["worker_get_wait_fraction"] = round (d["worker_get_wait"]/worker_time, 4)
+        summary_d["worker_put_wait_fraction"] = round (d["worker_put_wait"]/worker_time, 4)
+        # Throughput of a single fully busy worker, to size the number of workers needed to keep up with the reader
+        summary_d["worker_reads_per_busy_s"] = round (d["worker_reads"]/max (d["worker_busy"], 1e-9), 2)
+        summary_d["writer_reads_per_s"] = round (d["writer_reads"]/elapsed, 2)
+        summary_d["writer_bytes_per_s"] = round (d["writer_bytes"]/elapsed, 2)
+        summary_d["writer_get_wait_seconds"] = round (d["writer_get_wait"], 2)
+        summary_d["in_q_mean_depth"] = round (d["in_q_depth_sum"]/n_samples, 2)
+        summary_d["in_q_max_depth"] = int (d["in_q_depth_max"])
+        summary_d["out_q_mean_depth"] = round (d["out_q_depth_sum"]/n_samples, 2)
+        summary_d["out_q_max_depth"] = int (d["out_q_depth_max"])
+        return summary_d
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~IMPORTS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+# Standard library imports
+import os
+import io
+import mmap
+from collections import *
+
+# Third party imports
+import numpy as np
+
+# Local imports
+from NanopolishComp.common import *
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~MAIN CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+class Eventalign_collapse_reader ():
+
+    # dtypes of the kmer fields parsed from tsv files. Other fields are returned as str
+    TSV_DTYPE = OrderedDict ([
+        ("ref_pos", np.int64),
+        ("num_events", np.int64),
+        ("dwell_time", np.float64),
+        ("NNNNN_dwell_time", np.float64),
+        ("mismatch_dwell_time", np.float64),
+        ("start_idx", np.int64),
+        ("end_idx", np.int64),
+        ("mean", np.float64),
+        ("std", np.float64),
+        ("median", np.float64),
+        ("mad", np.float64),
+        ("num_signals", np.int64),
+        ("samples_offset", np.int64),
+        ("samples_count", np.int64)])
+
+    # dtypes of the index fields
+    IDX_DTYPE = OrderedDict ([
+        ("ref_id", str),
+        ("ref_start", np.int64),
+        ("ref_end", np.int64),
+        ("read_id", str),
+        ("kmers", np.int64),
+        ("dwell_time", np.float64),
+        ("NNNNN_kmers", np.int64),
+        ("mismatch_kmers", np.int64),
+        ("missing_kmers", np.int64),
+        ("samples_offset", np.int64),
+        ("samples_len", np.int64),
+        ("byte_offset", np.int64),
+        ("byte_len", np.int64),
+        ("virtual_offset", np.int64),
+        ("row_offset", np.int64),
+        ("row_len", np.int64),
+        ("shard", np.int64)])
+
+    def __init__ (self,
+        data_fn:"str",
+        idx_fn:"str"=None,
+        samples_fn:"str"=None,
+        verbose:"bool"=False,
+        quiet:"bool"=False):
+        """
+        Random access reader for files generated by Eventalign_collapse (tsv, BGZF compressed tsv or npy output format).
+        The data file is memory mapped and the index is loaded in memory to lookup reads by read_id or by reference interval.
+        Reads aligned on several references have one record per reference, selected with the ref_id argument of the lookup methods.
+        Compressed files are not memory mapped but read by BGZF virtual offsets. The shards written by multiple writers are
+        read as a single dataset from their manifest file (*_eventalign_collapse.tsv.manifest).
+        Reads are returned as numpy structured arrays with one row per kmer.
+        * data_fn
+            Path to a collapsed data file (*_eventalign_collapse.tsv, *_eventalign_collapse.tsv.gz or *_eventalign_collapse.npy)
+            or to the manifest file of a sharded dataset
+        * idx_fn
+            Path to the corresponding index file. By default data_fn + ".idx" or the unified index for a manifest
+        * samples_fn
+            Path to the binary samples file, if Eventalign_collapse was run with write_samples and a binary samples_format.
+            By default the *_eventalign_collapse.samples.npy file next to data_fn
+        * verbose
+            Increase verbosity
+        * quiet
+            Reduce verbosity
+        """
+        self.log = get_logger (name="Eventalign_collapse_reader", verbose=verbose, quiet=quiet)
+
+        # List of (data_fn, samples_fn) of each shard
+        if data_fn.endswith (".manifest"):
+            if not file_readable (data_fn):
+                raise IOError ("Cannot read file {}".format(data_fn))
+            shard_list = self._load_manifest (data_fn)
+            if not idx_fn:
+                idx_fn = data_fn[:-len(".manifest")]+".idx"
+        else:
+            shard_list = [(data_fn, samples_fn)]
+            if not idx_fn:
+                idx_fn = data_fn+".idx"
+        for fn in [fn for fn, _ in shard_list]+[idx_fn]:
+            if not file_readable (fn):
+                raise IOError ("Cannot read file {}".format(fn))
+        self.data_fn = data_fn
+        self.idx_fn = idx_fn
+
+        # Load index and define data file format from the offset fields
+        self.log.debug ("Loading index file {}".format(idx_fn))
+        self.idx = self._load_idx (idx_fn)
+        if "row_offset" in self.idx:
+            self.format = "npy"
+            self.offset, self.length = self.idx["row_offset"], self.idx["row_len"]
+        elif "byte_offset" in self.idx:
+            self.format = "tsv"
+            self.offset, self.length = self.idx["byte_offset"], self.idx["byte_len"]
+        elif "virtual_offset" in self.idx:
+            self.format = "tsv.gz"
+            self.offset, self.length = self.idx["virtual_offset"], self.idx["byte_len"]
+        else:
+            raise NanopolishCompError ("No offset fields found in index file {}".format(idx_fn))
+        self.shard = self.idx["shard"] if "shard" in self.idx else np.zeros (len(self.offset), dtype=np.int64)
+
+        # Memory map data files
+        self.data_list = [self._open_data (fn) for fn, _ in shard_list]
+
+        # Sorted read_id array for binary search
+        self.read_id_order = np.argsort (self.idx["read_id"], kind="stable")
+        self.sorted_read_id = self.idx["read_id"][self.read_id_order]
+
+        # Per reference arrays sorted by start for interval queries. The running max of ends allows to skip the reads
+        # ending before the query start with a binary search
+        self.ref_d = OrderedDict ()
+        for ref_id in np.unique (self.idx["ref_id"]):
+            ref_reads = np.flatnonzero (self.idx["ref_id"] == ref_id)
+            ref_reads = ref_reads[np.argsort (self.idx["ref_start"][ref_reads], kind="stable")]
+            self.ref_d[ref_id] = (
+                ref_reads,
+                self.idx["ref_start"][ref_reads],
+                self.idx["ref_end"][ref_reads],
+                np.maximum.accumulate (self.idx["ref_end"][ref_reads]))
+
+        # Memory map binary samples files if referenced in the index
+        self.samples_list = None
+        if "samples_offset" in self.idx:
+            self.samples_list = []
+            for fn, samples_fn in shard_list:
+                if not samples_fn:
+                    samples_fn = fn.rpartition("_eventalign_collapse.")[0]+"_eventalign_collapse.samples.npy"
+                if not file_readable (samples_fn):
+                    raise IOError ("Cannot read file {}".format(samples_fn))
+                self.log.debug ("Memory mapping samples file {}".format(samples_fn))
+                self.samples_list.append (np.load (samples_fn, mmap_mode="r"))
+
+        self.header_cache = {}
+        self.log.debug (repr(self))
+
+    def __repr__ (self):
+        return "Eventalign_collapse_reader / file:{} / format:{} / shards:{} / reads:{} / references:{}".format(
+            self.data_fn, self.format, len(self.data_list), len(self), len(self.ref_d))
+
+    def __len__ (self):
+        return len (self.idx["read_id"])
+
+    def __contains__ (self, read_id):
+        return len (self._find_reads (read_id)) > 0
+
+    def __iter__ (self):
+        """Iterate over all reads in file order, shard by shard. Yield (read_id, read_array)"""
+        for i in np.lexsort ((self.offset, self.shard)):
+            yield self.idx["read_id"][i], self._read_array (i)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exception_type, exception_val, trace):
+        self.close ()
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    @property
+    def read_ids (self):
+        """Array of all read_ids in index order"""
+        return self.idx["read_id"]
+
+    @property
+    def samples (self):
+        """Memory mapped samples array of a single file dataset, or None if there is no binary samples file"""
+        return self.samples_list[0] if self.samples_list else None
+
+    @property
+    def ref_ids (self):
+        """List of all reference ids found in the index"""
+        return list (self.ref_d.keys())
+
+    def get_read (self, read_id, ref_id=None):
+        """
+        Return the structured array of a read. ref_id is required if the read is aligned on several references.
+        Raise NanopolishCompError if the read_id is not in the index
+        """
+        return self._read_array (self._find_read (read_id, ref_id))
+
+    def get_read_info (self, read_id, ref_id=None):
+        """Return an OrderedDict of the index fields for a read. ref_id is required if the read is aligned on several references"""
+        return self._read_info (self._find_read (read_id, ref_id))
+
+    def get_samples (self, read_id, ref_id=None):
+        """
+        Return the float32 samples of a read from the binary samples file. The samples of a kmer are
+        samples[samples_offset:samples_offset+samples_count] using the fields of the read array.
+        ref_id is required if the read is aligned on several references
+        """
+        if not self.samples_list:
+            raise NanopolishCompError ("No binary samples file for {}".format(self.data_fn))
+        return self._read_samples (self._find_read (read_id, ref_id))
+
+    def get_ref_ids (self, read_id):
+        """Return the list of references on which a read is aligned"""
+        return list (self.idx["ref_id"][self._find_reads (read_id)])
+
+    def overlapping_reads (self, ref_id, start=None, end=None):
+        """
+        Return the read_ids of reads aligned on ref_id and overlapping the 0-based half open interval [start, end),
+        sorted by read start. If start or end are not given the interval extends to the start or end of the reference
+        """
+        return self.idx["read_id"][self._overlap_idx (ref_id, start, end)]
+
+    def query (self, region):
+        """
+        Iterate over reads overlapping a region formatted as "ref_id", "ref_id:start" or "ref_id:start-end" (0-based, half open).
+        Yield (read_id, read_array) sorted by read start
+        """
+        ref_id, start, end = self._parse_region (region)
+        for i in self._overlap_idx (ref_id, start, end):
+            yield self.idx["read_id"][i], self._read_array (i)
+
+    def close (self):
+        """Release the memory mapped data files"""
+        for data in self.data_list:
+            if isinstance (data, (mmap.mmap, io.IOBase)):
+                data.close ()
+        self.data_list = []
+        self.samples_list = None
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def _load_manifest (self, manifest_fn):
+        """Load the list of (data_fn, samples_fn) of the shards of a dataset. Paths are relative to the manifest file"""
+        shard_list = []
+        manifest_dir = os.path.dirname (manifest_fn)
+        with open (manifest_fn) as fp:
+            fp.readline()
+            for line in fp:
+                shard, data_fn, samples_fn = line.rstrip("\n").split("\t")
+                shard_list.append ((os.path.join (manifest_dir, data_fn), os.path.join (manifest_dir, samples_fn) if samples_fn else None))
+        return shard_list
+
+    def _open_data (self, data_fn):
+        """Memory map a data file or open it for BGZF random access"""
+        self.log.debug ("Memory mapping data file {}".format(data_fn))
+        if self.format == "npy":
+            return np.load (data_fn, mmap_mode="r")
+        elif self.format == "tsv.gz":
+            return open (data_fn, "rb")
+        elif os.path.getsize (data_fn):
+            with open (data_fn, "rb") as fp:
+                return mmap.mmap (fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return b""
+
+    def _load_idx (self, idx_fn):
+        """Load index file in a dict of arrays"""
+        with open (idx_fn) as fp:
+            header = fp.readline().rstrip("\n").split("\t")
+            col_l = [[] for _ in header]
+            for line in fp:
+                for col, val in zip (col_l, line.rstrip("\n").split("\t")):
+                    col.append (val)
+
+        idx = OrderedDict ()
+        for field, col in zip (header, col_l):
+            dtype = self.IDX_DTYPE.get (field, str)
+            idx[field] = np.array (col, dtype=str).astype (dtype) if col else np.array ([], dtype=dtype)
+        return idx
+
+    def _find_reads (self, read_id):
+        """Binary search of read_id in the sorted read_id array. Return the index positions of all its records in index order"""
+        lo = np.searchsorted (self.sorted_read_id, read_id, side="left")
+        hi = np.searchsorted (self.sorted_read_id, read_id, side="right")
+        return self.read_id_order[lo:hi]
+
+    def _find_read (self, read_id, ref_id=None):
+        """
+        Return the index position of a read record. Raise NanopolishCompError if the read is not found or
+        if it is aligned on several references and ref_id is not given
+        """
+        pos = self._find_reads (read_id)
+        if ref_id is not None:
+            pos = pos[self.idx["ref_id"][pos] == ref_id]
+        if len(pos) == 0:
+            raise NanopolishCompError ("Read {} not found in index{}".format(read_id, "" if ref_id is None else " for reference "+ref_id))
+        if len(pos) > 1:
+            if ref_id is None:
+                raise NanopolishCompError ("Read {} is aligned on several references ({}). Select one with ref_id".format(
+                    read_id, ", ".join(self.idx["ref_id"][pos])))
+            raise NanopolishCompError ("Read {} has several records for reference {}".format(read_id, ref_id))
+        return pos[0]
+
+    def _overlap_idx (self, ref_id, start=None, end=None):
+        """Return the index positions of reads overlapping [start, end) on ref_id sorted by start"""
+        if not ref_id in self.ref_d:
+            return np.array ([], dtype=np.int64)
+        ref_reads, ref_start, ref_end, max_end = self.ref_d[ref_id]
+        # Reads before lo all end before start and reads after hi all start after end
+        lo = 0 if start is None else np.searchsorted (max_end, start, side="right")
+        hi = len(ref_reads) if end is None else np.searchsorted (ref_start, end, side="left")
+        if lo >= hi:
+            return np.array ([], dtype=np.int64)
+        candidates = slice (lo, hi)
+        if start is None:
+            return ref_reads[candidates]
+        return ref_reads[candidates][ref_end[candidates] > start]
+
+    def _parse_region (self, region):
+        """Parse region string into (ref_id, start, end)"""
+        ref_id, sep, interval = region.rpartition (":")
+        if not sep or not interval or not interval.replace("-", "").replace(",", "").isdigit():
+            return region, None, None
+        try:
+            start, _, end = interval.replace(",", "").partition ("-")
+            start = int(start)
+            end = int(end) if end else None
+        except ValueError:
+            raise NanopolishCompError ("Invalid region {}".format(region))
+        if end is not None and end < start:
+            raise NanopolishCompError ("Invalid region {}. End is before start".format(region))
+        return ref_id, start, end
+
+    def _read_info (self, i):
+        """Return an OrderedDict of the index fields of the read at index position i"""
+        return OrderedDict ((field, a[i].item() if isinstance(a[i], np.generic) else a[i]) for field, a in self.idx.items())
+
+    def _read_samples (self, i):
+        """Return the float32 samples of the read at index position i"""
+        offset = int(self.idx["samples_offset"][i])
+        return decode_samples (self.samples_list[self.shard[i]][offset:offset+int(self.idx["samples_len"][i])])
+
+    def _read_array (self, i):
+        """Return the structured array of the read at index position i"""
+        offset = int(self.offset[i])
+        length = int(self.length[i])
+        data = self.data_list[self.shard[i]]
+        if self.format == "npy":
+            return self._parse_npy (data[offset:offset+length])
+        elif self.format == "tsv.gz":
+            return self._parse_tsv (bgzf_read (data, offset, length))
+        else:
+            return self._parse_tsv (data[offset:offset+length])
+
+    def _parse_npy (self, a):
+        """Copy npy records from the memory mapped file and decode the kmer codes"""
+        kmers = code_to_kmer (a["ref_kmer"])
+        dtype = [(field, kmers.dtype if field == "ref_kmer" else a.dtype[field]) for field in a.dtype.names]
+        read_a = np.empty (len(a), dtype=dtype)
+        for field in a.dtype.names:
+            read_a[field] = kmers if field == "ref_kmer" else a[field]
+        return read_a
+
+    def _parse_tsv (self, data):
+        """Parse a read block from the tsv file (read_id line, header line and kmer lines)"""
+        line_l = data.decode().split("\n")
+        header = line_l[1]
+        if not header in self.header_cache:
+            self.header_cache[header] = header.split("\t")
+        field_l = self.header_cache[header]
+
+        col_l = list (zip (*(line.split("\t") for line in line_l[2:]))) if len(line_l) > 2 else [() for _ in field_l]
+        array_d = OrderedDict ()
+        for field, col in zip (field_l, col_l):
+            array_d[field] = np.array (col, dtype=str).astype (self.TSV_DTYPE.get (field, str))
+
+        read_a = np.empty (len(line_l)-2, dtype=[(field, a.dtype) for field, a in array_d.items()])
+        for field, a in array_d.items():
+            read_a[field] = a
+        return read_a
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~IMPORTS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+# Disable multithreading for MKL and openBlas
+import os
+os.environ["MKL_NUM_THREADS"] = "1"
+os.environ["MKL_THREADING_LAYER"] = "sequential"
+os.environ["NUMEXPR_NUM_THREADS"] = "1"
+os.environ["OMP_NUM_THREADS"] = "1"
+os.environ['OPENBLAS_NUM_THREADS'] = '1'
+
+# Standard library imports
+import multiprocessing as mp
+from collections import *
+import traceback
+import datetime
+import threading
+
+# Third party imports
+import numpy as np
+
+# Local imports
+from NanopolishComp.common import *
+from NanopolishComp.Eventalign_collapse import Eventalign_collapse, QueueBatcher
+from NanopolishComp.Eventalign_collapse_reader import Eventalign_collapse_reader
+from NanopolishComp import __version__ as package_version
+from NanopolishComp import __name__ as package_name
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~LOGGING INFO~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+import logging
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~MAIN CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+class Eventalign_collapse_restat (Eventalign_collapse):
+
+    # kmer fields replaced or dropped in the output
+    STAT_FIELDS = ["mean", "std", "median", "mad", "num_signals"]
+    SAMPLES_FIELDS = ["samples", "samples_offset", "samples_count"]
+
+    def __init__ (self,
+        data_fn:"str",
+        outdir:"str"="./",
+        outprefix:"str"="out",
+        stat_fields:"list of str"=["mean", "median", "num_signals"],
+        threads:"int"=4,
+        output_format:"str"="tsv",
+        compress_output:"bool"=False,
+        compress_threads:"int"=4,
+        batch_reads:"int"=1,
+        verbose:"bool"=False,
+        quiet:"bool"=False):
+        """
+        Recompute the kmer statistics of an Eventalign_collapse output from its binary samples file, without parsing the
+        nanopolish eventalign file again. Eventalign_collapse has to be run with write_samples and samples_format float32 to
+        generate the samples cache. Reads listed in the index are split between the workers and written to a new collapsed
+        data file and index with the new stat fields, in the same formats as Eventalign_collapse
+        * data_fn
+            Path to a collapsed data file (*_eventalign_collapse.tsv, *_eventalign_collapse.tsv.gz or *_eventalign_collapse.npy),
+            with its index file and samples file, or to the manifest of a dataset written by multiple writers
+        * outdir
+            Path to the output folder (will be created if it does exist yet)
+        * outprefix
+            text outprefix for all the files generated
+        * stat_fields
+            List of statistical fields to compute. Valid values = "mean", "std", "median", "mad", "num_signals"
+        * threads
+            Total number of threads. 1 thread is used for the writer (default = 4)
+        * output_format
+            Format of the collapsed data file. "tsv" or "npy" (default = tsv)
+        * compress_output
+            Write the tsv data file compressed in BGZF format. Not available with npy output
+        * compress_threads
+            Number of threads used by the writer to compress BGZF blocks in parallel with compress_output. In addition to threads (default = 4)
+        * batch_reads
+            Number of reads grouped in a single message between the workers and the writer (default = 1)
+        * verbose
+            Increase verbosity
+        * quiet
+            Reduce verbosity
+        """
+
+        # Save init options in dict for later
+        kwargs = locals()
+
+        # Define overall verbose level
+        self.log = logging.getLogger()
+        if verbose:
+            self.log.setLevel (logging.DEBUG)
+        elif quiet:
+            self.log.setLevel (logging.WARNING)
+        else:
+            self.log.setLevel (logging.INFO)
+
+        # Collect args in dict for log report
+        self.option_d = OrderedDict()
+        self.option_d["package_name"] = package_name
+        self.option_d["package_version"] = package_version
+        self.option_d["timestamp"] = str(datetime.datetime.now())
+        for i, j in kwargs.items():
+            if i != "self":
+                self.option_d[i]=j
+        self.log.debug ("Options summary")
+        self.log.debug (dict_to_str(self.option_d))
+
+        # Verify parameters validity
+        self.log.info ("Checking arguments")
+        self.log.debug("\tLoading collapsed data file index")
+        reader = Eventalign_collapse_reader (data_fn, verbose=verbose, quiet=quiet)
+        if reader.samples is None:
+            raise ValueError ("No binary samples file found for {}. Run Eventalign_collapse with write_samples and samples_format float32".format(data_fn))
+        if reader.samples.dtype == np.int16:
+            self.log.warning ("Samples are stored as int16. Statistics are computed from scaled values and will differ from the original ones")
+        self.log.debug("\tCreating output folder")
+        mkdir(outdir, exist_ok=True)
+        self.log.debug("\tChecking number of threads")
+        if threads < 2:
+            raise ValueError ("At least 2 threads required")
+        self.log.debug("\tChecking if stat_fields names are valid")
+        for field in stat_fields:
+            if not field in self.STAT_FIELDS:
+                raise ValueError ("Invalid value in stat_field {}. Valid entries = mean, std, median, mad, num_signals".format(field))
+        self.log.debug("\tChecking output format")
+        if not output_format in ["tsv", "npy"]:
+            raise ValueError ("Invalid output_format {}. Valid entries = tsv, npy".format(output_format))
+        if output_format == "npy" and compress_output:
+            raise ValueError ("compress_output cannot be used with npy output format")
+        if batch_reads < 1:
+            raise ValueError ("batch_reads should be at least 1")
+
+        # Save args to self values. Reads are loaded directly by the workers, which send them to the Eventalign_collapse writer
+        self._init_writer (outdir, outprefix, output_format, compress_output, compress_threads)
+        self.data_fn = data_fn
+        self.stat_fields = stat_fields
+        self.threads = threads-1 # Remove 1 thread for write
+        self.batch_reads = batch_reads
+
+        # Init Multiprocessing variables
+        out_q = mp.Queue (maxsize = 1000)
+        error_q = mp.Queue ()
+
+        # Split reads between workers by position in the data file
+        ps_list = []
+        read_order = np.lexsort ((reader.offset, reader.shard))
+        reader.close ()
+        for i, read_idx in enumerate (np.array_split (read_order, self.threads)):
+            ps_list.append (mp.Process (target=self._restat_reads, args=(read_idx, out_q, error_q, i+1)))
+        ps_list.append (mp.Process (target=self._write_output, args=(out_q, error_q)))
+
+        self.log.info ("Starting to process files")
+        try:
+            # Start all processes
+            for ps in ps_list:
+                ps.start ()
+            threading.Thread (target=self._send_poison_pills, args=(ps_list[:-1], out_q, 1), daemon=True).start ()
+            # Monitor error queue
+            for E in iter (error_q.get, None):
+                raise E
+            # Join processes
+            for ps in ps_list:
+                ps.join ()
+
+        # Kill processes if any error
+        except (BrokenPipeError, KeyboardInterrupt, NanopolishCompError) as E:
+            for ps in ps_list:
+                ps.terminate ()
+            # Items left in the queue are never consumed, do not wait for them to be flushed at exit
+            out_q.cancel_join_thread ()
+            self.log.warning ("\nAn error occured. All processes were killed\n")
+            raise E
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+    def _restat_reads (self, read_idx, out_q, error_q, pid):
+        """
+        Multi-threaded workers recomputing the stat fields of a subset of reads from the index
+        """
+        self.log.debug("\t[restat_reads {}] Starting processing {} reads".format(pid, len(read_idx)))
+        out_batch = QueueBatcher (q=out_q, max_items=self.batch_reads)
+        try:
+            with Eventalign_collapse_reader (self.data_fn, quiet=True) as reader:
+                for seq, i in enumerate (read_idx):
+                    read_d, read_data = self._restat_read (reader, i)
+                    out_batch.put((seq, read_d, read_data))
+
+        # Manage exceptions and deal poison pills
+        except Exception:
+            error_q.put (NanopolishCompError(traceback.format_exc()))
+        finally:
+            self.log.debug("\t[restat_reads {}] Done".format(pid))
+            self._worker_done (out_batch)
+
+    def _restat_read (self, reader, i):
+        """
+        Replace the stat fields of the read at index position i by the ones computed from its samples and format it for the selected
+        output format. Reads are accessed by index position since reads aligned on several references share the same read_id
+        """
+        read_d = reader._read_info (i)
+        read_a = reader._read_array (i)
+        samples = reader._read_samples (i)
+
+        if read_d["samples_len"] != read_a["samples_count"].sum():
+            raise NanopolishCompError ("No samples or invalid samples count for read {} on {}".format(read_d["read_id"], read_d["ref_id"]))
+
+        # Keep the event level kmer fields and add the new stat fields
+        kmer_a = OrderedDict ()
+        for field in read_a.dtype.names:
+            if not field in self.STAT_FIELDS and not field in self.SAMPLES_FIELDS:
+                kmer_a[field] = read_a[field]
+        start = read_a["samples_offset"]
+        kmer_a.update (self._sample_stats (samples, start, start+read_a["samples_count"]))
+
+        if self.output_format == "tsv":
+            read_data = self._kmer_array_to_str (read_id=read_d["read_id"], ref_id=read_d["ref_id"], kmer_a=kmer_a)
+        else:
+            read_data = self._kmer_array_to_records (kmer_a=kmer_a)
+        return read_d, read_data
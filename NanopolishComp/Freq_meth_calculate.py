@@ -2,10 +2,12 @@
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~IMPORTS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 # Standard library imports
+import multiprocessing as mp
 from collections import *
 import csv
 import datetime
-from random import randint
+import math
+from itertools import islice
 
 # Third party imports
 from tqdm import tqdm
@@ -29,14 +31,19 @@ class Freq_meth_calculate():
         sample_id:"str"="",
         strand_specific:"bool"=False,
         min_llr:"float"=2,
+        decompress_threads:"int"=4,
+        sorted_input:"bool"=False,
+        threads:"int"=1,
         verbose:"bool"=False,
         quiet:"bool"=False):
         """
-        Calculate methylation frequency at genomic CpG sites from the output of nanopolish call-methylation
+        Calculate methylation frequency at genomic CpG sites from the output of nanopolish call-methylation.
+        The input is read in a single pass and the read calls are aggregated in per site counters
         * input_fn
-            Path to a nanopolish call_methylation tsv output file
+            Path to a nanopolish call_methylation tsv output file or 0 to read from stdin
         * fasta_index
-            fasta index file obtained with samtools faidx. Required for coordinate sorting
+            fasta index file obtained with samtools faidx. Required for coordinate sorting. Sites are sorted by chromosome in index
+            order, start and strand. Chromosomes missing from the index are sorted after the others in order of first appearance
         * output_bed_fn
             Path to write a summary result file in BED format
         * output_tsv_fn
@@ -49,6 +56,15 @@ class Freq_meth_calculate():
             If True, output strand specific sites
         * min_llr
             Minimal log likelyhood ratio to consider a site significantly methylated or unmethylated
+        * decompress_threads
+            Number of threads used to decompress BGZF compressed input in parallel. gzip and zstd compressed input are also detected
+        * sorted_input
+            The input is sorted by chromosome and start (in fasta_index order if given). Sites are written as soon as the input moves past
+            them, so that only the sites at the current position are held in memory. Raise NanopolishCompError if an unsorted line is found
+        * threads
+            Number of processes parsing the input. With more than 1 process, the input file is split in byte ranges starting at line
+            boundaries, which are parsed and aggregated in per site counters by the workers. The partial counters are merged in file order
+            so that the output is the same as with a single process. Requires an uncompressed input file and cannot be used with sorted_input
         * verbose
             Increase verbosity
         * quiet
@@ -76,6 +92,16 @@ class Freq_meth_calculate():
         if input_fn != 0 and not file_readable (input_fn):
             raise IOError ("Cannot read input file")
 
+        # Check multiprocessing options
+        if threads > 1:
+            log.debug("\tChecking multiprocessing options")
+            if input_fn == 0 or input_compression (input_fn):
+                raise ValueError ("threads requires an uncompressed input file and cannot read from stdin")
+            if sorted_input:
+                raise ValueError ("threads cannot be used with sorted_input")
+        elif threads < 1:
+            raise ValueError ("threads should be at least 1")
+
         # Verify that at least one output file is given:
         log.debug("\tCheck output file")
         if not output_bed_fn and not output_tsv_fn:
@@ -93,106 +119,225 @@ class Freq_meth_calculate():
         counter = Counter()
 
         log.warning ("## Parsing methylation_calls file ##")
-        # Init SGC class with fasta_index
-        if fasta_index:
-            SGC.set_chrom_list(fasta_index)
-
-        # Create collection to store results
-        site_dict = defaultdict(list)
-
+        # Integer encoding of the site coordinates, sorted in fasta_index order
+        site_keys = SiteKeys(fasta_index)
+
+        # Create collection to store results. The llr values of each read are only kept for the tsv output
+        # With sorted input, only the sites at the current position are kept
+        site_dict = OrderedDict()
+        Site.set_class_param(strand_specific=strand_specific, min_llr=min_llr, keep_llr_list=bool(output_tsv_fn))
+        cur_chrom = cur_start = None
+        done_chrom = set()
+
+        input_fp = open_input (input_fn, "r", threads=decompress_threads)
+        output_bed_fp = output_tsv_fp = None
         try:
-            input_fp = open (input_fn, "r")
+
+            log.debug ("\tWrite output file header")
+            if output_bed_fn:
+                output_bed_fp = open (output_bed_fn, "w")
+                output_bed_fp.write(Site.BED_header(sample_id)+"\n")
+            if output_tsv_fn:
+                output_tsv_fp = open (output_tsv_fn, "w")
+                output_tsv_fp.write(Site.TSV_header()+"\n")
 
             log.info ("\tStarting to parse file Nanopolish methylation call file")
             header_line = input_fp.readline()
-            byte_offset = len(header_line)
-            lp = LineParser(header_line, sep="\t", cast_numeric_field=True)
-
-            for line in tqdm(input_fp, desc="\t", unit=" lines", disable=log.level>=30):
-                counter["Total read lines"]+=1
-                byte_len = len(line)
-                l = lp(line)
-                
-                if not l:
-                    # Failsafe if line is malformed
-                    counter["Invalid read line"]+=1
-                else:
-                    # Store byte offset corresponding to appropriate line
-                    counter["Valid read lines"]+=1
-                    if strand_specific:
-                        coord = SGC(l.chromosome, l.start, l.strand)
-                    else:
-                        coord = SGC(l.chromosome, l.start)
-                    site_dict[coord].append(byte_offset)
-                    byte_offset += byte_len
-
-            log.info ("\tFiltering out low coverage sites")
-            filtered_site_dict = defaultdict(list)
-            for k, offset_list in site_dict.items():
-                counter["Total sites"]+=1
-
-                # If low coverage unset list to release memory
-                if len(offset_list) < min_depth:
-                    counter["Low coverage sites"]+=1
-                else:
-                    counter["Valid sites"]+=1
-                    filtered_site_dict[k]=offset_list
-            del site_dict
+            lp = self._line_parser (header_line)
 
-            if not filtered_site_dict:
-                raise NanopolishCompError ("No valid sites left after coverage filtering")
+            if threads > 1:
+                log.info ("\tParsing byte ranges of the input with {} processes".format(threads))
+                site_dict = self._parse_parallel (input_fn, header_line, threads, site_keys, counter, disable_pbar=log.level>=30)
 
-            if fasta_index:
+            else:
+                for lines in self._iter_blocks (tqdm(input_fp, desc="\t", unit=" lines", disable=log.level>=30)):
+                    for key, l in self._parse_block (lp, lines, counter, site_keys):
+
+                        # Write the sites of the previous position as soon as the input moves past it
+                        if sorted_input and (l.start != cur_start or l.chromosome != cur_chrom):
+                            self._check_sorted (l.chromosome, l.start, cur_chrom, cur_start, done_chrom, site_keys)
+                            self._write_sites (self._site_list (site_dict, site_keys, fasta_index), min_depth, counter, output_bed_fp, output_tsv_fp)
+                            site_dict = OrderedDict()
+                            if l.chromosome != cur_chrom:
+                                done_chrom.add(cur_chrom)
+                            cur_chrom, cur_start = l.chromosome, l.start
+
+                        self._add_call (site_dict, key, l)
+
+            if fasta_index and not sorted_input:
                 log.info ("\tSorting by coordinates")
-                filtered_site_dict = OrderedDict(sorted(filtered_site_dict.items(), key=lambda t: t[0]))
+            site_list = self._site_list (site_dict, site_keys, fasta_index)
+            del site_dict
 
-            log.info ("\tProcessing valid sites found")
-            Site.set_class_param(strand_specific=strand_specific, min_llr=min_llr)
+            log.info ("\tFiltering out low coverage sites and writing valid sites")
+            site_list = tqdm(site_list, desc="\t", unit=" sites", disable=log.level>=30 or sorted_input)
+            self._write_sites (site_list, min_depth, counter, output_bed_fp, output_tsv_fp)
 
-            log.debug ("\t\tWrite output file header")
-            if output_bed_fn:
-                output_bed_fp = open (output_bed_fn, "w")
-                output_bed_fp.write(Site.BED_header(sample_id)+"\n")
-            if output_tsv_fn:
-                output_tsv_fp = open (output_tsv_fn, "w")
-                output_tsv_fp.write(Site.TSV_header()+"\n")
+            if not counter["Valid sites"]:
+                raise NanopolishCompError ("No valid sites left after coverage filtering")
 
-            for k, offset_list in tqdm(filtered_site_dict.items(), desc="\t", unit=" sites", disable=log.level>=30):
-                # Get all read lines corresponding to current site
-                ll = []
-                for offset in offset_list:
-                    input_fp.seek(offset, 0)
-                    ll.append(lp(input_fp.readline()))
-
-                # Parse list with helper class Site
-                site = Site(ll=ll, id=hash(k))
-                counter["Valid sites"]+=1
-                if output_bed_fn:
-                    output_bed_fp.write(site.to_bed()+"\n")
-                if output_tsv_fn:
-                    output_tsv_fp.write(site.to_tsv()+"\n")
         finally:
             input_fp.close()
-            if output_bed_fn:
+            if output_bed_fp:
                 output_bed_fp.close()
-            if output_tsv_fn:
+            if output_tsv_fp:
                 output_tsv_fp.close()
 
         log.info ("## Results summary ##")
         log.info (dict_to_str(counter, nsep=1))
 
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def _line_parser (self, header_line):
+        """Return a LineParser only casting the columns used to aggregate the read calls. The strand is only required if strand_specific"""
+        columns = OrderedDict ([("chromosome", str), ("start", int), ("end", int), ("log_lik_ratio", float), ("sequence", str), ("num_motifs", int)])
+        if Site.strand_specific:
+            columns["strand"] = str
+        return LineParser(header_line, sep="\t", columns=columns)
+
+    def _iter_blocks (self, line_iter, block_lines=10000):
+        """Group the lines of an iterator in lists of block_lines lines"""
+        line_iter = iter(line_iter)
+        while True:
+            lines = list(islice(line_iter, block_lines))
+            if not lines:
+                return
+            yield lines
+
+    def _parse_block (self, lp, lines, counter, site_keys):
+        """
+        Parse a block of read call lines in column arrays and encode their site keys at once.
+        Return an iterator of (site key, parsed line) for the valid lines. Malformed lines are counted and skipped
+        """
+        col_d = lp.parse_block(lines)
+        n_valid = len(col_d["start"])
+        counter["Total read lines"]+=len(lines)
+        counter["Valid read lines"]+=n_valid
+        if n_valid < len(lines):
+            counter["Invalid read line"]+=len(lines)-n_valid
+        key_array = site_keys.encode_array(col_d["chromosome"], col_d["start"], col_d["strand"] if Site.strand_specific else None)
+        return zip(key_array.tolist(), map(lp.line_tuple._make, zip(*[a.tolist() for a in col_d.values()])))
+
+    def _add_call (self, site_dict, key, l):
+        """Add a read call to the counters of its site"""
+        site = site_dict.get(key)
+        if site is None:
+            site_dict[key] = Site(l=l)
+        else:
+            site.add(l)
+
+    def _parse_parallel (self, input_fn, header_line, threads, site_keys, counter, disable_pbar=False):
+        """
+        Aggregate the read calls of byte ranges of the input file in worker processes and merge the partial site counters in file order.
+        Sites are inserted in the merged dict in order of first appearance in the file, as with a single process
+        """
+        site_param = {"strand_specific":Site.strand_specific, "min_llr":Site.min_llr, "keep_llr_list":Site.keep_llr_list}
+        range_args = [(input_fn, start, end, header_line, site_param) for start, end in self._get_range_list (input_fn, threads*4)]
+
+        # Chromosome codes are specific to each worker so the keys are encoded again
+        site_dict = OrderedDict()
+        with mp.Pool (threads) as pool:
+            for range_site_list, range_counter in tqdm(pool.imap (self._parse_range, range_args), total=len(range_args), desc="\t", unit=" ranges", disable=disable_pbar):
+                counter.update(range_counter)
+                for site in range_site_list:
+                    key = site_keys.encode(site.chromosome, site.start, site.strand if Site.strand_specific else "")
+                    merged_site = site_dict.get(key)
+                    if merged_site is None:
+                        # Hashes of strings are only consistent within a process
+                        site.id = site.hash_id()
+                        site_dict[key] = site
+                    else:
+                        merged_site.merge(site)
+        return site_dict
+
+    def _parse_range (self, range_args):
+        """Worker aggregating the read calls of the lines of a byte range. Return the list of sites and the line counters"""
+        input_fn, start, end, header_line, site_param = range_args
+        Site.set_class_param(**site_param)
+        lp = self._line_parser (header_line)
+        site_keys = SiteKeys()
+        counter = Counter()
+        site_dict = OrderedDict()
+        with open (input_fn, "rb") as fp:
+            for lines in self._iter_blocks (self._range_lines (fp, start, end)):
+                for key, l in self._parse_block (lp, lines, counter, site_keys):
+                    self._add_call (site_dict, key, l)
+        return list(site_dict.values()), counter
+
+    def _range_lines (self, fp, start, end):
+        """Yield the decoded lines of the byte range [start, end) of a file starting at a line boundary"""
+        fp.seek(start)
+        pos = start
+        while pos < end:
+            line = fp.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode()
+
+    def _get_range_list (self, input_fn, n_ranges):
+        """Split the input file after the header line in byte ranges. Split points are moved forward to the next line start"""
+        file_size = os.path.getsize (input_fn)
+        with open (input_fn, "rb") as fp:
+            fp.readline()
+            data_start = fp.tell()
+            range_bounds = [data_start]
+            for i in range (1, n_ranges):
+                fp.seek (max (data_start+(file_size-data_start)*i//n_ranges, range_bounds[-1])-1)
+                fp.readline()
+                range_bounds.append (fp.tell())
+            range_bounds.append (file_size)
+        return [(start, end) for start, end in zip (range_bounds[:-1], range_bounds[1:]) if end > start]
+
+    def _check_sorted (self, chrom, start, cur_chrom, cur_start, done_chrom, site_keys):
+        """Raise NanopolishCompError if the site at chrom:start is before the current position of a sorted input"""
+        if chrom == cur_chrom:
+            if start < cur_start:
+                raise NanopolishCompError ("Input is not sorted: {}:{} found after {}:{}".format(chrom, start, cur_chrom, cur_start))
+        elif cur_chrom is not None:
+            if chrom in done_chrom:
+                raise NanopolishCompError ("Input is not sorted: chromosome {} found again after {}".format(chrom, cur_chrom))
+            if site_keys.index_rank and site_keys.chrom_rank(chrom) < site_keys.chrom_rank(cur_chrom):
+                raise NanopolishCompError ("Input is not sorted in fasta index order: chromosome {} found after {}".format(chrom, cur_chrom))
+
+    def _site_list (self, site_dict, site_keys, sort=False):
+        """Return the list of sites in insertion order or sorted by coordinates if sort"""
+        site_list = list(site_dict.values())
+        if sort:
+            key_array = np.fromiter(site_dict.keys(), dtype=np.int64, count=len(site_dict))
+            site_list = [site_list[i] for i in site_keys.sort_order(key_array)]
+        return site_list
+
+    def _write_sites (self, site_list, min_depth, counter, output_bed_fp, output_tsv_fp):
+        """Filter out low coverage sites and write the valid ones"""
+        for site in site_list:
+            counter["Total sites"]+=1
+            if site.total < min_depth:
+                counter["Low coverage sites"]+=1
+                continue
+            counter["Valid sites"]+=1
+            if output_bed_fp:
+                output_bed_fp.write(site.to_bed()+"\n")
+            if output_tsv_fp:
+                output_tsv_fp.write(site.to_tsv()+"\n")
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 
 class Site():
-    """Structure like class to store site information"""
+    """Counters of the read methylation calls of a site, updated line by line"""
+
+    __slots__ = ["total", "methylated", "unmethylated", "ambiguous", "id", "sequence", "num_motifs",
+        "chromosome", "start", "end", "strand", "llr_partials", "llr_list"]
 
     # Class variables and setter
     strand_specific = False
     min_llr = 2
+    keep_llr_list = True
     @classmethod
-    def set_class_param (cls, strand_specific=False, min_llr=2):
+    def set_class_param (cls, strand_specific=False, min_llr=2, keep_llr_list=True):
         cls.strand_specific = strand_specific
         cls.min_llr = min_llr
+        cls.keep_llr_list = keep_llr_list
 
     @classmethod
     def BED_header (cls, sample_id=""):
@@ -202,38 +347,84 @@ class Site():
     def TSV_header (cls):
         return "\t".join(["chromosome","start","end","strand","site_id","methylated_reads","unmethylated_reads","ambiguous_reads","sequence","num_motifs","llr_list"])
 
-    def __init__ (self, ll, id):
-        """"""
-        self.total = len(ll)
+    def __init__ (self, l):
+        """Init the site from its first read line"""
+        self.total = 0
         self.methylated = 0
         self.unmethylated = 0
         self.ambiguous = 0
-        self.id = id
-        self.sequence = ll[0].sequence
-        self.num_motifs = ll[0].num_motifs
-        self.chromosome = ll[0].chromosome
-        self.start = ll[0].start
-        self.end = ll[0].end+1
-        self.strand = ll[0].strand if self.strand_specific else "."
-
-        self.llr_list = []
-        for l in ll:
-            self.llr_list.append(float(l.log_lik_ratio))
-            # Count read methylation call per site
-            if l.log_lik_ratio >= self.min_llr:
-                self.methylated+=1
-            elif l.log_lik_ratio <= -self.min_llr:
-                self.unmethylated+=1
-            else:
-                self.ambiguous+=1
-
-        self.med_llr = np.mean(self.llr_list)
+        self.sequence = l.sequence
+        self.num_motifs = l.num_motifs
+        self.chromosome = l.chromosome
+        self.start = l.start
+        self.end = l.end+1
+        self.strand = l.strand if self.strand_specific else "."
+        self.id = self.hash_id()
+        self.llr_partials = []
+        self.llr_list = [] if self.keep_llr_list else None
+        self.add(l)
+
+    def add (self, l):
+        """Count the methylation call of a read line"""
+        llr = float(l.log_lik_ratio)
+        self.total+=1
+        self._add_partial(llr)
+        if self.llr_list is not None:
+            self.llr_list.append(llr)
+        if llr >= self.min_llr:
+            self.methylated+=1
+        elif llr <= -self.min_llr:
+            self.unmethylated+=1
+        else:
+            self.ambiguous+=1
+
+    def hash_id (self):
+        """Site id = hash of the site coordinates"""
+        return hash((self.chromosome, self.start, self.strand if self.strand_specific else ""))
+
+    def merge (self, other):
+        """Add the counters of the same site aggregated from another part of the input"""
+        self.total+=other.total
+        self.methylated+=other.methylated
+        self.unmethylated+=other.unmethylated
+        self.ambiguous+=other.ambiguous
+        for llr in other.llr_partials:
+            self._add_partial(llr)
+        if self.llr_list is not None:
+            self.llr_list.extend(other.llr_list)
+
+    def _add_partial (self, x):
+        """
+        Add a value to the exact sum of the llr, stored as a list of non-overlapping partial sums (Shewchuk algorithm, as in math.fsum).
+        The rounded sum does not depend on the order of the values, so that sites merged from several parts of the input are identical
+        """
+        partials = self.llr_partials
+        i = 0
+        for y in partials:
+            if abs(x) < abs(y):
+                x, y = y, x
+            hi = x+y
+            lo = y-(hi-x)
+            if lo:
+                partials[i] = lo
+                i+=1
+            x = hi
+        partials[i:] = [x]
+
+    @property
+    def med_llr (self):
+        """Mean llr of the reads, from the correctly rounded sum of the llr"""
+        return math.fsum(self.llr_partials)/self.total
+
+    @property
+    def color (self):
+        """BED item color depending on the mean llr"""
         if self.med_llr <= -self.min_llr:
-            self.color = '8,121,207'
+            return '8,121,207'
         elif self.med_llr < self.min_llr:
-            self.color = '100,100,100'
+            return '100,100,100'
         else:
-            self.color = '235,5,79'
+            return '235,5,79'
 
     def __repr__(self):
         return "{}:{}-{}({}) / id:{} / reads:{}".format(
@@ -245,13 +436,13 @@ class Site():
             self.total)
 
     def to_bed (self):
-        """"""
+        """Mean llr rounding to zero is written without sign"""
         return "{}\t{}\t{}\t{}\t{:.6f}\t{}\t{}\t{}\t'{}'".format(
             self.chromosome,
             self.start,
             self.end,
             self.id,
-            self.med_llr,
+            round(self.med_llr, 6)+0.0,
             self.strand,
             self.start,
             self.end,
@@ -272,47 +463,69 @@ class Site():
             self.num_motifs,
             ",".join([str(i) for i in self.llr_list]))
 
-class SGC():
-    """Sortable genomic coordinate object"""
+class SiteKeys():
+    """Encode site coordinates (chromosome, start, strand) in single integers used as dict keys, and sort them with numpy.
+    Chromosomes are coded in order of first appearance and ranked in fasta index order"""
 
-    chr_list = OrderedDict()
-    @classmethod
-    def set_chrom_list (cls, index):
-        if isinstance(index, dict):
-            cls.chr_list = index
-        else:
-            with open(index) as fp:
-                for i, line in enumerate(fp):
-                    chrom = line.split()[0]
-                    cls.chr_list[chrom]=i
+    STRAND_CODE = {"":0, "+":1, "-":2, ".":3}
+    START_BITS = 32
 
-    def __init__ (self, chrom, start=0, strand=""):
-        # Verify and store chromosome name
-        self.chrom = chrom
-        self.start = int(start)
-        self.strand = strand
+    def __init__ (self, fasta_index=None):
+        """"""
+        self.chrom_code = OrderedDict()
+        self.index_rank = OrderedDict()
+        # Sorting rank of each chromosome code, updated when a new chromosome is found
+        self.code_rank = np.zeros(0, dtype=np.int64)
+        if fasta_index:
+            with open(fasta_index) as fp:
+                for line in fp:
+                    self.index_rank.setdefault(line.split()[0], len(self.index_rank))
 
     def __repr__ (self):
-        return "{}:{} ({})".format(self.chrom, self.start, self.strand)
-
-    def __lt__(self, other):
-        if self.chrom == other.chrom:
-            if self.start == other.start:
-                # If everything is the same, just pick a random one
-                if self.strand == other.strand:
-                    return randint(0,1)
-                else:
-                    return self.strand < other.strand
-            else:
-                return self.start < other.start
-        else:
-            return self.chr_list.get(self.chrom, 0) < self.chr_list.get(other.chrom, 0)
-
-    def __hash__(self):
-        return hash((self.chrom, self.start, self.strand))
-
-    def __eq__(self, other):
-        return (self.chrom, self.start, self.strand) == (other.chrom, other.start, other.strand)
-
-    def __ne__(self, other):
-        return not(self == other)
+        return "SiteKeys / chromosomes:{} / indexed chromosomes:{}".format(len(self.chrom_code), len(self.index_rank))
+
+    def encode (self, chrom, start, strand=""):
+        """Return the integer key of a site. strand is "" if sites are not strand specific"""
+        code = self._chrom_code(chrom)
+        if not 0 <= start < 1<<self.START_BITS:
+            raise NanopolishCompError ("Invalid site start {}:{}".format(chrom, start))
+        return (((code<<self.START_BITS)|start)<<2)|self.STRAND_CODE.get(strand, 3)
+
+    def encode_array (self, chrom_array, start_array, strand_array=None):
+        """Return the int64 array of keys of arrays of site coordinates. strand_array is None if sites are not strand specific"""
+        if not len(start_array):
+            return np.zeros(0, dtype=np.int64)
+        if start_array.min() < 0 or start_array.max() >= 1<<self.START_BITS:
+            raise NanopolishCompError ("Invalid site start {}".format(start_array.min() if start_array.min() < 0 else start_array.max()))
+        # New chromosomes are coded in order of first appearance
+        chrom_list, first_idx, chrom_idx = np.unique(chrom_array, return_index=True, return_inverse=True)
+        code_array = np.zeros(len(chrom_list), dtype=np.int64)
+        for i in np.argsort(first_idx):
+            code_array[i] = self._chrom_code(chrom_list[i])
+        key_array = ((code_array[chrom_idx.ravel()]<<self.START_BITS)|start_array)<<2
+        if strand_array is not None:
+            strand_list, strand_idx = np.unique(strand_array, return_inverse=True)
+            key_array |= np.array([self.STRAND_CODE.get(strand, 3) for strand in strand_list], dtype=np.int64)[strand_idx.ravel()]
+        return key_array
+
+    def _chrom_code (self, chrom):
+        """Return the code of a chromosome. New chromosomes get the next code and their rank is added to the rank array"""
+        code = self.chrom_code.get(chrom)
+        if code is None:
+            code = self.chrom_code[chrom] = len(self.chrom_code)
+            self.code_rank = np.append(self.code_rank, self.chrom_rank(chrom))
+        return code
+
+    def chrom_rank (self, chrom):
+        """Sorting rank of a chromosome. Chromosomes missing from the fasta index are sorted after the others in order of first appearance"""
+        rank = self.index_rank.get(chrom)
+        if rank is None:
+            rank = len(self.index_rank)+self.chrom_code.get(chrom, len(self.chrom_code))
+        return rank
+
+    def sort_order (self, key_array):
+        """Return the indices sorting an int64 array of keys by chromosome rank, start and strand. Equal keys keep their order"""
+        strand = key_array & 3
+        start = (key_array>>2) & ((1<<self.START_BITS)-1)
+        code = key_array>>(self.START_BITS+2)
+        return np.lexsort((strand, start, self.code_rank[code]))
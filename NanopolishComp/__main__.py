@@ -11,6 +11,7 @@ from NanopolishComp import __version__ as package_version
 from NanopolishComp import __name__ as package_name
 from NanopolishComp import __description__ as package_description
 from NanopolishComp.Eventalign_collapse import Eventalign_collapse
+from NanopolishComp.Eventalign_collapse_restat import Eventalign_collapse_restat
 from NanopolishComp.Freq_meth_calculate import Freq_meth_calculate
 
 #~~~~~~~~~~~~~~TOP LEVEL ENTRY POINT~~~~~~~~~~~~~~#
@@ -29,21 +30,57 @@ def main(args=None):
     subparser_ec = subparsers.add_parser("Eventalign_collapse", description="Collapse the nanopolish eventalign output at kmers level and compute kmer level statistics")
     subparser_ec.set_defaults(func=Eventalign_collapse_main)
     subparser_ec_io = subparser_ec.add_argument_group("Input/Output options")
-    subparser_ec_io.add_argument("-i", "--input_fn", default=0, help="Path to a nanopolish eventalign tsv output file. If '0' read from std input (default: %(default)s)")
+    subparser_ec_io.add_argument("-i", "--input_fn", default=[0], nargs="+", help="Path to a nanopolish eventalign tsv output file or named pipe, optionally compressed with gzip, bgzip or zstd. Multiple inputs are read concurrently and written to a single output. If '0' read from std input (default: %(default)s)")
     subparser_ec_io.add_argument("-o", "--outdir", type=str, default="./", help="Path to the output folder (will be created if it does exist yet) (default: %(default)s)")
     subparser_ec_io.add_argument("-p", "--outprefix", type=str, default="out", help="text outprefix for all the files generated (default: %(default)s)")
+    subparser_ec_io.add_argument("--output_format", type=str, default="tsv", choices=["tsv", "npy"], help="Format of the collapsed data file. npy = numpy structured array with fixed dtype columns which can be memory mapped. In npy format the index contains row offsets instead of byte offsets (default: %(default)s)")
+    subparser_ec_io.add_argument("--compress_output", default=False, action='store_true', help="Write the tsv data file compressed in BGZF format (*_eventalign_collapse.tsv.gz). The index then contains BGZF virtual offsets instead of byte offsets (default: %(default)s)")
+    subparser_ec_io.add_argument("--resume", default=False, action='store_true', help="Resume an interrupted run with the same --outdir and --outprefix. Reads already in the index are skipped, partial records are truncated and new reads are appended. Only for uncompressed tsv output (default: %(default)s)")
     subparser_ec_rp = subparser_ec.add_argument_group("Run parameters options")
     subparser_ec_rp.add_argument("-s", "--write_samples", default=False, action='store_true', help="If given, will write the raw sample if nanopolish eventalign was ran with --samples option (default: %(default)s)")
+    subparser_ec_rp.add_argument("--samples_format", type=str, default="text", choices=["text", "float32", "int16"], help="Format of the samples written with --write_samples. text = comma separated values in the data file. float32 or int16 = binary samples file (*_eventalign_collapse.samples.npy) referenced by offsets in the kmer rows and in the index (default: %(default)s)")
     subparser_ec_rp.add_argument("-r", "--max_reads", default=0 , type=int , help = "Maximum number of read to parse. 0 to deactivate (default: %(default)s)")
     subparser_ec_rp.add_argument("-f", "--stat_fields", default=["mean", "median", "num_signals"], type=str, nargs='+', help = "List of statistical fields to compute if nanopolish eventalign was ran with --sample option. Valid values = mean, std, median, mad, num_signals (default: %(default)s)")
+    subparser_ec_rp.add_argument("-e", "--event_stats", default=False, action='store_true', help="Compute the kmer mean and std stat_fields from the event_level_mean, event_stdv and event_length fields, pooled over events weighted by length. Does not require nanopolish eventalign to be ran with --samples (default: %(default)s)")
     subparser_ec_other = subparser_ec.add_argument_group("Other options")
-    subparser_ec_other.add_argument("-t", "--threads", default=4, type=int, help="Total number of threads. 1 thread is used for the reader and 1 for the writer (default: %(default)s)")
+    subparser_ec_other.add_argument("-t", "--threads", default=4, type=int, help="Total number of threads. 1 thread is used for the reader of each input (none with --shard_input) and 1 for each writer, the others by the workers. With --auto, maximum total number of threads, 0 = all available CPUs (default: %(default)s)")
+    subparser_ec_other.add_argument("--decompress_threads", default=4, type=int, help="Number of additional threads used by the reader to decompress bgzip compressed input in parallel (default: %(default)s)")
+    subparser_ec_other.add_argument("--compress_threads", default=4, type=int, help="Number of additional threads used by the writer to compress the output in parallel with --compress_output (default: %(default)s)")
+    subparser_ec_other.add_argument("--vectorized_parser", default=False, action='store_true', help="Parse the input by large byte blocks with numpy instead of line by line. Much faster reader for large files (default: %(default)s)")
+    subparser_ec_other.add_argument("--shard_input", default=False, action='store_true', help="Split the input file in byte ranges starting at read boundaries, which are directly parsed and collapsed by the workers. Requires an input file (default: %(default)s)")
+    subparser_ec_other.add_argument("--batch_reads", default=1, type=int, help="Number of reads grouped in a single message between the reader, the workers and the writer (default: %(default)s)")
+    subparser_ec_other.add_argument("--batch_bytes", default="0", type=str, help="Send a batch as soon as its estimated size reaches this number of bytes, even if batch_reads is not reached. Accepts sizes with unit suffix such as 500K or 2M. 0 to deactivate (default: %(default)s)")
+    subparser_ec_other.add_argument("--max_memory", default="0", type=str, help="Maximum estimated size of the reads in flight in the queues between the reader, the workers and the writer. The reader waits when the limit is reached. With --shm_buffer, the buffer is allocated in addition. Accepts sizes with unit suffix such as 500M or 8G. 0 to deactivate (default: %(default)s)")
+    subparser_ec_other.add_argument("--shm_buffer", default="0", type=str, help="Size of a shared memory buffer in which the readers directly read blocks of reads parsed in place by the workers, instead of sending parsed reads through a queue. Fastest transport when reading from stdin. Accepts sizes with unit suffix such as 256M. Requires python >= 3.8. 0 to deactivate (default: %(default)s)")
+    subparser_ec_other.add_argument("--writers", default=1, type=int, help="Number of writer processes, each writing its own data file shard. A unified index and a manifest of the shards are written at the end. Cannot be used with --ordered, --max_chunk_events or --resume (default: %(default)s)")
+    subparser_ec_other.add_argument("--metrics_interval", default=0, type=float, help="Interval in seconds between samples of the pipeline metrics (rates, queue wait times and depths, worker busy fraction, writer bytes/s) written to a JSON lines file and summarized in the log. 0 to deactivate (default: %(default)s)")
+    subparser_ec_other.add_argument("--auto", default=False, action='store_true', help="Measure the processing costs on the first reads of the input and choose the number of workers (within --threads, 0 = all available CPUs), the batch size and the queue sizes. The chosen configuration is reported in the log. Requires a regular input file (default: %(default)s)")
+    subparser_ec_other.add_argument("--auto_reads", default=200, type=int, help="Number of reads sampled by --auto (default: %(default)s)")
+    subparser_ec_other.add_argument("--ordered", default=False, action='store_true', help="Write reads in the same order as in the input file. Cannot be used with --shard_input (default: %(default)s)")
+    subparser_ec_other.add_argument("--max_chunk_events", default=0, type=int, help="Split reads with more events than this value in chunks collapsed and written separately, to keep memory usage independent of read length. Implies --ordered. Cannot be used with --vectorized_parser or --shard_input. 0 to deactivate (default: %(default)s)")
+    subparser_ec_other.add_argument("--reorder_buffer", default=1000, type=int, help="Maximum number of reads held by the writer to restore the input order with --ordered. The reader waits when the limit is reached (default: %(default)s)")
+
+    # Eventalign_collapse_restat subparser
+    subparser_er = subparsers.add_parser("Eventalign_collapse_restat", description="Recompute the kmer level statistics of an Eventalign_collapse output from its binary samples file (Eventalign_collapse --write_samples --samples_format float32)")
+    subparser_er.set_defaults(func=Eventalign_collapse_restat_main)
+    subparser_er_io = subparser_er.add_argument_group("Input/Output options")
+    subparser_er_io.add_argument("-i", "--data_fn", required=True, help="Path to a collapsed data file generated by Eventalign_collapse. The index and samples files are found from the data file name")
+    subparser_er_io.add_argument("-o", "--outdir", type=str, default="./", help="Path to the output folder (will be created if it does exist yet) (default: %(default)s)")
+    subparser_er_io.add_argument("-p", "--outprefix", type=str, default="out", help="text outprefix for all the files generated (default: %(default)s)")
+    subparser_er_io.add_argument("--output_format", type=str, default="tsv", choices=["tsv", "npy"], help="Format of the collapsed data file (default: %(default)s)")
+    subparser_er_io.add_argument("--compress_output", default=False, action='store_true', help="Write the tsv data file compressed in BGZF format (default: %(default)s)")
+    subparser_er_rp = subparser_er.add_argument_group("Run parameters options")
+    subparser_er_rp.add_argument("-f", "--stat_fields", default=["mean", "median", "num_signals"], type=str, nargs='+', help = "List of statistical fields to compute. Valid values = mean, std, median, mad, num_signals (default: %(default)s)")
+    subparser_er_other = subparser_er.add_argument_group("Other options")
+    subparser_er_other.add_argument("-t", "--threads", default=4, type=int, help="Total number of threads. 1 thread is used for the writer (default: %(default)s)")
+    subparser_er_other.add_argument("--compress_threads", default=4, type=int, help="Number of additional threads used by the writer to compress the output in parallel with --compress_output (default: %(default)s)")
+    subparser_er_other.add_argument("--batch_reads", default=1, type=int, help="Number of reads grouped in a single message between the workers and the writer (default: %(default)s)")
 
     # Freq_meth_calculate subparser
     subparser_fm = subparsers.add_parser("Freq_meth_calculate", description="Calculate methylation frequency at genomic CpG sites from the output of nanopolish call-methylation")
     subparser_fm.set_defaults(func=Freq_meth_calculate_main)
     subparser_fm_io = subparser_fm.add_argument_group("Input/Output options")
-    subparser_fm_io.add_argument("-i", "--input_fn", default=0, help="Path to a nanopolish call_methylation tsv output file. If not specified read from std input")
+    subparser_fm_io.add_argument("-i", "--input_fn", default=0, help="Path to a nanopolish call_methylation tsv output file, optionally compressed with gzip, bgzip or zstd. If not specified read from std input")
     subparser_fm_io.add_argument("-b", "--output_bed_fn", type=str, default="", help="Path to write a summary result file in BED format")
     subparser_fm_io.add_argument("-t", "--output_tsv_fn", type=str, default="", help="Path to write an more extensive result report in TSV format")
     subparser_fm_fo = subparser_fm.add_argument_group("Filtering options")
@@ -53,9 +90,12 @@ def main(args=None):
     subparser_fm_other.add_argument("-s", "--sample_id", type=str, default="", help="Sample ID to be used for the bed track header (default: %(default)s)")
     subparser_fm_other.add_argument("--strand_specific", action="store_true", default=False, help="Output strand specific sites")
     subparser_fm_other.add_argument("--min_llr", type=float, default=2, help="Minimal log likelyhood ratio to consider a site significantly methylated or unmethylated (default: %(default)s)")
+    subparser_fm_other.add_argument("--decompress_threads", type=int, default=4, help="Number of threads used to decompress bgzip compressed input in parallel (default: %(default)s)")
+    subparser_fm_other.add_argument("--threads", type=int, default=1, help="Number of processes parsing byte ranges of the input in parallel. Requires an uncompressed input file and cannot be used with --sorted_input (default: %(default)s)")
+    subparser_fm_other.add_argument("--sorted_input", action="store_true", default=False, help="The input is sorted by chromosome and start (in fasta index order if given). Sites are written as soon as the input moves past them to use constant memory. An error is raised if the input is not sorted (default: %(default)s)")
 
     # Add common group parsers
-    for sp in [subparser_ec, subparser_fm]:
+    for sp in [subparser_ec, subparser_er, subparser_fm]:
         sp_verbosity = sp.add_mutually_exclusive_group()
         sp_verbosity.add_argument("-v", "--verbose", action="store_true", default=False, help="Increase verbosity")
         sp_verbosity.add_argument("-q", "--quiet", action="store_true", default=False, help="Reduce verbosity")
@@ -70,12 +110,48 @@ def Eventalign_collapse_main (args):
     """"""
     # Run corresponding class
     Eventalign_collapse (
-        input_fn = args.input_fn,
+        input_fn = [0 if fn == "0" else fn for fn in args.input_fn],
         outdir = args.outdir,
         outprefix = args.outprefix,
         write_samples = args.write_samples,
+        samples_format = args.samples_format,
+        stat_fields= args.stat_fields,
+        threads = args.threads,
+        vectorized_parser = args.vectorized_parser,
+        shard_input = args.shard_input,
+        batch_reads = args.batch_reads,
+        batch_bytes = args.batch_bytes,
+        max_memory = args.max_memory,
+        ordered = args.ordered,
+        reorder_buffer = args.reorder_buffer,
+        output_format = args.output_format,
+        max_chunk_events = args.max_chunk_events,
+        event_stats = args.event_stats,
+        decompress_threads = args.decompress_threads,
+        compress_output = args.compress_output,
+        compress_threads = args.compress_threads,
+        resume = args.resume,
+        shm_buffer = args.shm_buffer,
+        writers = args.writers,
+        metrics_interval = args.metrics_interval,
+        auto = args.auto,
+        auto_reads = args.auto_reads,
+        verbose = args.verbose,
+        quiet = args.quiet)
+
+def Eventalign_collapse_restat_main (args):
+    """"""
+    # Run corresponding class
+    Eventalign_collapse_restat (
+        data_fn = args.data_fn,
+        outdir = args.outdir,
+        outprefix = args.outprefix,
         stat_fields= args.stat_fields,
         threads = args.threads,
+        output_format = args.output_format,
+        compress_output = args.compress_output,
+        compress_threads = args.compress_threads,
+        batch_reads = args.batch_reads,
         verbose = args.verbose,
         quiet = args.quiet)
 
@@ -91,5 +167,8 @@ def Freq_meth_calculate_main (args):
         sample_id = args.sample_id,
         strand_specific = args.strand_specific,
         min_llr = args.min_llr,
+        decompress_threads = args.decompress_threads,
+        sorted_input = args.sorted_input,
+        threads = args.threads,
         verbose = args.verbose,
         quiet = args.quiet)
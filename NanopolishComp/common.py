@@ -4,8 +4,24 @@
 # Standard library imports
 import sys
 import os
+import stat
 from collections import *
 import logging
+import struct
+import io
+import gzip
+import zlib
+import array
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party imports
+import numpy as np
+
+# Optional third party imports
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 #~~~~~~~~~~~~~~FUNCTIONS~~~~~~~~~~~~~~#
 
@@ -18,6 +34,10 @@ def file_readable (fn, **kwargs):
     """Check if the file is readable"""
     return os.path.isfile (fn) and os.access (fn, os.R_OK)
 
+def fifo_readable (fn, **kwargs):
+    """Check if the file is a readable named pipe"""
+    return os.path.exists (fn) and stat.S_ISFIFO (os.stat(fn).st_mode) and os.access (fn, os.R_OK)
+
 def dir_writable (fn, **kwargs):
     """Check if the file is readable"""
     if not os.path.isdir(fn):
@@ -49,6 +69,76 @@ def numeric_cast (v):
                 pass
     return v
 
+def parse_size (size):
+    """Convert a size with an optional unit suffix (K, M, G or T) to a number of bytes"""
+    if isinstance (size, str):
+        size = size.strip().upper().rstrip("B")
+        unit_d = {"K":1024, "M":1024**2, "G":1024**3, "T":1024**4}
+        try:
+            if size and size[-1] in unit_d:
+                size = int(float(size[:-1])*unit_d[size[-1]])
+            else:
+                size = int(size)
+        except ValueError:
+            raise NanopolishCompError ("Invalid size value `{}`".format(size))
+    if size < 0:
+        raise NanopolishCompError ("Size cannot be negative")
+    return size
+
+def available_cpus ():
+    """Return the number of CPUs available to the current process"""
+    try:
+        return len (os.sched_getaffinity (0))
+    except AttributeError:
+        return os.cpu_count () or 1
+
+def available_memory ():
+    """Return the available physical memory in bytes, or None if it cannot be determined on this platform"""
+    try:
+        return os.sysconf ("SC_AVPHYS_PAGES")*os.sysconf ("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def detect_compression (magic):
+    """Return the compression format ("bgzf", "gzip" or "zstd") of a file from its first bytes or None if not compressed"""
+    if magic[:4] == b"\x28\xb5\x2f\xfd":
+        return "zstd"
+    if magic[:2] == b"\x1f\x8b":
+        # BGZF = gzip with the extra field flag and a BC extra subfield
+        if len(magic) >= 16 and magic[3] & 4 and magic[12:14] == b"BC":
+            return "bgzf"
+        return "gzip"
+    return None
+
+def input_compression (fn):
+    """Return the compression format of a file or None if not compressed"""
+    with open (fn, "rb") as fp:
+        return detect_compression (fp.read(18))
+
+def open_input (fn, mode="r", threads=1):
+    """
+    Open a plain, gzip, BGZF or zstd compressed file, named pipe or stdin if fn is 0, for reading in text ("r") or binary ("rb") mode.
+    The compression is detected from the first bytes. BGZF blocks are decompressed in parallel with threads
+    """
+    if not mode in ["r", "rb"]:
+        raise NanopolishCompError ("Invalid mode {}. Valid entries = r, rb".format(mode))
+    fp = open (fn, "rb")
+    compression = detect_compression (fp.peek(18)[:18])
+    # Streams cannot be reopened since the peeked bytes would be lost
+    if not compression and fn != 0 and os.path.isfile (fn):
+        fp.close ()
+        return open (fn, mode)
+
+    if compression == "bgzf":
+        fp = io.BufferedReader (BGZFReader (fp, threads=threads), buffer_size=1024*1024)
+    elif compression == "gzip":
+        fp = gzip.GzipFile (fileobj=fp, mode="rb")
+    elif compression == "zstd":
+        if not zstandard:
+            raise NanopolishCompError ("The zstandard package is required to read zstd compressed files")
+        fp = io.BufferedReader (zstandard.ZstdDecompressor().stream_reader(fp, read_across_frames=True, closefd=True), buffer_size=1024*1024)
+    return io.TextIOWrapper (fp) if mode == "r" else fp
+
 def dict_to_str (d, sep="\t", nsep=0, exclude_list=[]):
     """ Transform a multilevel dict to a tabulated str """
     m = ""
@@ -204,16 +294,51 @@ class LineParser():
     """Simple line parser which returns namedtuples per line and does numeric
     type casting for file lines"""
 
-    def __init__(self, header_line, sep="\t", cast_numeric_field=True):
-        """"""
+    NUMPY_TYPES = {int:np.int64, float:np.float64, str:object}
+
+    def __init__(self, header_line, sep="\t", cast_numeric_field=True, columns=None):
+        """
+        * header_line
+            Header line of the file containing the column names
+        * sep
+            Field separator (default = \\t)
+        * cast_numeric_field
+            Try to cast all fields to int or float. Ignored for columns with a declared type
+        * columns
+            Optional column projection. Either a list of column names or a dict of column name: type (int, float or str).
+            Only the selected columns are parsed and returned, and string columns are not cast
+        """
         self.cast_numeric_field = cast_numeric_field
         self.sep = sep
         self.header = header_line.strip().split(self.sep)
-        self.line_tuple = namedtuple("Line", self.header)
         self.c = Counter()
 
+        # Fast path. Only parse the projected columns with their declared types
+        self.columns = None
+        if columns:
+            if not isinstance (columns, dict):
+                columns = OrderedDict ((name, None) for name in columns)
+            self.columns = OrderedDict ()
+            self.col_idx = []
+            self.col_cast = []
+            for name, col_type in columns.items():
+                if not name in self.header:
+                    raise NanopolishCompError ("Column {} not found in header".format(name))
+                if not col_type in (int, float, str, None):
+                    raise NanopolishCompError ("Invalid type {} for column {}. Valid types = int, float, str".format(col_type, name))
+                if col_type is None:
+                    col_type = "numeric" if cast_numeric_field else str
+                self.columns[name] = col_type
+                self.col_idx.append (self.header.index(name))
+                self.col_cast.append (self._numeric_cast if col_type == "numeric" else None if col_type is str else col_type)
+            self.line_tuple = namedtuple("Line", self.columns.keys())
+        else:
+            self.line_tuple = namedtuple("Line", self.header)
+
     def __repr__ (self):
         m = "Header names: {}\n".format(self.header)
+        if self.columns:
+            m+="Projected columns: {}\n".format(dict_to_str({k:getattr(v, "__name__", v) for k, v in self.columns.items()}))
         m+="Line counter:{}".format(dict_to_str(self.c))
         return m
 
@@ -221,6 +346,9 @@ class LineParser():
         """"""
         line = line.strip().split(self.sep)
 
+        if self.columns:
+            return self._parse_columns (line)
+
         # Try to cast numeric field to appropiate type
         if self.cast_numeric_field:
             for i in range(len(line)):
@@ -235,6 +363,55 @@ class LineParser():
             self.c["Valid line parsed"]+=1
             return line
 
+    def parse_block (self, lines):
+        """
+        Parse a list of lines at once and return an OrderedDict of column name: numpy array. Requires a column projection.
+        Columns declared as int or float are returned as int64 or float64 arrays, other columns as object arrays.
+        Lines with inconsistent field numbers or invalid values are skipped and counted
+        """
+        if not self.columns:
+            raise NanopolishCompError ("parse_block requires a column projection")
+
+        n_fields = len(self.header)
+        row_list = []
+        for line in lines:
+            line = line.strip().split(self.sep)
+            if len(line) != n_fields:
+                self.c["Inconsistent field numbers"]+=1
+            else:
+                row_list.append (line)
+
+        try:
+            # Cast whole columns at once
+            col_d = OrderedDict ()
+            for (name, col_type), i, cast in zip (self.columns.items(), self.col_idx, self.col_cast):
+                if col_type == "numeric":
+                    col_d[name] = np.array ([cast(row[i]) for row in row_list], dtype=object)
+                else:
+                    col_d[name] = np.array ([row[i] for row in row_list], dtype=self.NUMPY_TYPES[col_type])
+            self.c["Valid line parsed"]+=len(row_list)
+
+        except ValueError:
+            # Fall back to line by line casting to skip the lines with invalid values
+            line_list = [l for l in (self._parse_columns (row) for row in row_list) if l]
+            col_d = OrderedDict ()
+            for j, (name, col_type) in enumerate (self.columns.items()):
+                col_d[name] = np.array ([l[j] for l in line_list], dtype=self.NUMPY_TYPES.get(col_type, object))
+        return col_d
+
+    def _parse_columns (self, line):
+        """Cast the projected columns of a split line and return a namedtuple or None if the line is invalid"""
+        if len(line) != len(self.header):
+            self.c["Inconsistent field numbers"]+=1
+            return None
+        try:
+            line = self.line_tuple(*[line[i] if cast is None else cast(line[i]) for i, cast in zip(self.col_idx, self.col_cast)])
+        except ValueError:
+            self.c["Invalid field value"]+=1
+            return None
+        self.c["Valid line parsed"]+=1
+        return line
+
     def _numeric_cast(self, val):
         """Try to cast values to int or to float"""
         if type(val)== str:
@@ -248,6 +425,319 @@ class LineParser():
         return val
 
 
+def kmer_to_code (kmer_array):
+    """Encode an array of kmers (str or bytes) as uint16 with 2 bits per base (A=0, C=1, G=2, T/U=3), after a leading 1 bit
+    marking the kmer length. Kmers containing other characters are encoded as 0. Kmers up to 7 bases are supported"""
+    kmer_array = np.asarray (kmer_array).astype("S")
+    kmer_len = kmer_array.dtype.itemsize
+    if kmer_len > 7:
+        raise NanopolishCompError ("Kmers longer than 7 bases cannot be encoded")
+
+    # Lookup table for base codes. 255 = invalid
+    base_code = np.full (256, 255, dtype=np.uint32)
+    for code, bases in enumerate ([b"Aa", b"Cc", b"Gg", b"TtUu"]):
+        for base in bases:
+            base_code[base] = code
+
+    mat = kmer_array.view(np.uint8).reshape(-1, kmer_len)
+    code_array = np.ones (len(mat), dtype=np.uint32)
+    invalid = np.zeros (len(mat), dtype=bool)
+    for i in range (kmer_len):
+        present = mat[:,i] != 0
+        col_code = base_code[mat[:,i]]
+        invalid |= present & (col_code == 255)
+        code_array = np.where (present, (code_array << 2) | (col_code & 3), code_array)
+    code_array[invalid] = 0
+    return code_array.astype(np.uint16)
+
+def code_to_kmer (code_array):
+    """Decode an array of uint16 kmer codes generated by kmer_to_code. Invalid kmers are decoded as a string of N"""
+    code_array = np.asarray (code_array, dtype=np.uint32)
+
+    # Find kmer length from the position of the leading bit
+    kmer_len = np.zeros (len(code_array), dtype=np.int64)
+    tmp = code_array.copy()
+    while np.any (tmp > 1):
+        m = tmp > 1
+        kmer_len[m] += 1
+        tmp[m] >>= 2
+    max_len = max (int(kmer_len.max()) if len(kmer_len) else 0, 1)
+
+    bases = np.frombuffer (b"ACGT", dtype=np.uint8)
+    mat = np.zeros ((len(code_array), max_len), dtype=np.uint8)
+    for i in range (max_len):
+        shift = np.clip (2*(kmer_len-1-i), 0, None).astype(np.uint32)
+        mat[:,i] = np.where (i < kmer_len, bases[(code_array >> shift) & 3], 0)
+    mat[code_array == 0] = ord("N")
+    return mat.view("S{}".format(max_len)).ravel().astype(str)
+
+# Scale factor of samples stored as int16 = 0.01 pA resolution for values up to +/- 327.67 pA
+SAMPLES_INT16_SCALE = 100
+
+def encode_samples (samples, samples_format="float32"):
+    """Encode an array of float32 samples for the binary samples file. "float32" = unchanged, "int16" = rounded values scaled by SAMPLES_INT16_SCALE"""
+    if samples_format == "float32":
+        return samples.astype(np.float32, copy=False)
+    scaled = np.round (samples.astype(np.float64)*SAMPLES_INT16_SCALE)
+    if len(scaled) and (scaled.min() < -32768 or scaled.max() > 32767):
+        raise NanopolishCompError ("Samples values out of the int16 encoding range")
+    return scaled.astype(np.int16)
+
+def decode_samples (a):
+    """Decode an array of samples generated by encode_samples to float32"""
+    if a.dtype == np.int16:
+        return (a/SAMPLES_INT16_SCALE).astype(np.float32)
+    return np.asarray (a, dtype=np.float32)
+
+class NpyWriter ():
+    """Write a 1D structured numpy array to a npy file chunk by chunk. The header is written with the first chunk and
+    updated with the final shape on close, so that the file can be memory mapped with np.load(fn, mmap_mode="r")"""
+
+    def __init__ (self, fn, default_dtype=None):
+        """"""
+        self.fn = fn
+        self.fp = open (fn, "wb")
+        self.default_dtype = default_dtype
+        self.dtype = None
+        self.n_rows = 0
+        self.header_len = 0
+
+    def __repr__ (self):
+        return "NpyWriter / file:{} / dtype:{} / rows:{}".format(self.fn, self.dtype, self.n_rows)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exception_type, exception_val, trace):
+        self.close ()
+
+    def write (self, a):
+        """Append a structured array chunk. All chunks must have the same dtype"""
+        if self.dtype is None:
+            self.dtype = a.dtype
+            self._write_header ()
+        elif a.dtype != self.dtype:
+            raise NanopolishCompError ("Inconsistent dtype between npy chunks")
+        self.fp.write (a.tobytes())
+        self.n_rows += len(a)
+
+    def close (self):
+        """Rewrite the header with the final number of rows and close the file"""
+        if self.fp.closed:
+            return
+        if self.dtype is None:
+            self.dtype = np.dtype (self.default_dtype)
+            self._write_header ()
+        self.fp.seek (0)
+        self._write_header ()
+        self.fp.close ()
+
+    def _write_header (self):
+        """Write a version 1.0 npy header padded to a fixed length with room for the final number of rows"""
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(np.lib.format.dtype_to_descr(self.dtype), self.n_rows)
+        if not self.header_len:
+            self.header_len = ((10+len(header)+21+63)//64)*64-10
+        header = header.ljust(self.header_len-1)+"\n"
+        self.fp.write (b"\x93NUMPY\x01\x00"+struct.pack("<H", self.header_len)+header.encode("latin1"))
+
+class BGZFReader (io.RawIOBase):
+    """Raw binary stream decompressing a BGZF file. Blocks are read by batches and decompressed in parallel by a pool
+    of threads, since zlib releases the GIL. Decompressed batches are returned in file order"""
+
+    def __init__ (self, fp, threads=1, batch_blocks=64):
+        """"""
+        self.fp = fp
+        self.threads = max (threads, 1)
+        self.batch_blocks = batch_blocks
+        self.executor = ThreadPoolExecutor (max_workers=self.threads)
+        self.pending = deque ()
+        self.buf = b""
+        self.buf_pos = 0
+        self.raw_eof = False
+
+    def __repr__ (self):
+        return "BGZFReader / threads:{} / blocks per batch:{}".format(self.threads, self.batch_blocks)
+
+    def readable (self):
+        return True
+
+    def readinto (self, b):
+        """Copy decompressed data in b and return the number of bytes copied. 0 at the end of file"""
+        while self.buf_pos >= len(self.buf):
+            if not self._next_batch ():
+                return 0
+        n = min (len(b), len(self.buf)-self.buf_pos)
+        b[:n] = self.buf[self.buf_pos:self.buf_pos+n]
+        self.buf_pos += n
+        return n
+
+    def close (self):
+        if not self.closed:
+            for future in self.pending:
+                future.cancel ()
+            self.executor.shutdown (wait=False)
+            self.fp.close ()
+        super().close ()
+
+    def _next_batch (self):
+        """Keep threads busy with new batches of blocks and get the next decompressed batch"""
+        while not self.raw_eof and len(self.pending) < 2*self.threads:
+            block_list = self._read_blocks ()
+            if block_list:
+                self.pending.append (self.executor.submit (self._decompress, block_list))
+        if not self.pending:
+            return False
+        self.buf = self.pending.popleft().result()
+        self.buf_pos = 0
+        return True
+
+    def _read_blocks (self):
+        """Read up to batch_blocks complete compressed blocks. Return a list of (compressed data, uncompressed size)"""
+        block_list = []
+        for _ in range (self.batch_blocks):
+            block = read_bgzf_block (self.fp)
+            if not block:
+                self.raw_eof = True
+                break
+            block_list.append (block)
+        return block_list
+
+    @staticmethod
+    def _decompress (block_list):
+        """Decompress a list of raw deflate blocks and join them"""
+        out_list = []
+        for cdata, isize in block_list:
+            out = zlib.decompress (cdata, -15)
+            if len(out) != isize:
+                raise NanopolishCompError ("Invalid BGZF block size")
+            out_list.append (out)
+        return b"".join (out_list)
+
+class BGZFWriter ():
+    """Write a BGZF file. Data is cut in blocks of BLOCK_SIZE uncompressed bytes, compressed in parallel by a pool of threads
+    and written in order. Positions are tracked as uncompressed offsets, which can be converted to BGZF virtual offsets
+    once the block containing them is written"""
+
+    BLOCK_SIZE = 65280
+
+    def __init__ (self, fn, threads=1, level=6):
+        """"""
+        self.fn = fn
+        self.fp = open (fn, "wb")
+        self.threads = max (threads, 1)
+        self.level = level
+        self.executor = ThreadPoolExecutor (max_workers=self.threads)
+        self.pending = deque ()
+        self.buf = bytearray ()
+        self.uncompressed_offset = 0
+        self.compressed_offset = 0
+        # Compressed start offset of each block written
+        self.block_start = array.array ("Q")
+
+    def __repr__ (self):
+        return "BGZFWriter / file:{} / threads:{} / blocks written:{}".format(self.fn, self.threads, len(self.block_start))
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exception_type, exception_val, trace):
+        self.close ()
+
+    def write (self, data):
+        """Append str or bytes data"""
+        if isinstance (data, str):
+            data = data.encode ()
+        self.buf += data
+        self.uncompressed_offset += len(data)
+        while len(self.buf) >= self.BLOCK_SIZE:
+            self._submit (bytes(self.buf[:self.BLOCK_SIZE]))
+            del self.buf[:self.BLOCK_SIZE]
+
+    def tell (self):
+        """Current uncompressed offset"""
+        return self.uncompressed_offset
+
+    def virtual_offset (self, offset):
+        """Convert an uncompressed offset to a virtual offset. Return None if the corresponding block is not written yet"""
+        block_idx, block_offset = divmod (offset, self.BLOCK_SIZE)
+        if block_idx >= len(self.block_start):
+            return None
+        return self.block_start[block_idx] << 16 | block_offset
+
+    def close (self):
+        """Compress remaining data, write all blocks followed by the BGZF EOF block"""
+        if self.fp.closed:
+            return
+        if self.buf:
+            self._submit (bytes(self.buf))
+            self.buf = bytearray ()
+        while self.pending:
+            self._write_next ()
+        self.fp.write (self._compress (b"", self.level))
+        self.executor.shutdown ()
+        self.fp.close ()
+
+    def _submit (self, data):
+        """Queue a block for compression and write the oldest ones when enough are pending"""
+        self.pending.append (self.executor.submit (self._compress, data, self.level))
+        while len(self.pending) > 2*self.threads:
+            self._write_next ()
+
+    def _write_next (self):
+        """Write the oldest compressed block"""
+        block = self.pending.popleft().result()
+        self.block_start.append (self.compressed_offset)
+        self.fp.write (block)
+        self.compressed_offset += len(block)
+
+    @staticmethod
+    def _compress (data, level):
+        """Compress data in a single BGZF block"""
+        compressor = zlib.compressobj (level, zlib.DEFLATED, -15)
+        cdata = compressor.compress (data)+compressor.flush ()
+        header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"+struct.pack ("<H", len(cdata)+25)
+        return header+cdata+struct.pack ("<II", zlib.crc32(data), len(data))
+
+def read_bgzf_block (fp):
+    """Read the next BGZF block of a binary file object. Return (compressed data, uncompressed size) or None at the end of file"""
+    header = fp.read (12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:2] != b"\x1f\x8b" or not header[3] & 4:
+        raise NanopolishCompError ("Invalid BGZF block header")
+    xlen = struct.unpack ("<H", header[10:12])[0]
+    extra = fp.read (xlen)
+
+    # Find block size in the BC subfield
+    bsize = None
+    i = 0
+    while i+4 <= len(extra):
+        slen = struct.unpack ("<H", extra[i+2:i+4])[0]
+        if extra[i:i+2] == b"BC" and slen == 2:
+            bsize = struct.unpack ("<H", extra[i+4:i+6])[0]
+        i += 4+slen
+    if bsize is None:
+        raise NanopolishCompError ("Invalid BGZF block without BC subfield")
+
+    data = fp.read (bsize-xlen-11)
+    if len(data) != bsize-xlen-11:
+        raise NanopolishCompError ("Truncated BGZF block")
+    return data[:-8], struct.unpack ("<I", data[-4:])[0]
+
+def bgzf_read (fp, virtual_offset, length):
+    """Read length uncompressed bytes of a BGZF binary file object starting from a virtual offset"""
+    fp.seek (virtual_offset >> 16)
+    start = virtual_offset & 0xFFFF
+    block_l = []
+    data_len = 0
+    while data_len < start+length:
+        block = read_bgzf_block (fp)
+        if not block:
+            break
+        block_l.append (BGZFReader._decompress ([block]))
+        data_len += len(block_l[-1])
+    return b"".join (block_l)[start:start+length]
+
 #~~~~~~~~~~~~~~CUSTOM EXCEPTION AND WARN CLASSES~~~~~~~~~~~~~~#
 class NanopolishCompError (Exception):
     """ Basic exception class for NanopolishComp package """
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~IMPORTS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+# Standard library imports
+import random
+import gzip
+import zlib
+import struct
+from collections import *
+
+# Third party imports
+import numpy as np
+
+# Local imports
+from NanopolishComp.Eventalign_collapse_reader import Eventalign_collapse_reader
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~FUNCTIONS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+# Index fields depending on the file layout rather than on the read content
+OFFSET_FIELDS = ["samples_offset", "samples_len", "byte_offset", "byte_len", "virtual_offset", "row_offset", "row_len", "shard"]
+
+def write_eventalign (fn, n_reads=40, seed=1, samples=True, read_names=True, dup_reads=0, max_kmers=60):
+    """
+    Write a synthetic nanopolish eventalign file. The first dup_reads reads are aligned a second time on another reference
+    """
+    rand = random.Random (seed)
+    header = ["contig", "position", "reference_kmer", "read_name" if read_names else "read_index", "strand", "event_index",
+        "event_level_mean", "event_stdv", "event_length", "model_kmer", "model_mean", "model_stdv", "standardized_level", "start_idx", "end_idx"]
+    if samples:
+        header.append ("samples")
+
+    alignment_list = []
+    for r in range (n_reads):
+        read_id = "{:08x}-aaaa-bbbb-cccc-{:012x}".format(rand.getrandbits(32), r) if read_names else str(r)
+        alignment_list.append ((read_id, "tx_{}".format(rand.randint(0, 5))))
+        if r < dup_reads:
+            alignment_list.append ((read_id, "txDUP"))
+
+    event_idx = 0
+    with open (fn, "w") as fp:
+        fp.write ("\t".join(header)+"\n")
+        for read_id, contig in alignment_list:
+            pos = rand.randint (0, 5000)
+            start_idx = rand.randint (1000, 100000)
+            for _ in range (rand.randint (1, max_kmers)):
+                kmer = "".join (rand.choice ("ACGT") for _ in range(5))
+                for _ in range (rand.choice ([1, 1, 1, 2, 3])):
+                    model_kmer = kmer
+                    x = rand.random ()
+                    if x < 0.1:
+                        model_kmer = "NNNNN"
+                    elif x < 0.2:
+                        model_kmer = "".join (rand.choice ("ACGT") for _ in range(5))
+                    n_samples = rand.randint (1, 12)
+                    line = [contig, str(pos), kmer, read_id, "t", str(event_idx),
+                        "{:.2f}".format(rand.uniform(60, 130)), "{:.3f}".format(rand.uniform(1, 8)), "{:.5f}".format(n_samples/3012.0),
+                        model_kmer, "{:.2f}".format(rand.uniform(60, 130)), "2.5", "0.5", str(start_idx), str(start_idx+n_samples)]
+                    if samples:
+                        line.append (",".join ("{:.4g}".format(rand.uniform(60, 130)) for _ in range(n_samples)))
+                    start_idx += n_samples
+                    event_idx += 1
+                    fp.write ("\t".join(line)+"\n")
+                pos += rand.choice ([1, 1, 1, 1, 2, 3])
+    return fn
+
+def write_meth_calls (fn, fai_fn=None, n_reads=3000, seed=1):
+    """Write a synthetic nanopolish call-methylation file and optionally the fasta index of its chromosomes"""
+    rand = random.Random (seed)
+    chrom_list = [("chr-II", 50000), ("chr-I", 40000), ("chr-X", 30000)]
+    if fai_fn:
+        with open (fai_fn, "w") as fp:
+            for chrom, length in chrom_list:
+                fp.write ("{}\t{}\t0\t60\t61\n".format(chrom, length))
+
+    with open (fn, "w") as fp:
+        fp.write ("chromosome\tstrand\tstart\tend\tread_name\tlog_lik_ratio\tlog_lik_methylated\tlog_lik_unmethylated\tnum_calling_strands\tnum_motifs\tsequence\n")
+        for r in range (n_reads):
+            chrom, length = rand.choice (chrom_list)
+            strand = rand.choice ("+-")
+            pos = rand.randint (0, length-5000)
+            for _ in range (rand.randint (5, 60)):
+                pos += rand.randint (5, 120)
+                end, num_motifs = pos, 1
+                if rand.random () < 0.1:
+                    end, num_motifs = pos+rand.randint(1, 10), rand.randint(2, 3)
+                llr = round (rand.gauss (-1, 4), 2)
+                line = [chrom, strand, pos, end, "read_{}".format(r), llr, round(-100+llr/2, 2), round(-100-llr/2, 2), 1, num_motifs,
+                    "".join (rand.choice ("ACGT") for _ in range(11))]
+                fp.write ("\t".join(map(str, line))+"\n")
+                pos = end
+    return fn
+
+def compress_file (fn, out_fn, compression, block_size=4096):
+    """
+    Compress a file with gzip or with BGZF blocks of block_size uncompressed bytes. BGZF blocks are built here with zlib, independently
+    of the package writer
+    """
+    with open (fn, "rb") as fp:
+        data = fp.read ()
+    if compression == "gzip":
+        with gzip.open (out_fn, "wb") as fp:
+            fp.write (data)
+        return out_fn
+
+    with open (out_fn, "wb") as fp:
+        for start in list (range (0, len(data), block_size))+[len(data)]:
+            block = data[start:start+block_size]
+            compressor = zlib.compressobj (6, zlib.DEFLATED, -15)
+            cdata = compressor.compress (block)+compressor.flush ()
+            fp.write (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"+struct.pack ("<H", len(cdata)+25))
+            fp.write (cdata+struct.pack ("<II", zlib.crc32(block), len(block)))
+    return out_fn
+
+def collapsed_reads (data_fn):
+    """Load all the reads of an Eventalign_collapse output in a dict keyed by (read_id, ref_id, ref_start) of (index fields, read array)"""
+    read_d = OrderedDict ()
+    with Eventalign_collapse_reader (data_fn, quiet=True) as reader:
+        for i in range (len(reader)):
+            info = OrderedDict ((field, a[i]) for field, a in reader.idx.items() if not field in OFFSET_FIELDS)
+            read_d[(info["read_id"], info["ref_id"], info["ref_start"])] = (info, reader._read_array (i))
+    return read_d
+
+def assert_same_reads (data_fn1, data_fn2, fields=None, rtol=0):
+    """Check that 2 Eventalign_collapse outputs contain the same reads. Numeric fields are compared with rtol if given"""
+    read_d1 = collapsed_reads (data_fn1)
+    read_d2 = collapsed_reads (data_fn2)
+    assert read_d1.keys() == read_d2.keys()
+    for key, (info1, read_a1) in read_d1.items():
+        info2, read_a2 = read_d2[key]
+        assert list(info1.items()) == list(info2.items())
+        assert len(read_a1) == len(read_a2)
+        for field in fields or read_a1.dtype.names:
+            a1, a2 = read_a1[field], read_a2[field]
+            if rtol and np.issubdtype (a1.dtype, np.number):
+                assert np.allclose (a1, a2, rtol=rtol, equal_nan=True), "{} {}".format(key, field)
+            else:
+                np.testing.assert_array_equal (a1, a2, err_msg="{} {}".format(key, field))
+    return read_d1
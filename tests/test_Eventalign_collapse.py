@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+
+# Standard library imports
+import os
+import sys
+import json
+import subprocess
+
+# Third party imports
+import pytest
+import numpy as np
+
+# Local imports
+from NanopolishComp.common import *
+from NanopolishComp.Eventalign_collapse import Eventalign_collapse, BlockParser
+from NanopolishComp.Eventalign_collapse_reader import Eventalign_collapse_reader
+from helpers import write_eventalign, collapsed_reads, assert_same_reads, compress_file
+
+ALL_STAT_FIELDS = ["mean", "std", "median", "mad", "num_signals"]
+
+# Synthetic inputs. The first reads are aligned on 2 references
+INPUT_D = {
+    "samples": dict (samples=True, read_names=True),
+    "nosamples": dict (samples=False, read_names=True),
+    "read_index": dict (samples=True, read_names=False)}
+
+def collapse (input_fn, outdir, outprefix, **kwargs):
+    """Run Eventalign_collapse with all the stat fields and return the path of the data file"""
+    kwargs.setdefault ("threads", 3)
+    Eventalign_collapse (input_fn, outdir=str(outdir), outprefix=outprefix, stat_fields=ALL_STAT_FIELDS, quiet=True, **kwargs)
+    ext = "npy" if kwargs.get ("output_format") == "npy" else "tsv.gz" if kwargs.get ("compress_output") else "tsv"
+    if kwargs.get ("writers", 1) > 1:
+        ext+= ".manifest"
+    return str(outdir/"{}_eventalign_collapse.{}".format(outprefix, ext))
+
+def input_read_order (input_fn):
+    """List of (read_id, ref_id) in input order"""
+    read_list = []
+    with open (input_fn) as fp:
+        fp.readline ()
+        for line in fp:
+            field_l = line.split ("\t", 4)
+            if not read_list or read_list[-1] != (field_l[3], field_l[0]):
+                read_list.append ((field_l[3], field_l[0]))
+    return read_list
+
+@pytest.fixture (scope="module")
+def baseline (tmp_path_factory):
+    """Input files and output of the default line parser path for each synthetic input"""
+    outdir = tmp_path_factory.mktemp ("collapse")
+    baseline_d = {}
+    for name, input_kwargs in INPUT_D.items():
+        input_fn = write_eventalign (str(outdir/"{}.tsv".format(name)), dup_reads=2, **input_kwargs)
+        baseline_d[name] = (input_fn, collapse (input_fn, outdir, "baseline_"+name))
+    return baseline_d
+
+@pytest.mark.parametrize ("name", INPUT_D.keys())
+def test_vectorized_parser (baseline, tmp_path, name):
+    input_fn, baseline_fn = baseline[name]
+    assert_same_reads (baseline_fn, collapse (input_fn, tmp_path, "out", vectorized_parser=True))
+
+@pytest.mark.parametrize ("block_size", [100, 1000, 4096])
+def test_block_parser (baseline, block_size):
+    """Reads are the same whatever the block size, including reads spanning several blocks"""
+    input_fn, baseline_fn = baseline["samples"]
+    idx = OrderedDict ([("ref_id", 0), ("read_id", 3), ("ref_pos", 1), ("ref_kmer", 2), ("mod_kmer", 9), ("event_len", 8), ("samples", 15)])
+    read_list = []
+    for size in [block_size, 16*1024*1024]:
+        with open (input_fn, "rb") as fp:
+            fp.readline ()
+            read_list.append ([(read_id, ref_id, read_a["events"], read_a["sample_text"]) for read_id, ref_id, read_a in BlockParser (idx, 16, size) (fp)])
+    assert len(read_list[0]) == len(read_list[1]) == 42
+    for read1, read2 in zip (*read_list):
+        assert read1[:2] == read2[:2]
+        assert np.array_equal (read1[2], read2[2]) and read1[3] == read2[3]
+
+@pytest.mark.parametrize ("name", INPUT_D.keys())
+@pytest.mark.parametrize ("threads", [3, 6])
+def test_shard_input (baseline, tmp_path, name, threads):
+    input_fn, baseline_fn = baseline[name]
+    assert_same_reads (baseline_fn, collapse (input_fn, tmp_path, "out", shard_input=True, threads=threads))
+
+@pytest.mark.parametrize ("batch", [dict (batch_reads=7), dict (batch_reads=1000), dict (batch_reads=50, batch_bytes=2000)])
+def test_batch (baseline, tmp_path, batch):
+    """Batching reads in queue messages does not change the output"""
+    input_fn, baseline_fn = baseline["samples"]
+    assert_same_reads (baseline_fn, collapse (input_fn, tmp_path, "out", **batch))
+    with open (tmp_path/"out_eventalign_collapse.log") as fp:
+        assert "out_q_batches" in fp.read ()
+
+@pytest.mark.parametrize ("max_memory", ["4K", "1M"])
+def test_max_memory (baseline, tmp_path, max_memory):
+    """Bounding the memory in flight does not change the output, even with reads larger than the budget"""
+    input_fn, baseline_fn = baseline["samples"]
+    assert_same_reads (baseline_fn, collapse (input_fn, tmp_path, "out", max_memory=max_memory, batch_reads=5))
+    with open (tmp_path/"out_eventalign_collapse.log") as fp:
+        assert "max_memory_bytes: {}".format(parse_size (max_memory)) in fp.read ()
+
+@pytest.mark.parametrize ("options", [dict (reorder_buffer=3), dict (reorder_buffer=1000, vectorized_parser=True, batch_reads=4)])
+def test_ordered (baseline, tmp_path, options):
+    """Reads are written in input order"""
+    input_fn, baseline_fn = baseline["samples"]
+    data_fn = collapse (input_fn, tmp_path, "out", ordered=True, threads=6, **options)
+    assert_same_reads (baseline_fn, data_fn)
+    with Eventalign_collapse_reader (data_fn, quiet=True) as reader:
+        i_list = np.argsort (reader.offset)
+        assert list (zip (reader.idx["read_id"][i_list], reader.idx["ref_id"][i_list])) == input_read_order (input_fn)
+
+@pytest.mark.parametrize ("name", INPUT_D.keys())
+def test_npy_output (baseline, tmp_path, name):
+    """npy output contains the tsv values cast to the npy dtypes"""
+    input_fn, baseline_fn = baseline[name]
+    data_fn = collapse (input_fn, tmp_path, "out", output_format="npy")
+    assert_same_reads (baseline_fn, data_fn, rtol=1e-6)
+    a = np.load (data_fn, mmap_mode="r")
+    assert a.dtype.names == tuple (field for field in Eventalign_collapse.NPY_DTYPE.keys() if field in a.dtype.names)
+    assert a["ref_kmer"].dtype == np.uint16
+
+@pytest.mark.parametrize ("vectorized_parser", [False, True])
+def test_sample_stats (baseline, tmp_path, vectorized_parser):
+    """Kmer statistics are the values of numpy functions called on the float32 samples of each kmer"""
+    input_fn, baseline_fn = baseline["samples"]
+    data_fn = collapse (input_fn, tmp_path, "out", write_samples=True, vectorized_parser=vectorized_parser)
+    assert_same_reads (baseline_fn, data_fn, fields=ALL_STAT_FIELDS)
+    for info, read_a in collapsed_reads (data_fn).values():
+        for kmer in read_a:
+            samples = np.array (kmer["samples"].split(","), dtype=np.float64).astype(np.float32)
+            median = np.median (samples)
+            assert kmer["num_signals"] == len(samples)
+            assert np.float32 (kmer["mean"]) == np.mean (samples)
+            assert np.float32 (kmer["std"]) == np.std (samples)
+            assert np.float32 (kmer["median"]) == median
+            assert np.float32 (kmer["mad"]) == np.median (np.abs (samples-median))
+
+@pytest.mark.parametrize ("name", INPUT_D.keys())
+@pytest.mark.parametrize ("max_chunk_events", [1, 7, 40])
+def test_chunks (baseline, tmp_path, name, max_chunk_events):
+    """Reads collapsed by chunks are the same as reads collapsed at once"""
+    input_fn, baseline_fn = baseline[name]
+    assert_same_reads (baseline_fn, collapse (input_fn, tmp_path, "out", max_chunk_events=max_chunk_events, threads=4))
+
+def test_chunks_samples_file (baseline, tmp_path):
+    """Samples offsets of reads collapsed by chunks point to the same samples"""
+    input_fn, baseline_fn = baseline["samples"]
+    data_fn = collapse (input_fn, tmp_path, "chunks", max_chunk_events=7, write_samples=True, samples_format="float32")
+    ref_fn = collapse (input_fn, tmp_path, "ref", write_samples=True, samples_format="float32")
+    assert_same_reads (ref_fn, data_fn)
+    with Eventalign_collapse_reader (data_fn, quiet=True) as reader, Eventalign_collapse_reader (ref_fn, quiet=True) as ref_reader:
+        for read_id, ref_id in zip (reader.read_ids, reader.idx["ref_id"]):
+            assert np.array_equal (reader.get_samples (read_id, ref_id), ref_reader.get_samples (read_id, ref_id))
+
+def pooled_event_stats (input_fn):
+    """Length weighted pooled mean and std of the events of each kmer, keyed by (read_id, ref_id, ref_pos)"""
+    event_d = defaultdict (list)
+    with open (input_fn) as fp:
+        fp.readline ()
+        for line in fp:
+            field_l = line.split ("\t")
+            event_d[(field_l[3], field_l[0], int(field_l[1]))].append ([float(field_l[i]) for i in (6, 7, 8)])
+    stat_d = {}
+    for key, event_list in event_d.items():
+        mean, std, w = np.array (event_list).T
+        pooled_mean = np.sum (w*mean)/np.sum (w)
+        stat_d[key] = (pooled_mean, np.sqrt (np.sum (w*(std*std+(mean-pooled_mean)**2))/np.sum (w)))
+    return stat_d
+
+@pytest.mark.parametrize ("name", ["samples", "nosamples"])
+def test_event_stats (baseline, tmp_path, name):
+    """Kmer mean and std computed from the event level fields are the length weighted pooled values of the kmer events"""
+    input_fn, baseline_fn = baseline[name]
+    data_fn = collapse (input_fn, tmp_path, "line", event_stats=True)
+    assert_same_reads (data_fn, collapse (input_fn, tmp_path, "vectorized", event_stats=True, vectorized_parser=True))
+    stat_d = pooled_event_stats (input_fn)
+    read_d = collapsed_reads (data_fn)
+    assert len(read_d) == 42
+    for info, read_a in read_d.values():
+        assert not "median" in read_a.dtype.names and not "num_signals" in read_a.dtype.names
+        for kmer in read_a:
+            mean, std = stat_d[(info["read_id"], info["ref_id"], kmer["ref_pos"])]
+            assert np.isclose (kmer["mean"], mean, rtol=1e-6) and np.isclose (kmer["std"], std, rtol=1e-6)
+
+@pytest.mark.parametrize ("compression", ["gzip", "bgzf"])
+@pytest.mark.parametrize ("vectorized_parser", [False, True])
+def test_compressed_input (baseline, tmp_path, compression, vectorized_parser):
+    input_fn, baseline_fn = baseline["samples"]
+    compressed_fn = compress_file (input_fn, str(tmp_path/"input.tsv.gz"), compression)
+    assert_same_reads (baseline_fn, collapse (compressed_fn, tmp_path, "out", vectorized_parser=vectorized_parser, decompress_threads=3))
+    with pytest.raises (ValueError):
+        collapse (compressed_fn, tmp_path, "shard", shard_input=True)
+
+@pytest.mark.parametrize ("options", [dict (), dict (ordered=True, write_samples=True)])
+def test_compress_output (baseline, tmp_path, options):
+    """BGZF compressed output contains the same reads, accessed through virtual offsets, as the uncompressed output"""
+    input_fn, baseline_fn = baseline["samples"]
+    plain_fn = collapse (input_fn, tmp_path, "plain", **options)
+    data_fn = collapse (input_fn, tmp_path, "compressed", compress_output=True, compress_threads=3, **options)
+    assert data_fn.endswith (".tsv.gz") and input_compression (data_fn) == "bgzf"
+    assert_same_reads (plain_fn, data_fn)
+    with Eventalign_collapse_reader (data_fn, quiet=True) as reader:
+        assert "virtual_offset" in reader.idx
+    if options.get ("ordered"):
+        with open (plain_fn, "rb") as plain_fp, open_input (data_fn, "rb") as fp:
+            assert fp.read () == plain_fp.read ()
+
+@pytest.mark.parametrize ("options", [dict (samples_format="float32"), dict (samples_format="int16"), dict (samples_format="float32", output_format="npy")])
+def test_samples_file (baseline, tmp_path, options):
+    """Samples of each kmer read from the binary samples file are the samples of the text output"""
+    input_fn, baseline_fn = baseline["samples"]
+    text_d = collapsed_reads (collapse (input_fn, tmp_path, "text", write_samples=True))
+    data_fn = collapse (input_fn, tmp_path, "binary", write_samples=True, **options)
+    assert_same_reads (baseline_fn, data_fn, fields=ALL_STAT_FIELDS, rtol=1e-6 if options.get ("output_format") else 0)
+    atol = 0.5/SAMPLES_INT16_SCALE+1e-4 if options["samples_format"] == "int16" else 0
+    with Eventalign_collapse_reader (data_fn, quiet=True) as reader:
+        for read_id, ref_id in zip (reader.read_ids, reader.idx["ref_id"]):
+            samples = reader.get_samples (read_id, ref_id)
+            read_a = reader.get_read (read_id, ref_id)
+            text_a = text_d[(read_id, ref_id, read_a["ref_pos"][0])][1]
+            assert samples.dtype == np.float32 and len(samples) == read_a["samples_count"].sum()
+            for kmer, text_kmer in zip (read_a, text_a):
+                expected = np.array (text_kmer["samples"].split(","), dtype=np.float64).astype(np.float32)
+                kmer_samples = samples[kmer["samples_offset"]:kmer["samples_offset"]+kmer["samples_count"]]
+                assert np.allclose (kmer_samples, expected, rtol=0, atol=atol)
+
+def interrupt_output (data_fn, n_reads, partial_data, partial_idx):
+    """
+    Truncate an output as if the run had been killed after writing n_reads reads. partial_data bytes of the next record are left in the data
+    file and partial_idx bytes of its index line, or the full line if None
+    """
+    with open (data_fn+".idx", "rb") as fp:
+        header = fp.readline ()
+        line_list = fp.readlines ()
+    offset, length = map (int, line_list[n_reads].split(b"\t")[-2:])
+    assert partial_data < length
+    with open (data_fn, "rb+") as fp:
+        fp.truncate (offset+partial_data)
+    with open (data_fn+".idx", "wb") as fp:
+        fp.write (header+b"".join (line_list[:n_reads])+line_list[n_reads][:partial_idx])
+
+@pytest.mark.parametrize ("interruption", [(0, 0, 0), (10, 0, 0), (10, 120, 0), (25, 50, 12), (25, 50, None), (41, 0, 0)])
+@pytest.mark.parametrize ("options", [dict (), dict (vectorized_parser=True), dict (shard_input=True)])
+def test_resume (baseline, tmp_path, interruption, options):
+    """Resuming an interrupted run gives the same reads as an uninterrupted run"""
+    input_fn, baseline_fn = baseline["samples"]
+    data_fn = collapse (input_fn, tmp_path, "out", ordered=not options.get ("shard_input"), **options)
+    n_reads, partial_data, partial_idx = interruption
+    interrupt_output (data_fn, n_reads, partial_data, partial_idx)
+    collapse (input_fn, tmp_path, "out", resume=True, **options)
+    assert_same_reads (baseline_fn, data_fn)
+    with open (tmp_path/"out_eventalign_collapse.log") as fp:
+        assert "skipped_reads: {}".format(n_reads) in fp.read ()
+
+@pytest.mark.parametrize ("options", [dict (), dict (vectorized_parser=True), dict (shard_input=True), dict (shm_buffer="64K")])
+def test_resume_skipped_reads_not_parsed (baseline, tmp_path, options):
+    """Only the ids of the lines of skipped reads are parsed, so that invalid values in these lines are not detected"""
+    input_fn, baseline_fn = baseline["samples"]
+    data_fn = collapse (input_fn, tmp_path, "out", ordered=True)
+    interrupt_output (data_fn, 10, 0, 0)
+    with open (data_fn+".idx") as fp:
+        fp.readline ()
+        done_reads = set ((field_l[3], field_l[0]) for field_l in (line.split("\t") for line in fp))
+    resume_fn = str(tmp_path/"resume.tsv")
+    with open (input_fn) as fp, open (resume_fn, "w") as out_fp:
+        out_fp.write (fp.readline ())
+        for line in fp:
+            field_l = line.split ("\t")
+            if (field_l[3], field_l[0]) in done_reads:
+                field_l[1] = field_l[8] = "invalid"
+            out_fp.write ("\t".join (field_l))
+    collapse (resume_fn, tmp_path, "out", resume=True, **options)
+    assert_same_reads (baseline_fn, data_fn)
+
+def test_resume_no_output (baseline, tmp_path):
+    input_fn, baseline_fn = baseline["samples"]
+    assert_same_reads (baseline_fn, collapse (input_fn, tmp_path, "out", resume=True))
+    with pytest.raises (ValueError):
+        collapse (input_fn, tmp_path, "out", resume=True, compress_output=True)
+
+def split_input (input_fn, outdir, n_parts):
+    """Split an eventalign file in n_parts files at read boundaries, each with the header line. Return the list of paths"""
+    with open (input_fn) as fp:
+        header = fp.readline ()
+        lines = fp.readlines ()
+    read_list = [(field_l[3], field_l[0]) for field_l in (line.split("\t", 4) for line in lines)]
+    bounds = [0]+[i for i in range (1, len(lines)) if read_list[i] != read_list[i-1]][::len(set(read_list))//n_parts+1][1:]+[len(lines)]
+    fn_list = []
+    for i, (start, end) in enumerate (zip (bounds[:-1], bounds[1:])):
+        fn_list.append (str(outdir/"part_{}.tsv".format(i)))
+        with open (fn_list[-1], "w") as fp:
+            fp.write (header+"".join (lines[start:end]))
+    return fn_list
+
+@pytest.mark.parametrize ("vectorized_parser", [False, True])
+def test_multiple_inputs (baseline, tmp_path, vectorized_parser):
+    """Reads of several inputs are written in a single output with the reads count of each input in the log"""
+    input_fn, baseline_fn = baseline["samples"]
+    fn_list = split_input (input_fn, tmp_path, 3)
+    assert len(fn_list) == 3
+    assert_same_reads (baseline_fn, collapse (fn_list, tmp_path, "out", threads=6, vectorized_parser=vectorized_parser))
+    with open (tmp_path/"out_eventalign_collapse.log") as fp:
+        log = fp.read ()
+    for fn in fn_list:
+        assert "{}: {} reads".format(fn, len (input_read_order (fn))) in log
+    with pytest.raises (ValueError):
+        collapse (fn_list, tmp_path, "out", threads=4)
+
+def test_multiple_inputs_named_pipes (baseline, tmp_path):
+    """Inputs can be named pipes. The pipes are written by other processes, so that the readers do not inherit their write end"""
+    input_fn, baseline_fn = baseline["samples"]
+    fifo_list = []
+    ps_list = []
+    for i, fn in enumerate (split_input (input_fn, tmp_path, 2)):
+        fifo_list.append (str(tmp_path/"fifo_{}".format(i)))
+        os.mkfifo (fifo_list[-1])
+        ps_list.append (subprocess.Popen ("cat {} > {}".format(fn, fifo_list[-1]), shell=True))
+    assert_same_reads (baseline_fn, collapse (fifo_list, tmp_path, "out", threads=5))
+    for ps in ps_list:
+        assert ps.wait () == 0
+
+@pytest.mark.parametrize ("shm_buffer", ["8K", "64K", "4M"])
+def test_shm_buffer (baseline, tmp_path, shm_buffer):
+    """Reads passed through the shared memory buffer are the same, including reads larger than a slot and read through a named pipe"""
+    input_fn, baseline_fn = baseline["samples"]
+    assert_same_reads (baseline_fn, collapse (input_fn, tmp_path, "out", shm_buffer=shm_buffer))
+    fifo = str(tmp_path/"fifo")
+    os.mkfifo (fifo)
+    ps = subprocess.Popen ("cat {} > {}".format(input_fn, fifo), shell=True)
+    assert_same_reads (baseline_fn, collapse (fifo, tmp_path, "fifo", shm_buffer=shm_buffer, threads=4))
+    assert ps.wait () == 0
+
+@pytest.mark.parametrize ("max_memory", ["1K", "64K"])
+def test_shm_buffer_max_memory (baseline, tmp_path, max_memory):
+    """Reads larger than a slot sent through the queue are counted in max_memory, even when a single one exceeds it"""
+    input_fn, baseline_fn = baseline["samples"]
+    assert_same_reads (baseline_fn, collapse (input_fn, tmp_path, "out", shm_buffer="8K", max_memory=max_memory))
+    with open (tmp_path/"out_eventalign_collapse.log") as fp:
+        assert "max_memory_bytes: {}".format(parse_size (max_memory)) in fp.read ()
+
+def test_shm_buffer_multiple_inputs (baseline, tmp_path):
+    input_fn, baseline_fn = baseline["read_index"]
+    fn_list = split_input (input_fn, tmp_path, 3)
+    n_reads_list = [len (input_read_order (fn)) for fn in fn_list]
+    fn_list[1] = compress_file (fn_list[1], fn_list[1]+".gz", "bgzf")
+    assert_same_reads (baseline_fn, collapse (fn_list, tmp_path, "out", shm_buffer="32K", threads=6))
+    with open (tmp_path/"out_eventalign_collapse.log") as fp:
+        log = fp.read ()
+    for fn, n_reads in zip (fn_list, n_reads_list):
+        assert "{}: {} reads".format(fn, n_reads) in log
+
+def test_shm_buffer_stdin (baseline, tmp_path):
+    """Command line run reading the input from stdin"""
+    input_fn, baseline_fn = baseline["nosamples"]
+    cmd = [sys.executable, "-c", "from NanopolishComp.__main__ import main; main()", "Eventalign_collapse", "-i", "0", "-o", str(tmp_path),
+        "-p", "out", "--stat_fields"]+ALL_STAT_FIELDS+["--shm_buffer", "64K", "--threads", "3", "--quiet"]
+    with open (input_fn, "rb") as fp:
+        subprocess.run (cmd, stdin=fp, check=True, cwd=os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+    assert_same_reads (baseline_fn, str(tmp_path/"out_eventalign_collapse.tsv"))
+
+@pytest.mark.parametrize ("options", [dict (writers=2), dict (writers=3, shard_input=True), dict (writers=2, output_format="npy"),
+    dict (writers=2, compress_output=True), dict (writers=2, write_samples=True, samples_format="float32")])
+def test_writers (baseline, tmp_path, options):
+    """Reads written by several writers are read back through the manifest as a single output, each read in a single shard"""
+    input_fn, baseline_fn = baseline["samples"]
+    data_fn = collapse (input_fn, tmp_path, "out", threads=6, **options)
+    assert_same_reads (baseline_fn, data_fn, fields=ALL_STAT_FIELDS, rtol=1e-6 if options.get ("output_format") else 0)
+    with open (data_fn) as fp:
+        assert len (fp.readlines ()) == options["writers"]+1
+    with open (tmp_path/"out_eventalign_collapse.log") as fp:
+        log = fp.read ()
+    with Eventalign_collapse_reader (data_fn, quiet=True) as reader:
+        assert len(reader) == 42
+        # The log records the reads written by each writer
+        for writer_id in range (options["writers"]):
+            assert "{}: {} reads".format(os.path.basename (data_fn[:-len(".manifest")]).replace (".", ".{}.".format(writer_id), 1),
+                np.sum (reader.shard == writer_id)) in log
+        if options.get ("write_samples"):
+            for read_id, ref_id in zip (reader.read_ids, reader.idx["ref_id"]):
+                assert len (reader.get_samples (read_id, ref_id)) == reader.get_read_info (read_id, ref_id)["samples_len"]
+
+@pytest.mark.parametrize ("options", [dict (), dict (vectorized_parser=True), dict (max_chunk_events=5), dict (shard_input=True), dict (shm_buffer="64K")])
+def test_metrics (baseline, tmp_path, options):
+    """Metrics samples are written as JSON lines and summarized in the log, without changing the output"""
+    input_fn, baseline_fn = baseline["samples"]
+    assert_same_reads (baseline_fn, collapse (input_fn, tmp_path, "out", metrics_interval=0.05, **options))
+    with open (tmp_path/"out_eventalign_collapse.metrics.jsonl") as fp:
+        sample_list = [json.loads (line) for line in fp]
+    assert sample_list
+    assert [sample_d["elapsed_s"] for sample_d in sample_list] == sorted (sample_d["elapsed_s"] for sample_d in sample_list)
+    # The last sample is taken once all the reads are written
+    assert sample_list[-1]["writer_reads"] == 42
+    assert sample_list[-1]["worker_reads"] == 42
+    # Reads and events are counted for the readers in all modes, except when the workers read the input directly
+    with open (input_fn) as fp:
+        n_events = len (fp.readlines ())-1
+    assert sample_list[-1]["reader_reads"] == (0 if options.get ("shard_input") else 42)
+    assert sample_list[-1]["reader_events"] == (0 if options.get ("shard_input") else n_events)
+    # Header lines and the last line of the data file are not counted in the bytes written
+    data_fn = str(tmp_path/"out_eventalign_collapse.tsv")
+    with open (data_fn+".idx") as fp:
+        idx_header_len = len (fp.readline ())
+    assert sample_list[-1]["writer_bytes"] == os.path.getsize (data_fn)-len("#\n")+os.path.getsize (data_fn+".idx")-idx_header_len
+    for sample_d in sample_list:
+        assert 0 <= sample_d["worker_busy_fraction"] and sample_d["in_q_depth"] >= 0 and sample_d["out_q_depth"] >= 0
+    with open (tmp_path/"out_eventalign_collapse.log") as fp:
+        assert "Pipeline metrics:" in fp.read ()
+
+@pytest.mark.parametrize ("options", [dict (threads=4), dict (threads=6, vectorized_parser=True, max_memory="1M"), dict (threads=5, shm_buffer="64K"),
+    dict (threads=4, auto_reads=1000)])
+def test_auto (baseline, tmp_path, options):
+    """Automatic tuning chooses a configuration within the thread limit, reports it in the log and does not change the output"""
+    input_fn, baseline_fn = baseline["samples"]
+    options.setdefault ("auto_reads", 20)
+    assert_same_reads (baseline_fn, collapse (input_fn, tmp_path, "out", auto=True, **options))
+    with open (tmp_path/"out_eventalign_collapse.log") as fp:
+        log = fp.read ()
+    assert "Auto tuning:" in log
+    auto_d = OrderedDict (line.split (": ") for line in log.split ("Auto tuning:\n")[1].split ("\n\n")[0].splitlines() if ": " in line)
+    assert int (auto_d["sampled_reads"]) == min (options["auto_reads"], 42)
+    assert 1 <= int (auto_d["workers"]) <= options["threads"]-2
+    assert int (auto_d["batch_reads"]) >= 1 and int (auto_d["queue_size"]) >= 1
+
+def test_auto_stream (baseline, tmp_path):
+    input_fn, baseline_fn = baseline["samples"]
+    fifo = str(tmp_path/"fifo")
+    os.mkfifo (fifo)
+    with pytest.raises (ValueError):
+        collapse (fifo, tmp_path, "out", auto=True)
+
+@pytest.mark.parametrize ("options", [{"threads":3}, {"threads":4, "writers":2}])
+def test_worker_error (tmp_path, options):
+    """A worker error is raised and the process exits although the queues are still full"""
+    input_fn = write_eventalign (str(tmp_path/"input.tsv"), n_reads=1000)
+    with open (input_fn) as fp:
+        line_list = fp.readlines ()
+    field_l = line_list[1].split ("\t")
+    field_l[-1] = "abc,def\n"
+    line_list[1] = "\t".join (field_l)
+    with open (input_fn, "w") as fp:
+        fp.writelines (line_list)
+    code = "\n".join ([
+        "from NanopolishComp.common import NanopolishCompError",
+        "from NanopolishComp.Eventalign_collapse import Eventalign_collapse",
+        "try:",
+        "    Eventalign_collapse ({!r}, outdir={!r}, outprefix='out', quiet=True, **{!r})".format(input_fn, str(tmp_path), options),
+        "except NanopolishCompError:",
+        "    print ('raised')"])
+    root_dir = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+    res = subprocess.run ([sys.executable, "-c", code], cwd=root_dir, capture_output=True, text=True, timeout=120)
+    assert res.returncode == 0
+    assert res.stdout.strip () == "raised"
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Third party imports
+import pytest
+import numpy as np
+
+# Local imports
+from NanopolishComp.common import NanopolishCompError
+from NanopolishComp.Eventalign_collapse import Eventalign_collapse
+from NanopolishComp.Eventalign_collapse_reader import Eventalign_collapse_reader
+from helpers import write_eventalign
+
+@pytest.fixture (scope="module")
+def data_fn (tmp_path_factory):
+    """Collapse a synthetic eventalign file in which the first reads are also aligned on txDUP"""
+    outdir = tmp_path_factory.mktemp ("reader")
+    input_fn = write_eventalign (str(outdir/"eventalign.tsv"), dup_reads=3)
+    Eventalign_collapse (input_fn, outdir=str(outdir), outprefix="out", threads=3, quiet=True)
+    return str(outdir/"out_eventalign_collapse.tsv")
+
+def test_iter (data_fn):
+    with Eventalign_collapse_reader (data_fn, quiet=True) as reader:
+        read_list = list (reader)
+        assert len(read_list) == len(reader) == 43
+        for (read_id, read_a), kmers in zip (read_list, reader.idx["kmers"][np.argsort(reader.offset)]):
+            assert len(read_a) == kmers
+
+def test_get_read (data_fn):
+    with Eventalign_collapse_reader (data_fn, quiet=True) as reader:
+        for read_id, read_a in reader:
+            if len (reader.get_ref_ids (read_id)) == 1:
+                assert np.array_equal (reader.get_read (read_id), read_a)
+                assert reader.get_read_info (read_id)["read_id"] == read_id
+        assert "unknown_read" not in reader
+        with pytest.raises (NanopolishCompError):
+            reader.get_read ("unknown_read")
+
+def test_get_read_multiple_references (data_fn):
+    """Each alignment of a read aligned on several references is reachable with ref_id"""
+    with Eventalign_collapse_reader (data_fn, quiet=True) as reader:
+        dup_reads = reader.overlapping_reads ("txDUP")
+        assert len(dup_reads) == 3
+        for read_id in dup_reads:
+            ref_ids = reader.get_ref_ids (read_id)
+            assert len(ref_ids) == 2 and "txDUP" in ref_ids
+            assert read_id in reader
+            with pytest.raises (NanopolishCompError):
+                reader.get_read (read_id)
+            for ref_id in ref_ids:
+                read_d = reader.get_read_info (read_id, ref_id=ref_id)
+                assert read_d["ref_id"] == ref_id
+                read_a = reader.get_read (read_id, ref_id=ref_id)
+                assert len(read_a) == read_d["kmers"]
+                assert read_a["ref_pos"][0] == read_d["ref_start"]
+            with pytest.raises (NanopolishCompError):
+                reader.get_read (read_id, ref_id="tx_unknown")
+
+def test_query (data_fn):
+    with Eventalign_collapse_reader (data_fn, quiet=True) as reader:
+        for ref_id in reader.ref_ids:
+            ref_reads = reader.overlapping_reads (ref_id)
+            assert len(ref_reads) == np.sum (reader.idx["ref_id"] == ref_id)
+            start, end = 1000, 3000
+            expected = set (np.flatnonzero ((reader.idx["ref_id"] == ref_id) & (reader.idx["ref_start"] < end) & (reader.idx["ref_end"] > start)))
+            found = [read_id for read_id, read_a in reader.query ("{}:{}-{}".format(ref_id, start, end))]
+            assert sorted(found) == sorted(reader.idx["read_id"][list(expected)])
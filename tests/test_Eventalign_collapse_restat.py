@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+# Third party imports
+import pytest
+
+# Local imports
+from NanopolishComp.Eventalign_collapse import Eventalign_collapse
+from NanopolishComp.Eventalign_collapse_restat import Eventalign_collapse_restat
+from helpers import write_eventalign, assert_same_reads
+
+ALL_STAT_FIELDS = ["mean", "std", "median", "mad", "num_signals"]
+
+@pytest.fixture (scope="module")
+def collapsed_dir (tmp_path_factory):
+    """Collapse a synthetic eventalign file with all the stat fields and with a float32 samples file"""
+    outdir = tmp_path_factory.mktemp ("restat")
+    input_fn = write_eventalign (str(outdir/"eventalign.tsv"))
+    Eventalign_collapse (input_fn, outdir=str(outdir), outprefix="all", stat_fields=ALL_STAT_FIELDS, threads=3, quiet=True)
+    Eventalign_collapse (input_fn, outdir=str(outdir), outprefix="ref", stat_fields=["median"], write_samples=True,
+        samples_format="float32", threads=3, quiet=True)
+    return outdir
+
+def test_restat (collapsed_dir):
+    """Statistics recomputed from the samples file are the ones computed from the eventalign samples"""
+    Eventalign_collapse_restat (str(collapsed_dir/"ref_eventalign_collapse.tsv"), outdir=str(collapsed_dir), outprefix="restat",
+        stat_fields=ALL_STAT_FIELDS, threads=3, quiet=True)
+    assert_same_reads (str(collapsed_dir/"all_eventalign_collapse.tsv"), str(collapsed_dir/"restat_eventalign_collapse.tsv"), rtol=1e-5)
+    assert (collapsed_dir/"restat_eventalign_collapse.log").exists ()
+
+def test_restat_multiple_references (tmp_path):
+    """All the alignments of reads aligned on several references are recomputed"""
+    input_fn = write_eventalign (str(tmp_path/"eventalign.tsv"), n_reads=20, dup_reads=5)
+    Eventalign_collapse (input_fn, outdir=str(tmp_path), outprefix="all", stat_fields=ALL_STAT_FIELDS, threads=3, quiet=True)
+    Eventalign_collapse (input_fn, outdir=str(tmp_path), outprefix="ref", write_samples=True, samples_format="float32", threads=3, quiet=True)
+    Eventalign_collapse_restat (str(tmp_path/"ref_eventalign_collapse.tsv"), outdir=str(tmp_path), outprefix="restat",
+        stat_fields=ALL_STAT_FIELDS, threads=3, quiet=True)
+    read_d = assert_same_reads (str(tmp_path/"all_eventalign_collapse.tsv"), str(tmp_path/"restat_eventalign_collapse.tsv"), rtol=1e-5)
+    assert len(read_d) == 25
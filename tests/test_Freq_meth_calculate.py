@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+# Standard library imports
+import math
+import csv
+from collections import *
+
+# Third party imports
+import pytest
+import numpy as np
+
+# Local imports
+from NanopolishComp.common import NanopolishCompError
+from NanopolishComp.Freq_meth_calculate import Freq_meth_calculate, Site, SiteKeys
+from helpers import write_meth_calls, compress_file
+
+@pytest.fixture (scope="module")
+def meth_fn (tmp_path_factory):
+    """Synthetic call-methylation file and fasta index"""
+    outdir = tmp_path_factory.mktemp ("freq_meth")
+    write_meth_calls (str(outdir/"meth.tsv"), fai_fn=str(outdir/"meth.fa.fai"), n_reads=1000)
+    return outdir/"meth.tsv"
+
+def read_bed (fn):
+    """Return the list of BED lines split in fields without the track header"""
+    with open (fn) as fp:
+        fp.readline ()
+        return [line.rstrip("\n").split("\t") for line in fp]
+
+def test_med_llr (meth_fn, tmp_path):
+    """The mean llr of each site is the correctly rounded mean of its read calls"""
+    llr_d = defaultdict (list)
+    with open (meth_fn) as fp:
+        for l in csv.DictReader (fp, delimiter="\t"):
+            llr_d[(l["chromosome"], int(l["start"]))].append (float(l["log_lik_ratio"]))
+
+    Freq_meth_calculate (str(meth_fn), output_bed_fn=str(tmp_path/"out.bed"), min_depth=1, quiet=True)
+    bed_list = read_bed (tmp_path/"out.bed")
+    assert len(bed_list) == len(llr_d)
+    for chrom, start, end, site_id, med_llr, *_ in bed_list:
+        llr_list = llr_d[(chrom, int(start))]
+        assert med_llr == "{:.6f}".format(round(math.fsum(llr_list)/len(llr_list), 6)+0.0)
+
+@pytest.mark.parametrize ("llr_list", [[0.3, -0.1, -0.2], [-0.2, -0.1, 0.3], [1.5, -1.5], [-0.0, -0.0], [0.01, -0.01, -1e-9]])
+def test_med_llr_zero (tmp_path, llr_list):
+    """A mean llr rounding to zero is written as 0.000000, without minus sign"""
+    input_fn = str(tmp_path/"meth.tsv")
+    with open (input_fn, "w") as fp:
+        fp.write ("chromosome\tstrand\tstart\tend\tread_name\tlog_lik_ratio\tlog_lik_methylated\tlog_lik_unmethylated\tnum_calling_strands\tnum_motifs\tsequence\n")
+        for i, llr in enumerate (llr_list):
+            fp.write ("chr1\t+\t100\t100\tread_{}\t{!r}\t-100\t-100\t1\t1\tACGTACGTACG\n".format(i, llr))
+    Freq_meth_calculate (input_fn, output_bed_fn=str(tmp_path/"out.bed"), min_depth=1, quiet=True)
+    assert read_bed (tmp_path/"out.bed")[0][4] == "0.000000"
+
+def test_site_merge ():
+    """Merging the counters of parts of a site gives the same mean llr as aggregating all the calls at once"""
+    Line = namedtuple ("Line", ["chromosome", "strand", "start", "end", "log_lik_ratio", "sequence", "num_motifs"])
+    Site.set_class_param (keep_llr_list=False)
+    llr_list = [0.1, 0.2, -0.3, 1e16, 1.37, -1e16, 2.6, -4.85, 0.01]
+    line_list = [Line("chr1", "+", 10, 10, llr, "ACGT", 1) for llr in llr_list]
+    site = Site (line_list[0])
+    for l in line_list[1:]:
+        site.add (l)
+    part1, part2 = Site (line_list[5]), Site (line_list[0])
+    for l in line_list[6:]:
+        part1.add (l)
+    for l in line_list[1:5]:
+        part2.add (l)
+    part1.merge (part2)
+    assert site.total == part1.total == len(llr_list)
+    assert site.med_llr == part1.med_llr == math.fsum(llr_list)/len(llr_list)
+
+@pytest.mark.parametrize ("threads", [2, 5])
+@pytest.mark.parametrize ("strand_specific", [False, True])
+def test_threads (meth_fn, tmp_path, threads, strand_specific):
+    """Parsing the input with several processes gives the same output as a single process"""
+    kwargs = dict (fasta_index=str(meth_fn.parent/"meth.fa.fai") if strand_specific else "", strand_specific=strand_specific, min_depth=2, quiet=True)
+    Freq_meth_calculate (str(meth_fn), output_bed_fn=str(tmp_path/"serial.bed"), output_tsv_fn=str(tmp_path/"serial.tsv"), **kwargs)
+    Freq_meth_calculate (str(meth_fn), output_bed_fn=str(tmp_path/"parallel.bed"), output_tsv_fn=str(tmp_path/"parallel.tsv"), threads=threads, **kwargs)
+    for ext in ["bed", "tsv"]:
+        assert (tmp_path/"serial.{}".format(ext)).read_text() == (tmp_path/"parallel.{}".format(ext)).read_text()
+
+def test_threads_merge_order (tmp_path):
+    """Calls of a site split between byte ranges are summed exactly, so the result does not depend on the ranges"""
+    header = "chromosome\tstrand\tstart\tend\tread_name\tlog_lik_ratio\tlog_lik_methylated\tlog_lik_unmethylated\tnum_calling_strands\tnum_motifs\tsequence\n"
+    line = "{}\t+\t{}\t{}\tread_{}\t{}\t-100.0\t-100.0\t1\t1\tACGTACGTACG\n"
+    # 1 is lost when added to 1e16, but 2 is not
+    group_list = [[1e16], [1.0, 1.0], [1.0, 1.0], [1.0, 1.0], [], [], [], [-1e16]]
+    with open (tmp_path/"meth.tsv", "w") as fp:
+        fp.write (header)
+        for i, group in enumerate (group_list):
+            for j in range (50):
+                fp.write (line.format("chr2", 1000+100*i+j, 1000+100*i+j, j, -1.5))
+                if j == 25:
+                    for llr in group:
+                        fp.write (line.format("chr1", 10, 10, j, llr))
+
+    for threads in [1, 2]:
+        Freq_meth_calculate (str(tmp_path/"meth.tsv"), output_bed_fn=str(tmp_path/"{}.bed".format(threads)), min_depth=1, threads=threads, quiet=True)
+    bed_list = read_bed (tmp_path/"1.bed")
+    assert bed_list == read_bed (tmp_path/"2.bed")
+    site = [bed for bed in bed_list if bed[0] == "chr1"][0]
+    assert site[4] == "{:.6f}".format(6/8)
+
+def test_site_keys_sort (tmp_path):
+    """Keys are sorted by chromosome in fasta index order, start and strand. Chromosomes missing from the index come last"""
+    with open (tmp_path/"ref.fa.fai", "w") as fp:
+        fp.write ("chr2\t1000\t0\t60\t61\nchr1\t1000\t0\t60\t61\n")
+    site_keys = SiteKeys (str(tmp_path/"ref.fa.fai"))
+    site_list = [("chrU2", 5, "+"), ("chr1", 20, "-"), ("chr1", 20, "+"), ("chrU1", 1, "+"), ("chr2", 300, "+"), ("chr1", 3, "+"), ("chr2", 7, "-")]
+    key_array = np.array ([site_keys.encode (*site) for site in site_list], dtype=np.int64)
+    code_rank = site_keys.code_rank
+    order = site_keys.sort_order (key_array)
+    assert [site_list[i] for i in order] == [
+        ("chr2", 7, "-"), ("chr2", 300, "+"), ("chr1", 3, "+"), ("chr1", 20, "+"), ("chr1", 20, "-"), ("chrU2", 5, "+"), ("chrU1", 1, "+")]
+    # The rank array is only updated for new chromosomes
+    site_keys.encode ("chr1", 30, "+")
+    site_keys.sort_order (key_array)
+    assert site_keys.code_rank is code_rank
+    assert site_keys.chrom_rank ("chr1") < site_keys.chrom_rank ("chrU2") < site_keys.chrom_rank ("chrU1")
+
+def test_site_keys_encode_array ():
+    """Keys encoded from arrays are the same as keys encoded one by one"""
+    site_list = [("chrB", 5, "+"), ("chrA", 20, "-"), ("chrB", 20, "+"), ("chrC", 1, "."), ("chrA", 300, "+")]
+    site_keys = SiteKeys ()
+    key_list = [site_keys.encode (*site) for site in site_list]
+    site_keys = SiteKeys ()
+    chrom, start, strand = [np.array (col, dtype=dtype) for col, dtype in zip (zip(*site_list), [object, np.int64, object])]
+    assert site_keys.encode_array (chrom, start, strand).tolist() == key_list
+    assert list(site_keys.chrom_code.keys()) == ["chrB", "chrA", "chrC"]
+    with pytest.raises (NanopolishCompError):
+        site_keys.encode_array (chrom, -start)
+
+@pytest.mark.parametrize ("compression", ["gzip", "bgzf"])
+def test_compressed_input (meth_fn, tmp_path, compression):
+    compressed_fn = compress_file (str(meth_fn), str(tmp_path/"meth.tsv.gz"), compression)
+    for name, fn in [("plain", str(meth_fn)), ("compressed", compressed_fn)]:
+        Freq_meth_calculate (fn, output_bed_fn=str(tmp_path/"{}.bed".format(name)), output_tsv_fn=str(tmp_path/"{}.tsv".format(name)),
+            min_depth=2, quiet=True)
+    for ext in ["bed", "tsv"]:
+        assert (tmp_path/"plain.{}".format(ext)).read_text() == (tmp_path/"compressed.{}".format(ext)).read_text()
+    with pytest.raises (ValueError):
+        Freq_meth_calculate (compressed_fn, output_bed_fn=str(tmp_path/"out.bed"), threads=2, quiet=True)
+
+def write_sorted (meth_fn, fai_fn, out_fn):
+    """Sort the lines of a call-methylation file by chromosome in fasta index order and start. Calls of a site keep the input order"""
+    with open (fai_fn) as fp:
+        chrom_rank = {line.split("\t")[0]:i for i, line in enumerate (fp)}
+    with open (meth_fn) as fp:
+        header = fp.readline ()
+        lines = sorted (fp, key=lambda line: (chrom_rank[line.split("\t")[0]], int(line.split("\t")[2])))
+    with open (out_fn, "w") as fp:
+        fp.write (header+"".join (lines))
+    return out_fn
+
+@pytest.mark.parametrize ("strand_specific", [False, True])
+def test_sorted_input (meth_fn, tmp_path, strand_specific):
+    """Sites of a sorted input written on the fly are the same as the sites sorted at the end"""
+    fai_fn = str(meth_fn.parent/"meth.fa.fai")
+    sorted_fn = write_sorted (str(meth_fn), fai_fn, str(tmp_path/"sorted_meth.tsv"))
+    kwargs = dict (fasta_index=fai_fn, strand_specific=strand_specific, min_depth=2, quiet=True)
+    Freq_meth_calculate (str(meth_fn), output_bed_fn=str(tmp_path/"ref.bed"), output_tsv_fn=str(tmp_path/"ref.tsv"), **kwargs)
+    Freq_meth_calculate (sorted_fn, output_bed_fn=str(tmp_path/"sorted.bed"), output_tsv_fn=str(tmp_path/"sorted.tsv"), sorted_input=True, **kwargs)
+    for ext in ["bed", "tsv"]:
+        assert (tmp_path/"ref.{}".format(ext)).read_text() == (tmp_path/"sorted.{}".format(ext)).read_text()
+
+def test_sorted_input_unsorted (meth_fn, tmp_path):
+    """Lines before the current position, chromosomes found again and chromosomes out of fasta index order raise an error"""
+    fai_fn = str(meth_fn.parent/"meth.fa.fai")
+    with open (write_sorted (str(meth_fn), fai_fn, str(tmp_path/"sorted.tsv"))) as fp:
+        header = fp.readline ()
+        lines = fp.readlines ()
+    chrom_list = [line.split("\t")[0] for line in lines]
+    first_chrom_end = chrom_list.index (chrom_list[-1])
+    unsorted_d = {
+        "start": lines[:100]+lines[50:51]+lines[100:],
+        "chrom_again": lines+lines[:1],
+        "chrom_order": lines[first_chrom_end:]+lines[:first_chrom_end]}
+    for name, line_list in unsorted_d.items():
+        with open (tmp_path/"{}.tsv".format(name), "w") as fp:
+            fp.write (header+"".join (line_list))
+        with pytest.raises (NanopolishCompError, match="not sorted"):
+            Freq_meth_calculate (str(tmp_path/"{}.tsv".format(name)), output_bed_fn=str(tmp_path/"out.bed"), fasta_index=fai_fn, sorted_input=True, quiet=True)
+    # Without fasta index, chromosomes can be in any order
+    Freq_meth_calculate (str(tmp_path/"chrom_order.tsv"), output_bed_fn=str(tmp_path/"out.bed"), sorted_input=True, min_depth=1, quiet=True)
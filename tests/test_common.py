@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+# Standard library imports
+import gzip
+
+# Third party imports
+import pytest
+import numpy as np
+
+# Local imports
+from NanopolishComp.common import *
+from helpers import write_meth_calls, compress_file
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~LineParser~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+COLUMNS = OrderedDict ([("chromosome", str), ("strand", str), ("start", int), ("end", int), ("log_lik_ratio", float), ("sequence", str), ("num_motifs", int)])
+
+@pytest.fixture (scope="module")
+def meth_lines (tmp_path_factory):
+    """Header and lines of a synthetic call-methylation file"""
+    fn = write_meth_calls (str(tmp_path_factory.mktemp ("common")/"meth.tsv"), n_reads=50)
+    with open (fn) as fp:
+        return fp.readline (), fp.readlines ()
+
+def invalid_start (line):
+    """Replace the start field of a line by a non numeric value"""
+    field_list = line.split ("\t")
+    field_list[2] = "not_int"
+    return "\t".join (field_list)
+
+def test_line_parser_columns (meth_lines):
+    """Projected columns have the values of the full parsing with the declared types"""
+    header_line, lines = meth_lines
+    lp_full = LineParser (header_line, sep="\t", cast_numeric_field=True)
+    lp_proj = LineParser (header_line, sep="\t", columns=COLUMNS)
+    for line in lines:
+        l_full, l_proj = lp_full (line), lp_proj (line)
+        assert l_proj._fields == tuple(COLUMNS.keys())
+        for field, col_type in COLUMNS.items():
+            assert getattr (l_proj, field) == getattr (l_full, field)
+            assert type (getattr (l_proj, field)) == col_type
+    assert lp_proj.c["Valid line parsed"] == len(lines)
+
+def test_line_parser_column_list (meth_lines):
+    """Columns given as a list are cast as numeric when possible"""
+    header_line, lines = meth_lines
+    lp = LineParser (header_line, sep="\t", columns=["chromosome", "start", "log_lik_ratio"])
+    l = lp (lines[0])
+    assert l._fields == ("chromosome", "start", "log_lik_ratio")
+    assert type(l.start) == int and type(l.log_lik_ratio) == float
+
+def test_line_parser_invalid (meth_lines):
+    header_line, lines = meth_lines
+    lp = LineParser (header_line, sep="\t", columns=COLUMNS)
+    assert lp ("chr1\t+\t10") is None
+    assert lp (invalid_start (lines[0])) is None
+    assert lp.c["Inconsistent field numbers"] == 1 and lp.c["Invalid field value"] == 1
+    with pytest.raises (NanopolishCompError):
+        LineParser (header_line, sep="\t", columns=["unknown_column"])
+    with pytest.raises (NanopolishCompError):
+        LineParser (header_line, sep="\t", columns={"start":bool})
+
+def test_parse_block (meth_lines):
+    """parse_block returns the columns of the valid lines parsed line by line"""
+    header_line, lines = meth_lines
+    lp = LineParser (header_line, sep="\t", columns=COLUMNS)
+    line_list = [lp (line) for line in lines]
+    block = lines[:10]+["chr1\t+\t10\n", invalid_start (lines[10])]+lines[11:]
+    col_d = lp.parse_block (block)
+    assert list(col_d.keys()) == list(COLUMNS.keys())
+    assert col_d["start"].dtype == np.int64 and col_d["log_lik_ratio"].dtype == np.float64
+    assert [lp.line_tuple._make (row) for row in zip (*[a.tolist() for a in col_d.values()])] == line_list[:10]+line_list[11:]
+    with pytest.raises (NanopolishCompError):
+        LineParser (header_line, sep="\t").parse_block (lines)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~parse_size~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+def test_parse_size ():
+    assert parse_size (1000) == parse_size ("1000") == 1000
+    assert parse_size ("2K") == parse_size ("2kb") == 2048
+    assert parse_size ("1.5M") == 1536*1024
+    assert parse_size ("8G") == 8*1024**3
+    for size in ["-1", "12X", "M"]:
+        with pytest.raises (NanopolishCompError):
+            parse_size (size)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~kmer codec~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+def test_kmer_codec ():
+    kmer_list = ["AAAAA", "ACGTA", "TTTTT", "GATTACA", "A", "CG", "acgta"]
+    code_array = kmer_to_code (kmer_list)
+    assert code_array.dtype == np.uint16
+    assert len(set(code_array.tolist())) == len(set(kmer.upper() for kmer in kmer_list))
+    assert code_to_kmer (code_array).tolist() == [kmer.upper() for kmer in kmer_list]
+    # Kmers with other bases are decoded as N, U as T
+    assert code_to_kmer (kmer_to_code (["ACNTA", "ACGUA"])).tolist() == ["NNNNN", "ACGTA"]
+    assert code_to_kmer (kmer_to_code (np.array ([b"ACGTA", b"CCCCC"]))).tolist() == ["ACGTA", "CCCCC"]
+    with pytest.raises (NanopolishCompError):
+        kmer_to_code (["ACGTACGT"])
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~samples codec~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+def test_samples_codec ():
+    samples = np.random.RandomState (1).uniform (-300, 300, 1000).astype (np.float32)
+    a = encode_samples (samples, "float32")
+    assert a.dtype == np.float32 and np.array_equal (decode_samples (a), samples)
+    a = encode_samples (samples, "int16")
+    assert a.dtype == np.int16
+    decoded = decode_samples (a)
+    assert decoded.dtype == np.float32
+    assert np.max (np.abs (decoded-samples)) <= 0.5/SAMPLES_INT16_SCALE+1e-4
+    assert len (decode_samples (encode_samples (np.zeros (0, dtype=np.float32), "int16"))) == 0
+    with pytest.raises (NanopolishCompError):
+        encode_samples (np.array ([400], dtype=np.float32), "int16")
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~NpyWriter~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+def test_npy_writer (tmp_path):
+    dtype = [("ref_pos", np.int32), ("mean", np.float32)]
+    chunk_list = [np.array ([(i, i/3) for i in range (start, start+n)], dtype=dtype) for start, n in [(0, 5), (5, 1), (6, 1000)]]
+    with NpyWriter (str(tmp_path/"out.npy")) as fp:
+        for chunk in chunk_list:
+            fp.write (chunk)
+        with pytest.raises (NanopolishCompError):
+            fp.write (np.zeros (2, dtype=np.float64))
+    a = np.load (str(tmp_path/"out.npy"), mmap_mode="r")
+    assert np.array_equal (a, np.concatenate (chunk_list))
+
+    # Empty file with the default dtype
+    NpyWriter (str(tmp_path/"empty.npy"), default_dtype=dtype).close ()
+    a = np.load (str(tmp_path/"empty.npy"))
+    assert len(a) == 0 and a.dtype == np.dtype (dtype)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~open_input~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+@pytest.fixture (scope="module")
+def plain_fn (tmp_path_factory):
+    """Synthetic call-methylation file of a few hundred KB"""
+    return write_meth_calls (str(tmp_path_factory.mktemp ("open_input")/"meth.tsv"), n_reads=300)
+
+@pytest.mark.parametrize ("compression", [None, "gzip", "bgzf"])
+@pytest.mark.parametrize ("threads", [1, 3])
+def test_open_input (plain_fn, compression, threads):
+    """Compressed files are detected and read as the plain file in text and binary mode"""
+    fn = compress_file (plain_fn, plain_fn+"."+compression, compression) if compression else plain_fn
+    assert input_compression (fn) == compression
+    with open (plain_fn, "rb") as fp:
+        data = fp.read ()
+    with open_input (fn, "rb", threads=threads) as fp:
+        assert fp.read () == data
+    with open_input (fn, threads=threads) as fp:
+        assert fp.readline () == data[:data.index(b"\n")+1].decode()
+        assert fp.read () == data[data.index(b"\n")+1:].decode()
+    with pytest.raises (NanopolishCompError):
+        open_input (fn, "w")
+
+def test_open_input_zstd (plain_fn):
+    zstandard = pytest.importorskip ("zstandard")
+    with open (plain_fn, "rb") as fp:
+        data = fp.read ()
+    with open (plain_fn+".zst", "wb") as fp:
+        fp.write (zstandard.ZstdCompressor().compress (data[:1000])+zstandard.ZstdCompressor().compress (data[1000:]))
+    assert input_compression (plain_fn+".zst") == "zstd"
+    with open_input (plain_fn+".zst", "rb") as fp:
+        assert fp.read () == data
+
+def test_bgzf_reader_invalid (plain_fn, tmp_path):
+    """Truncated BGZF files raise an error"""
+    fn = compress_file (plain_fn, str(tmp_path/"meth.tsv.bgz"), "bgzf")
+    with open (fn, "rb") as fp:
+        data = fp.read ()
+    with open (str(tmp_path/"truncated.bgz"), "wb") as fp:
+        fp.write (data[:10000])
+    with pytest.raises (NanopolishCompError):
+        with open_input (str(tmp_path/"truncated.bgz"), "rb") as fp:
+            fp.read ()
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~BGZFWriter~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+@pytest.mark.parametrize ("threads", [1, 4])
+def test_bgzf_writer (plain_fn, tmp_path, threads):
+    """Data written in BGZF is read back by BGZFReader and by gzip, and virtual offsets give random access to any position"""
+    with open (plain_fn, "rb") as fp:
+        data = fp.read ()
+    line_list = data.splitlines (keepends=True)
+    offset_list = []
+    with BGZFWriter (str(tmp_path/"out.gz"), threads=threads) as writer:
+        for line in line_list:
+            offset_list.append (writer.tell ())
+            writer.write (line.decode() if len(offset_list)%2 else line)
+            # Offsets are only converted once the block containing them is written
+            assert writer.virtual_offset (writer.tell ()) is None
+        assert writer.tell () == len(data)
+    virtual_offset_list = [writer.virtual_offset (offset) for offset in offset_list]
+    assert len(data) > 4*BGZFWriter.BLOCK_SIZE
+    assert input_compression (str(tmp_path/"out.gz")) == "bgzf"
+    with gzip.open (str(tmp_path/"out.gz"), "rb") as fp:
+        assert fp.read () == data
+    with open_input (str(tmp_path/"out.gz"), "rb", threads=threads) as fp:
+        assert fp.read () == data
+
+    with open (str(tmp_path/"out.gz"), "rb") as fp:
+        for line, virtual_offset in list (zip (line_list, virtual_offset_list))[::37]+[(line_list[-1], virtual_offset_list[-1])]:
+            assert bgzf_read (fp, virtual_offset, len(line)) == line
+        # A read spanning several blocks
+        assert bgzf_read (fp, virtual_offset_list[1], 3*BGZFWriter.BLOCK_SIZE) == data[offset_list[1]:offset_list[1]+3*BGZFWriter.BLOCK_SIZE]